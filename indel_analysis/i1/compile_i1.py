@@ -3,8 +3,8 @@ import Bio.Seq
 
 from selftarget.data import isOldLib, getDirNameFromSubdir, getIndelSummaryFiles, getDirLabel, createResultDirectory, getExpOligoFile
 from selftarget.indel import tokFullIndel
-from selftarget.profile import readSummaryToProfile, getHighestIndel, getProfileCounts, fetchRepresentativeCleanReads
-from selftarget.oligo import getOligoIdsFromFile, getShortOligoId, loadAllOligoDetails, loadExpOligoLookup
+from selftarget.profile import readSummaryToProfiles, getHighestIndel, getProfileCounts, fetchRepresentativeCleanReads
+from selftarget.oligo import getShortOligoId, loadAllOligoDetails, loadExpOligoLookup
 
 
 def loadI1to3Details(filename):
@@ -66,12 +66,10 @@ if __name__ == '__main__':
     sum_files = getIndelSummaryFiles(subdir)
     for filename in sum_files:
         file_prefix = filename.split('/')[-1][:-23]
-        oligo_ids = getOligoIdsFromFile(filename)
-        for id in oligo_ids:
+        for id, p1, acc, pacc, null in readSummaryToProfiles(filename):
     
             #Read in the profile (if it exists)	
-            p1 = {}
-            stats1 = readSummaryToProfile(filename, p1, oligoid=getShortOligoId(id))
+            stats1 = (acc, pacc, null)
 
             if len(p1) == 0 or p1.keys() == ['-']:
                 continue
@@ -3,8 +3,8 @@ import Bio.Seq
 
 from selftarget.data import getIndelSummaryFiles, getDirLabel, createResultDirectory, getExpOligoFile, setHighDataDir
 from selftarget.indel import tokFullIndel
-from selftarget.profile import readSummaryToProfile, getHighestIndel, getProfileCounts
-from selftarget.oligo import getOligoIdsFromFile, getShortOligoId, loadAllOligoDetails, loadExpOligoLookup
+from selftarget.profile import readSummaryToProfiles, getHighestIndel, getProfileCounts
+from selftarget.oligo import loadAllOligoDetails, loadExpOligoLookup
 
 def getSequence(oligo_det, left, right):
     pam_loc, pam_dir, seq = oligo_det
@@ -61,12 +61,10 @@ if __name__ == '__main__':
         for filename in sum_files:
             file_prefix = filename.split('/')[-1][:-23]
             oligo_details = {x[0]: x[1:] for x in oligo_lookup[file_prefix]}
-            oligo_ids = getOligoIdsFromFile(filename)
-            for id in oligo_ids:
+            for id, p1, acc, pacc, null in readSummaryToProfiles(filename):
     
                 #Read in the profile (if it exists)	
-                p1 = {}
-                stats1 = readSummaryToProfile(filename, p1, oligoid=getShortOligoId(id))
+                stats1 = (acc, pacc, null)
 
                 if len(p1) == 0 or p1.keys() == ['-']:
                     continue
@@ -1,69 +1,104 @@
 import io, sys, os, csv
 import numpy as np
 
-from selftarget.profile import readSummaryToProfile, symmetricKL, compareTopIndels, entropy, percentOverlap
-from selftarget.oligo import getOligoIdsFromFile
+from selftarget.profile import readSummaryToProfiles
+from selftarget.metrics import AlignedProfiles
 from selftarget.data import getDirLabel, getIndelSummaryFiles, getSubdirs
 
+REMOVE_LARGE_I = True
+HEADER = u'ID\tNum Reads 1\tNum Reads 2\tNum States 1\tNum States 2\tNum null reads 1\tNum null reads 2\tKL with Null\tKL without null\tPerc Accepted Reads 1\tPerc Accepted Reads 2\t1st Nonmatch Indel\tNum Top 3 Common\tNum Top 5 Common\tNum Top 10 Common\tProfile 1 Entropy (before mods)\tProfile 2 Entropy (before mods)\tProfile 1 Entropy (after mods)\tProfile 2 Entropy (after mods)\tPerc Overlap\tP1 Perc in Top 3\tP2 Perc in Top 3\tP1 Perc in Top 5\tP2 Perc in Top 5\tP1 Perc in Top 10\tP2 Perc in Top 10\n'
+
 def filterLargeI(profile):
     return {x:profile[x] for x in profile if (x[0] == '-' or x[0] != 'I' or x[1] != '1')}
 
-if len(sys.argv) != 4:
-    print('compare_pairwise.py <dirname1> <dirname2> <subdir>')
-else:
+def getOutFile(dirname1, dirname2, subdir):
+    out_dir = 'profile_comparison_summaries' if not REMOVE_LARGE_I else 'profile_comparison_summaries_nolargeI'
+    if not os.path.isdir(out_dir): os.mkdir(out_dir)
+    out_dir += '/%s_vs_%s' % (getDirLabel(dirname1),getDirLabel(dirname2))
+    if not os.path.isdir(out_dir): os.mkdir(out_dir)
+    return out_dir + '/%s.txt' % subdir
+
+def loadSubdirFileProfiles(dirname, subdir, filename):
+    #{oligo_id: (profile, num_reads, perc_accepted, null_reads, num_states)} for one summary file
+    profiles = {}
+    for oligo_id, profile, num_reads, perc_acc, nonull in readSummaryToProfiles(dirname + '/mapped_reads/' + subdir + '/' + filename):
+        ns = len(profile)
+        if REMOVE_LARGE_I: profile = filterLargeI(profile)
+        profiles[oligo_id] = (profile, num_reads, perc_acc, nonull, ns)
+    return profiles
+
+def formatComparison(oligo_id, aligned, i, j, stats1, stats2):
+    _, num_reads1, perc_acc1, nonull1, ns1 = stats1
+    _, num_reads2, perc_acc2, nonull2, ns2 = stats2
+
+    ent1a, ent2a = aligned.entropy(i,True), aligned.entropy(j,True)
+    poverlap = aligned.percentOverlap( i, j, True )
+
+    score1 = aligned.symmetricKL( i, j, False )
+    score2 = aligned.symmetricKL( i, j, True )
+
+    ent1b, ent2b = ent1a, ent2a    #(Comparing the profiles no longer modifies them)
 
-    remove_largeI = True
+    nonmatch_idx, top_common, top_percs = aligned.compareTopIndels(i, j)
+    return u'%s\t%d\t%d\t%d\t%d\t%d\t%d\t%.6f\t%.6f\t%.3f\t%.3f\t%d\t%d\t%d\t%d\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\n' % (oligo_id, num_reads1, num_reads2, ns1, ns2, nonull1, nonull2, score1, score2, perc_acc1, perc_acc2, nonmatch_idx, top_common[3], top_common[5], top_common[10], ent1a, ent2a, ent1b, ent2b, poverlap, top_percs[3][0],top_percs[3][1],top_percs[5][0],top_percs[5][1], top_percs[10][0], top_percs[10][1])
 
-    dirname1, dirname2 = sys.argv[1], sys.argv[2]
-    subdir = sys.argv[3]
+def comparePair(dirname1, dirname2, subdir):
 
     if subdir not in getSubdirs(dirname1, withpath=False):
         raise Exception('No subdir %s in %s' % (subdir, dirname1) )
     if subdir not in getSubdirs(dirname2, withpath=False):
-        raise Exception('No subdir %s in %s' % (subdir, dirname2) )    
-        
-    out_dir = 'profile_comparison_summaries' if not remove_largeI else 'profile_comparison_summaries_nolargeI'
-    if not os.path.isdir(out_dir): os.mkdir(out_dir)
-    out_dir += '/%s_vs_%s' % (getDirLabel(dirname1),getDirLabel(dirname2))
-    if not os.path.isdir(out_dir): os.mkdir(out_dir)
-    out_file = out_dir + '/%s.txt' % subdir
-    
-    fout = io.open(out_file,'w')
-    fout.write(u'ID\tNum Reads 1\tNum Reads 2\tNum States 1\tNum States 2\tNum null reads 1\tNum null reads 2\tKL with Null\tKL without null\tPerc Accepted Reads 1\tPerc Accepted Reads 2\t1st Nonmatch Indel\tNum Top 3 Common\tNum Top 5 Common\tNum Top 10 Common\tProfile 1 Entropy (before mods)\tProfile 2 Entropy (before mods)\tProfile 1 Entropy (after mods)\tProfile 2 Entropy (after mods)\tPerc Overlap\tP1 Perc in Top 3\tP2 Perc in Top 3\tP1 Perc in Top 5\tP2 Perc in Top 5\tP1 Perc in Top 10\tP2 Perc in Top 10\n')
-    
+        raise Exception('No subdir %s in %s' % (subdir, dirname2) )
+
+    fout = io.open(getOutFile(dirname1, dirname2, subdir),'w')
+    fout.write(HEADER)
+
     dir1_files = getIndelSummaryFiles(dirname1 + '/mapped_reads/' + subdir, withpath=False)
     dir2_files = getIndelSummaryFiles(dirname2 + '/mapped_reads/' + subdir, withpath=False)
     common_files =  set(dir1_files).intersection(set(dir2_files))
     for filename in common_files:
-        
-        filename1 = dirname1 + '/mapped_reads/' + subdir + '/' + filename
-        filename2 = dirname2 + '/mapped_reads/' + subdir + '/' + filename
-        
-        oligo_ids1 = getOligoIdsFromFile( filename1 )
-        oligo_ids2 = getOligoIdsFromFile( filename2 )
-        common_oligos =  set(oligo_ids1).intersection(set(oligo_ids2))
-        for oligo_id in common_oligos:
 
-            profile1, profile2 = {}, {}
-            num_reads1, perc_acc1, nonull1 = readSummaryToProfile(filename1, profile1, oligoid=oligo_id)	
-            num_reads2, perc_acc2, nonull2 = readSummaryToProfile(filename2, profile2, oligoid=oligo_id)
-            ns1, ns2 = len(profile1), len(profile2)
+        profiles1 = loadSubdirFileProfiles(dirname1, subdir, filename)
+        profiles2 = loadSubdirFileProfiles(dirname2, subdir, filename)
+        common_oligos =  set(profiles1.keys()).intersection(set(profiles2.keys()))
+        for oligo_id in common_oligos:
+            aligned = AlignedProfiles([profiles1[oligo_id][0], profiles2[oligo_id][0]])
+            fout.write(formatComparison(oligo_id, aligned, 0, 1, profiles1[oligo_id], profiles2[oligo_id]))
 
-            if remove_largeI:
-                profile1 = filterLargeI(profile1)
-                profile2 = filterLargeI(profile2)
+    fout.close()
 
-            ent1a, ent2a = entropy(profile1,True), entropy(profile2,True)
-            poverlap = percentOverlap( profile1, profile2, True )
+def compareAllPairs(dirnames, subdir):
+    #Loads the profiles of each sample once per summary file, then compares all pairs of samples,
+    #writing the same <dirname1>_vs_<dirname2>/<subdir>.txt outputs as comparePair
+    dirnames = [x for x in dirnames if subdir in getSubdirs(x, withpath=False)]
+    pairs = [(i,j) for i in range(len(dirnames)) for j in range(i+1,len(dirnames))]
+    pair_lines = {pair: [] for pair in pairs}
 
-            score1 = symmetricKL( profile1, profile2, False )
-            score2 = symmetricKL( profile1, profile2, True )
+    dir_files = [set(getIndelSummaryFiles(x + '/mapped_reads/' + subdir, withpath=False)) for x in dirnames]
+    all_files = sorted(set([x for files in dir_files for x in files]))
+    for filename in all_files:
 
-            ent1b, ent2b = entropy(profile1,True), entropy(profile2,True)	#Since comparing the profiles appends missing states to both profiles
+        sample_idxs = [i for i in range(len(dirnames)) if filename in dir_files[i]]
+        profiles = {i: loadSubdirFileProfiles(dirnames[i], subdir, filename) for i in sample_idxs}
+        all_oligos = set([x for i in sample_idxs for x in profiles[i]])
+        for oligo_id in all_oligos:
+            oligo_idxs = [i for i in sample_idxs if oligo_id in profiles[i]]
+            aligned = AlignedProfiles([profiles[i][oligo_id][0] for i in oligo_idxs])
+            for a, i in enumerate(oligo_idxs):
+                for b, j in enumerate(oligo_idxs[a+1:]):
+                    pair_lines[(i,j)].append(formatComparison(oligo_id, aligned, a, a+1+b, profiles[i][oligo_id], profiles[j][oligo_id]))
 
-            nonmatch_idx, top_common, top_percs = compareTopIndels(profile1, profile2)
-            fout.write(u'%s\t%d\t%d\t%d\t%d\t%d\t%d\t%.6f\t%.6f\t%.3f\t%.3f\t%d\t%d\t%d\t%d\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f\n' % (oligo_id, num_reads1, num_reads2, ns1, ns2, nonull1, nonull2, score1, score2, perc_acc1, perc_acc2, nonmatch_idx, top_common[3], top_common[5], top_common[10], ent1a, ent2a, ent1b, ent2b, poverlap, top_percs[3][0],top_percs[3][1],top_percs[5][0],top_percs[5][1], top_percs[10][0], top_percs[10][1]))	
-    
-    fout.close()
+    for (i,j) in pairs:
+        fout = io.open(getOutFile(dirnames[i], dirnames[j], subdir),'w')
+        fout.write(HEADER)
+        fout.write(u''.join(pair_lines[(i,j)]))
+        fout.close()
 
+if __name__ == '__main__':
 
+    if len(sys.argv) > 3 and sys.argv[1] == '--all':
+        compareAllPairs(sys.argv[2:-1], sys.argv[-1])
+    elif len(sys.argv) == 4:
+        comparePair(sys.argv[1], sys.argv[2], sys.argv[3])
+    else:
+        print('compare_pairwise.py <dirname1> <dirname2> <subdir>')
+        print('compare_pairwise.py --all <dirname1> <dirname2> ... <dirnameN> <subdir>')
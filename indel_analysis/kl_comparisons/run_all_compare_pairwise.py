@@ -3,21 +3,31 @@ import itertools
 from selftarget.data import getAllDataDirs, getShortDir, getSubdirs, isOldLib
 from selftarget.util import getLogDir, runCmdCheckIdx, runSubdir
 
+#Set COMPARE_ALL_PAIRS=1 to run one job per subdir comparing all pairs of samples (each sample's
+#profiles are then loaded once per subdir, rather than once per partner sample)
+ALL_PAIRS = os.getenv('COMPARE_ALL_PAIRS', '0') == '1'
+
 if __name__ == '__main__':
-    
+
     all_dir, out_dir = getAllDataDirs(), getLogDir()
     idx = 0
     for old_lib in [False]: #[True,False]:
-    
+
         lib_dirs = [x for x in all_dir if (isOldLib(x) == old_lib) and os.path.isdir(x + '/mapped_reads') and 'DPI7' in x and 'K562_1600x_LV7B_DPI7' not in x and '2A_TREX' not in x and 'K562_800x_7A_DPI7_may' not in x]
-    
+
+        if ALL_PAIRS:
+            all_subdirs = set([x for dirname in lib_dirs for x in getSubdirs(dirname, withpath=False)])
+            extra_args = '--all %s ' % ' '.join(lib_dirs)
+            idx = runSubdir(idx, sorted(all_subdirs), 'All pairs', 'compare_pairwise.py', 'out_compare_pairwise', __file__, extra_args=extra_args)
+            continue
+
         for dirname1, dirname2 in itertools.combinations(lib_dirs,2):
 
             subdirs_1 = getSubdirs(dirname1, withpath=False)
             subdirs_2 = getSubdirs(dirname2, withpath=False)
             common_subdirs = set(subdirs_1).intersection(set(subdirs_2))
-            
+
             label = '%s\t%s' % (getShortDir(dirname1), getShortDir(dirname2))
             extra_args = '%s %s ' % (dirname1, dirname2)
             idx = runSubdir(idx, common_subdirs, label, 'compare_pairwise.py', 'out_compare_pairwise', __file__, extra_args=extra_args)
-            
+
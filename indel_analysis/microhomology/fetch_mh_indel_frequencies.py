@@ -1,8 +1,8 @@
 import io, os, sys, csv
 
 from selftarget.data import isOldLib, createResultDirectory, getDirNameFromSubdir, getIndelSummaryFiles
-from selftarget.oligo import getFileForOligoIdx, getOligoIdsFromFile, getShortOligoId
-from selftarget.profile import readSummaryToProfile
+from selftarget.oligo import getFileForOligoIdx, getShortOligoId
+from selftarget.profile import readSummaryToProfiles
 
 def loadMhExpIndels(filename, oligo_ids):
     
@@ -38,15 +38,12 @@ if __name__ == '__main__':
         indel_files = getIndelSummaryFiles(subdir, withpath=False)
         for indel_file in indel_files:
     
-            oligo_ids = getOligoIdsFromFile(subdir + '/' + indel_file)
+            profiles = [x for x in readSummaryToProfiles(subdir + '/' + indel_file)]
             mh_loc = '.' if highdir == '.' else highdir + '/ST_June_2017/data'
-            mh_indels = loadMhExpIndels(mh_loc + '/' + mh_exp_indels_file, set(oligo_ids))
+            mh_indels = loadMhExpIndels(mh_loc + '/' + mh_exp_indels_file, set([x[0] for x in profiles]))
     
             fout = io.open(outdir + '/' + indel_file[:-23] + '_mhindels.txt','w')
-            for oligo_id in oligo_ids:
-            
-                profile = {}
-                acc, pacc, nullr = readSummaryToProfile(subdir + '/' + indel_file, profile, oligoid=oligo_id)
+            for oligo_id, profile, acc, pacc, nullr in profiles:
             
                 fout.write(u'@@@%s:%d:%d\n' % (oligo_id,acc,acc-nullr))
                 mhs,indels = mh_indels[oligo_id]
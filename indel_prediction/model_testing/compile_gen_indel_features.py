@@ -1,12 +1,12 @@
 import io, sys, os, csv
 import Bio.Seq
 
-from predictor.features import calculateFeaturesForGenIndelFile
+from predictor.features import calculateFeaturesForGenIndelFile, convertFeaturesFileToSparse, SPARSE_FEATURES_EXT
 
 from selftarget.oligo import loadAllOligoDetails, getShortOligoId, loadPamLookup, getOligoIdxFromId, getFileForOligoIdx
-from selftarget.data import getHighDataDir
+from selftarget.data import getHighDataDir, setHighDataDir
 
-def computeFeaturesForGenIndels(gen_indel_dir = 'generated_indels', out_dir='features_for_gen_indels'):
+def computeFeaturesForGenIndels(gen_indel_dir = 'generated_indels', out_dir='features_for_gen_indels', sparse=False):
 
     if not os.path.isdir(out_dir): os.mkdir(out_dir)
 
@@ -29,11 +29,26 @@ def computeFeaturesForGenIndels(gen_indel_dir = 'generated_indels', out_dir='fea
         uncut_seq = row['Target'] if row['PAM Direction'] != 'REVERSE' else Bio.Seq.reverse_complement(row['Target'])
         cut_site = eval(row['PAM Location'])-3 if row['PAM Direction'] != 'REVERSE' else (79 - eval(row['PAM Location']) - 3)
         generated_indel_file = gen_indel_dir + '/' + gen_file    
-        out_file = out_subdir + '/%s_gen_indel_features.txt' % oligo_id
+        out_file = out_subdir + '/%s_gen_indel_features%s' % (oligo_id, SPARSE_FEATURES_EXT if sparse else '.txt')
         is_reverse = (row['PAM Direction'] == 'REVERSE')
         calculateFeaturesForGenIndelFile( generated_indel_file, uncut_seq, cut_site, out_file, is_reverse=is_reverse)
 
+def convertFeaturesDirToSparse(features_dir='features_for_gen_indels'):
+    #Converts the existing text features files in features_dir to sparse feature stores (written alongside them)
+    for oligo_subdir in os.listdir(features_dir):
+        if not os.path.isdir(features_dir + '/' + oligo_subdir): continue
+        for features_file in os.listdir(features_dir + '/' + oligo_subdir):
+            if not features_file.endswith('_gen_indel_features.txt'): continue
+            print(features_file)
+            features_file = features_dir + '/' + oligo_subdir + '/' + features_file
+            convertFeaturesFileToSparse(features_file, features_file[:-4] + SPARSE_FEATURES_EXT)
+
 if __name__ == '__main__':
 
-    setHighDataDir('predicted_vs_measured_example')
-    computeFeaturesForGenIndels()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == '--convert':
+        convertFeaturesDirToSparse(*sys.argv[2:3])
+    elif len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] == '--sparse'):
+        setHighDataDir('predicted_vs_measured_example')
+        computeFeaturesForGenIndels(sparse=(len(sys.argv) == 2))
+    else:
+        print('Usage: compile_gen_indel_features.py [--sparse]\n       compile_gen_indel_features.py --convert [<features_dir>]')
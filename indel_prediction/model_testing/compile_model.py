@@ -0,0 +1,16 @@
+import sys
+
+from predictor.model import compileModel, exportModel, COMPILED_MODEL_EXT
+
+#Converts a model (theta) text file to the compiled model format read by predictor.model.loadModel, or
+#with --export, a compiled model back to the text format
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--export':
+        exportModel(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) in [2,3]:
+        out_file = compileModel(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+        print('Wrote %s' % out_file)
+    else:
+        print('Usage: compile_model.py <theta_file> [<out_file%s>]\n       compile_model.py --export <model_file%s> <theta_file>' % (COMPILED_MODEL_EXT, COMPILED_MODEL_EXT))
@@ -0,0 +1,197 @@
+import io, os, sys, time, argparse
+import numpy as np
+from multiprocessing import Pool
+
+import predictor.model
+from predictor.features import readFeaturesData, readSparseFeaturesData, SPARSE_FEATURES_EXT
+from predictor.model import writeTheta, printAndFlush, trainModelParallel, computeObjective, loadTrainingData, getOligoDataFiles, \
+    hasSparseFeatures, setFeaturesDir, setReadsDir, setTrainingCacheFile, setRegConst, setI1RegConst, setL1RegConst, setOutputThetaFile, \
+    setParallelBackend, setTrainingMode, setCheckpointPrefix, trainRegularisationPath, getNumEvaluations, countNonZero
+from predictor.optimize import l1Penalty
+
+#Runs the K-fold cross validation of test_model.py for a grid of (REG_CONST, I1_REG_CONST) values, with the
+#(fold, regularisation) tasks run concurrently on a local process pool (or one task per job of a cluster array,
+#using --task), and collects the per-fold objective and KL divergences into one summary table.
+#With --path, each fold instead trains the whole grid as a regularisation path (largest lambdas first, each
+#warm-started from the previous solution). With --l1_reg_consts, the grid is repeated for each L1 penalty
+#(elastic net), and the number of non-zero weights of each model is reported alongside its KL.
+
+SUMMARY_HEADER = u'Reg Const\tI1 Reg Const\tL1 Reg Const\tFold\tNum Train\tNum Test\tTrain Objective\tTrain KL\tTest KL\tTest KL Median\tNon-Zero Weights\tEvaluations\tTheta File\tSeconds\n'
+
+def loadGuideset(guideset_file, num_oligo=-1, seed=0):
+    f = io.open(guideset_file)
+    guideset = [line.strip() for line in f if line.strip() != '']
+    f.close()
+    if num_oligo != -1:
+        guideset = [guideset[i] for i in sorted(np.random.RandomState(seed).choice(len(guideset), num_oligo, replace=False))]
+    return guideset
+
+def loadFeatureColumns(oligo_id):
+    if hasSparseFeatures(oligo_id):
+        return readSparseFeaturesData(getOligoDataFiles(oligo_id, SPARSE_FEATURES_EXT)[0])[2]
+    return readFeaturesData(getOligoDataFiles(oligo_id)[0])[1]
+
+def getKFoldSplits(num_items, num_folds):
+    #Same (unshuffled) splits as sklearn.model_selection.KFold(n_splits=num_folds), as (train_idxs, test_idxs)
+    fold_sizes = [num_items//num_folds + (1 if i < num_items % num_folds else 0) for i in range(num_folds)]
+    splits, start = [], 0
+    for size in fold_sizes:
+        test_idxs = list(range(start, start + size))
+        splits.append(([i for i in range(num_items) if i < start or i >= start + size], test_idxs))
+        start += size
+    return splits
+
+def getL1Suffix(l1_reg_const):
+    #(Empty without an L1 penalty, so the file names of L2 only runs are unchanged)
+    return '_l1_%.8f' % l1_reg_const if l1_reg_const > 0 else ''
+
+def getRunPrefix(out_prefix, num_oligo, reg_const, i1_reg_const, l1_reg_const=0.0):
+    return '%s_%d_%.8f_%.8f%s' % (out_prefix, num_oligo, reg_const, i1_reg_const, getL1Suffix(l1_reg_const))
+
+def getThetaFile(out_prefix, num_oligo, reg_const, i1_reg_const, fold, l1_reg_const=0.0):
+    return getRunPrefix(out_prefix, num_oligo, reg_const, i1_reg_const, l1_reg_const) + '_theta.txt_cf%d.txt' % fold
+
+def setupTask(settings):
+    setFeaturesDir(settings['features_dir']); setReadsDir(settings['reads_dir']); setTrainingCacheFile(settings['cache_file'])
+    setParallelBackend('serial'); setTrainingMode(settings['training_mode']); setL1RegConst(settings['l1_reg_const'])
+
+def evaluateTheta(theta, reg_const, i1_reg_const, fold, train_set, test_set, sample_names, feature_columns, num_evals, theta_file, start_time, l1_reg_const=0.0):
+    writeTheta(theta_file, feature_columns, theta, train_set)
+    train_Q = computeObjective(theta, train_set, sample_names, feature_columns, reg_const, i1_reg_const)[0]/len(train_set) + l1Penalty(theta, l1_reg_const)
+    train_kls = computeObjective(theta, train_set, sample_names, feature_columns, 0.0, 0.0)[2]
+    test_kls = computeObjective(theta, test_set, sample_names, feature_columns, 0.0, 0.0)[2] if len(test_set) > 0 else [np.nan]
+    return (reg_const, i1_reg_const, l1_reg_const, fold, len(train_set), len(test_set), train_Q, np.mean(train_kls), np.mean(test_kls), np.median(test_kls),
+            countNonZero(theta), num_evals, theta_file, time.time() - start_time)
+
+def runTask(task):
+    (reg_pairs, fold, train_set, test_set, sample_names, feature_columns, settings) = task
+    setupTask(settings)
+    if len(reg_pairs) > 1:
+        return runPathTask(task)
+    reg_const, i1_reg_const = reg_pairs[0]
+    l1_reg_const = settings['l1_reg_const']
+    setRegConst(reg_const); setI1RegConst(i1_reg_const)
+    theta_file = getThetaFile(settings['out_prefix'], settings['num_oligo'], reg_const, i1_reg_const, fold, l1_reg_const)
+    setOutputThetaFile(os.path.basename(theta_file))    #(tmp theta files are written to the working dir)
+    if settings['checkpoint']: setCheckpointPrefix(getRunPrefix(settings['out_prefix'], settings['num_oligo'], reg_const, i1_reg_const, l1_reg_const) + '_checkpoint')
+
+    start_time, num_evals = time.time(), getNumEvaluations()
+    theta = trainModelParallel(train_set, sample_names, feature_columns, None, cv_idx=fold)
+    return [evaluateTheta(theta, reg_const, i1_reg_const, fold, train_set, test_set, sample_names, feature_columns, getNumEvaluations() - num_evals, theta_file, start_time, l1_reg_const)]
+
+def runPathTask(task):
+    (reg_pairs, fold, train_set, test_set, sample_names, feature_columns, settings) = task
+    l1_reg_const = settings['l1_reg_const']
+    setOutputThetaFile(os.path.basename(settings['out_prefix']) + getL1Suffix(l1_reg_const) + '_path_theta.txt')
+    if settings['checkpoint']: setCheckpointPrefix(settings['out_prefix'] + getL1Suffix(l1_reg_const) + '_path_checkpoint')
+    results, start_time = [], [time.time()]
+    def onTrained(reg_const, i1_reg_const, theta, num_evals):
+        theta_file = getThetaFile(settings['out_prefix'], settings['num_oligo'], reg_const, i1_reg_const, fold, l1_reg_const)
+        results.append(evaluateTheta(theta, reg_const, i1_reg_const, fold, train_set, test_set, sample_names, feature_columns, num_evals, theta_file, start_time[0], l1_reg_const))
+        start_time[0] = time.time()
+    trainRegularisationPath(train_set, sample_names, feature_columns, reg_pairs, cv_idx=fold, on_trained=onTrained)
+    return results
+
+def formatResult(result):
+    return u'%e\t%e\t%e\t%d\t%d\t%d\t%.6f\t%.6f\t%.6f\t%.6f\t%d\t%d\t%s\t%.1f\n' % result
+
+def getRegPairs(reg_consts, i1_reg_consts):
+    #i1_reg_consts=None ties I1_REG_CONST to REG_CONST, otherwise all combinations are used
+    return [(x, y) for x in reg_consts for y in (i1_reg_consts if i1_reg_consts is not None else [x])]
+
+def getTasks(guideset, sample_names, feature_columns, reg_pairs, num_folds, settings, path=False, l1_reg_consts=[0.0]):
+    tasks = []
+    for l1_reg_const in l1_reg_consts:
+        l1_settings = dict(settings, l1_reg_const=l1_reg_const)
+        for reg_pair_set in ([reg_pairs] if path else [[x] for x in reg_pairs]):
+            for fold, (train_idxs, test_idxs) in enumerate(getKFoldSplits(len(guideset), num_folds)):
+                tasks.append((reg_pair_set, fold, [guideset[i] for i in train_idxs], [guideset[i] for i in test_idxs], sample_names, feature_columns, l1_settings))
+    return tasks
+
+def runCrossValidation(guideset, sample_names, reg_consts, i1_reg_consts=None, num_folds=2, jobs=1, out_prefix='model_output', training_mode='lbfgs',
+                       cache_file=None, checkpoint=False, num_oligo=-1, task_idx=None, path=False, l1_reg_consts=[0.0]):
+    os.makedirs(os.path.dirname(out_prefix) or '.', exist_ok=True)    #(Before training, since the outputs are written after it)
+    feature_columns = loadFeatureColumns(guideset[0])
+    settings = {'features_dir': predictor.model.FEATURES_DIR, 'reads_dir': predictor.model.READS_DIR, 'cache_file': cache_file, 'out_prefix': out_prefix,
+                'training_mode': training_mode, 'checkpoint': checkpoint, 'num_oligo': num_oligo}
+    tasks = getTasks(guideset, sample_names, feature_columns, getRegPairs(reg_consts, i1_reg_consts), num_folds, settings, path=path, l1_reg_consts=l1_reg_consts)
+
+    if task_idx is not None:    #(One task of a cluster array job, see collectResults)
+        results = runTask(tasks[task_idx])
+        fout = io.open('%s_cv_task%d.txt' % (out_prefix, task_idx), 'w')
+        fout.write(SUMMARY_HEADER + u''.join([formatResult(x) for x in results]))
+        fout.close()
+        return results
+
+    #Load the data for all oligos once, shared by the fold workers (inherited on fork, else via the cache file)
+    printAndFlush('Loading training data for %d oligos' % len(guideset))
+    setTrainingCacheFile(cache_file)
+    loadTrainingData(guideset, sample_names, feature_columns)
+
+    printAndFlush('Running %d tasks on %d processes' % (len(tasks), jobs))
+    if jobs > 1:
+        pool = Pool(processes=jobs)
+        task_results = pool.map(runTask, tasks, chunksize=1)
+        pool.close(); pool.join()
+    else:
+        task_results = [runTask(task) for task in tasks]
+    results = [x for task_result in task_results for x in task_result]
+    writeSummary(out_prefix + '_cv_summary.txt', results)
+    return results
+
+def collectResults(out_prefix):
+    #Combines the outputs of --task runs into the summary table
+    dirname, prefix = os.path.dirname(out_prefix) or '.', os.path.basename(out_prefix) + '_cv_task'
+    task_files = [x for x in os.listdir(dirname) if x.startswith(prefix) and x[len(prefix):-4].isdigit() and x.endswith('.txt')]
+    lines = []
+    for filename in sorted(task_files, key=lambda x: int(x[len(prefix):-4])):
+        f = io.open(dirname + '/' + filename)
+        lines.extend(f.readlines()[1:])
+        f.close()
+    fout = io.open(out_prefix + '_cv_summary.txt', 'w')
+    fout.write(SUMMARY_HEADER + u''.join(lines))
+    fout.close()
+
+def writeSummary(summary_file, results):
+    fout = io.open(summary_file, 'w')
+    fout.write(SUMMARY_HEADER)
+    for result in results:
+        fout.write(formatResult(result))
+    fout.close()
+    settings = sorted(set([(x[0], x[1], x[2]) for x in results]))
+    for (reg_const, i1_reg_const, l1_reg_const) in settings:
+        setting_results = [x for x in results if (x[0], x[1], x[2]) == (reg_const, i1_reg_const, l1_reg_const)]
+        printAndFlush('Lambda=%e I1_Lambda=%e L1_Lambda=%e Mean Test KL=%.5f Mean Non-Zero Weights=%.1f' % (reg_const, i1_reg_const, l1_reg_const,
+                      np.mean([x[8] for x in setting_results]), np.mean([x[10] for x in setting_results])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='K-fold cross validation of the indel prediction model over a grid of regularisation constants')
+    parser.add_argument('guideset_file')
+    parser.add_argument('--samples', nargs='+', default=['ST_Feb_2018_CAS9_12NA_1600X_DPI7', 'ST_June_2017_K562_800x_LV7A_DPI7', 'ST_June_2017_K562_800x_LV7B_DPI7'])
+    parser.add_argument('--reg_consts', nargs='+', type=float, default=[0.01])
+    parser.add_argument('--i1_reg_consts', nargs='+', type=float, default=None, help='(default: same as reg_consts)')
+    parser.add_argument('--l1_reg_consts', nargs='+', type=float, default=[0.0], help='L1 penalties (elastic net with the above), each run with every reg_consts setting')
+    parser.add_argument('--folds', type=int, default=2)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--num_oligo', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random selection of num_oligo oligos')
+    parser.add_argument('--out_prefix', default='model_output')
+    parser.add_argument('--training_mode', default='lbfgs')
+    parser.add_argument('--cache_file', default=None, help='Binary training data cache shared by all tasks')
+    parser.add_argument('--checkpoint', action='store_true')
+    parser.add_argument('--path', action='store_true', help='Train the regularisation grid as a warm-started path within each fold')
+    parser.add_argument('--features_dir', default=None)
+    parser.add_argument('--reads_dir', default=None)
+    parser.add_argument('--task', type=int, default=None, help='Run only this task (e.g. a cluster array index)')
+    parser.add_argument('--collect', action='store_true', help='Collect the outputs of --task runs into the summary table')
+    args = parser.parse_args()
+
+    if args.collect:
+        collectResults(args.out_prefix)
+        sys.exit()
+    if args.features_dir is not None: setFeaturesDir(args.features_dir)
+    if args.reads_dir is not None: setReadsDir(args.reads_dir)
+    guideset = loadGuideset(args.guideset_file, args.num_oligo, args.seed)
+    runCrossValidation(guideset, args.samples, args.reg_consts, args.i1_reg_consts, num_folds=args.folds, jobs=args.jobs, out_prefix=args.out_prefix,
+                       training_mode=args.training_mode, cache_file=args.cache_file, checkpoint=args.checkpoint, num_oligo=args.num_oligo, task_idx=args.task, path=args.path,
+                       l1_reg_consts=args.l1_reg_consts)
@@ -2,8 +2,6 @@ import pandas as pd
 import numpy as np
 import random
 
-from mpi4py import MPI
-
 import io, os, sys, csv, time
 from multiprocessing import Process, Pipe
 
@@ -16,11 +14,18 @@ from selftarget.data import getSampleSelectors, getAllDataDirs
 from selftarget.oligo import loadOldNewMapping, partitionGuides, getFileForOligoIdx, getOligoIdxFromId
 from selftarget.profile import getProfileCounts
 
-from predictor.model import writeTheta, readTheta, printAndFlush, trainModelParallel, testModelParallel, recordPredictions
+from predictor.model import writeTheta, readTheta, printAndFlush, trainModelParallel, testModelParallel, recordPredictions, \
+    setParallelBackend, broadcastFromMaster, setTrainingMode, setCheckpointPrefix, getCheckpointFile, setL1RegConst
+from predictor.checkpoint import readCheckpoint
 
-comm = MPI.COMM_WORLD
-mpi_rank = comm.Get_rank()
-mpi_size = comm.Get_size()
+#PARALLEL_BACKEND=mpi (run under mpirun), process (opt-in: NUM_WORKERS local processes) or serial. Defaults to mpi when
+#launched by an MPI launcher, and otherwise to serial (as the previous MPI-only script run as a single rank)
+MPI_LAUNCHER_VARS = ['OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK', 'MPI_LOCALNRANKS']
+PARALLEL_BACKEND = os.getenv('PARALLEL_BACKEND') or ('mpi' if any([os.getenv(x) for x in MPI_LAUNCHER_VARS]) else 'serial')
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', '0')) or None
+TRAINING_MODE = os.getenv('TRAINING_MODE', 'lbfgs')    #or stochastic (mini-batch Adam/SGD)
+CHECKPOINT_EVERY = int(os.getenv('CHECKPOINT_EVERY', '0'))    #>0 to checkpoint (and resume) every CHECKPOINT_EVERY iterations
+L1_REG_CONST = float(os.getenv('L1_REG_CONST', '0'))    #>0 for a sparse (elastic net) model
 
 NUM_OLIGO = -1
 FOLD = 2
@@ -54,7 +59,12 @@ def runAnalysis(guideset_file = 'model_development_guideset.txt'):
 
         theta0 = None
         tmp_file = 'tmp_%s_%d.txt' % (OUT_THETA_FILE, i)
-        if os.path.isfile(tmp_file):
+        if CHECKPOINT_EVERY > 0 and os.path.isfile(getCheckpointFile(i)):
+            printAndFlush('Resuming from checkpoint')
+            rec_train_set = readCheckpoint(getCheckpointFile(i))['guideset']
+            test_set = [x for x in ([y for y in train_set] + [y for y in test_set]) if x not in rec_train_set][:int(NUM_OLIGO/2)]
+            train_set = rec_train_set
+        elif os.path.isfile(tmp_file):
             printAndFlush('Loading from previous tmp file')
             theta0, rec_train_set, feature_columns = readTheta(tmp_file)
             test_set = [x for x in ([y for y in train_set] + [y for y in test_set]) if x not in rec_train_set][:int(NUM_OLIGO/2)]
@@ -71,15 +81,19 @@ def runAnalysis(guideset_file = 'model_development_guideset.txt'):
         recordPredictions(OUT_PROFILE_DIR + '_test_%d' % i, theta, test_set, feature_columns )
 
 if __name__ == '__main__':
+    setParallelBackend(PARALLEL_BACKEND, num_workers=NUM_WORKERS)
+    setTrainingMode(TRAINING_MODE)
+    setL1RegConst(L1_REG_CONST)
     if len(sys.argv) > 1: NUM_OLIGO = eval(sys.argv[1])
     if len(sys.argv) > 3: REG_CONST = eval(sys.argv[3])
     if len(sys.argv) > 4: OUT_PREFIX = sys.argv[4]
     else:
         rand_val = np.random.normal(loc=0.0, scale=1.0)
-        rand_val = comm.bcast(rand_val, root=0)
+        rand_val = broadcastFromMaster(rand_val)
         OUT_PREFIX = 'model_output_%d_%.8f_%.3f' % (NUM_OLIGO, REG_CONST, rand_val )
     OUT_PROFILE_DIR = OUT_PREFIX + '_predictions'
     OUT_THETA_FILE = OUT_PREFIX + '_theta.txt'
+    if CHECKPOINT_EVERY > 0: setCheckpointPrefix(OUT_PREFIX + '_checkpoint', every=CHECKPOINT_EVERY)
     runAnalysis()
    
 
@@ -0,0 +1,53 @@
+import io, os, time
+import numpy as np
+
+#Training checkpoints: all state needed to resume a training run exactly (theta, optimizer state,
+#iteration count, objective trace, random seed and the data it was trained on) in one .npz file,
+#written atomically so that a run killed mid-write leaves the previous checkpoint intact.
+
+CHECKPOINT_EXT = '.npz'
+PROGRESS_LOG_HEADER = u'Iteration\tObjective\tMax Abs Gradient\tElapsed Seconds\n'
+
+_STR_LIST_KEYS = ['guideset', 'sample_names', 'feature_columns']
+
+def writeCheckpoint(filename, state):
+    #state: dict of numpy-storable values (lists of arrays, e.g. the L-BFGS history, are stored as 2D arrays)
+    tmp_filename = filename + '.tmp%d' % os.getpid()
+    fout = io.open(tmp_filename, 'wb')
+    np.savez(fout, **{x: (np.array(state[x], dtype=str) if x in _STR_LIST_KEYS else np.array(state[x])) for x in state})
+    fout.close()
+    os.replace(tmp_filename, filename)
+
+def readCheckpoint(filename):
+    f = np.load(filename)
+    state = {}
+    for x in f.files:
+        val = f[x]
+        if x in _STR_LIST_KEYS: val = [y for y in val]
+        elif val.ndim == 0: val = val.item()
+        state[x] = val
+    f.close()
+    return state
+
+def checkCheckpointMatches(filename, state, guideset, sample_names, feature_columns, reg_const, i1_reg_const, l1_reg_const=0.0):
+    #Raises an exception if the checkpoint was written for a different training run
+    if list(state['guideset']) != [x for x in guideset]:
+        raise Exception('Checkpoint %s was written for a different training set' % filename)
+    if list(state['sample_names']) != list(sample_names) or list(state['feature_columns']) != list(feature_columns):
+        raise Exception('Checkpoint %s was written for different samples or features' % filename)
+    if state['reg_const'] != reg_const or state['i1_reg_const'] != i1_reg_const or state.get('l1_reg_const', 0.0) != l1_reg_const:
+        raise Exception('Checkpoint %s was written for different regularisation constants' % filename)
+
+def getRNGState(rng):
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return {'rng_keys': keys, 'rng_pos': pos, 'rng_has_gauss': has_gauss, 'rng_cached_gaussian': cached_gaussian}
+
+def setRNGState(rng, state):
+    rng.set_state(('MT19937', state['rng_keys'], state['rng_pos'], state['rng_has_gauss'], state['rng_cached_gaussian']))
+
+def logProgress(log_file, iteration, Q, jac, start_time):
+    new_file = not os.path.isfile(log_file)
+    fout = io.open(log_file, 'a')
+    if new_file: fout.write(PROGRESS_LOG_HEADER)
+    fout.write(u'%d\t%.8f\t%e\t%.1f\n' % (iteration, Q, np.max(np.abs(jac)), time.time() - start_time))
+    fout.close()
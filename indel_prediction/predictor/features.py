@@ -1,7 +1,13 @@
 import io, csv
+from functools import lru_cache
+import Bio.Seq
+import numpy as np
 import pandas as pd
+import scipy.sparse
+from selftarget.parse import parseIndelLocs
 
 NTS = ['A','T','G','C']
+SPARSE_FEATURES_EXT = '.npz'
 
 def feature_DelSize(indel_details ):
     features, feature_labels = [],[]
@@ -171,16 +177,17 @@ def features_pairwise(features1, feature_labels1, features2, feature_labels2 ):
             pairwise_features.append(val1*val2)
     return pairwise_features, pairwise_labels
 
+FEATURE_LIST = [feature_InsSize, feature_DelSize, feature_DelLoc, feature_InsLoc, feature_I1or2Rpt,feature_InsSeq, feature_LocalCutSiteSequence, feature_LocalCutSiteSeqMatches, feature_LocalRelativeSequence, features_SeqMatches, feature_microhomology]
+PAIRWISE_LIST = [('feature_DelSize','feature_DelLoc'),('feature_InsSeq','feature_I1or2Rpt'), ('feature_microhomology','feature_DelSize')]
+PAIRWISE_LIST += [('feature_microhomology','feature_DelLoc'), ('feature_LocalRelativeSequence','feature_DelSize'), ('feature_LocalCutSiteSequence','feature_InsSize')]
+PAIRWISE_LIST += [('features_SeqMatches','feature_DelSize'),('feature_LocalRelativeSequence','feature_DelLoc'), ('feature_LocalCutSiteSequence','feature_DelSize')]
+PAIRWISE_LIST += [('feature_LocalCutSiteSeqMatches','feature_DelSize'),('feature_LocalCutSiteSequence','feature_DelSize'), ('feature_LocalCutSiteSequence','feature_I1or2Rpt')]
+PAIRWISE_LIST += [('feature_LocalCutSiteSeqMatches','feature_I1or2Rpt')]
+
 def calculateFeatures(indel_details):
     all_features, all_feature_labels = [], []
-    feature_list = [feature_InsSize, feature_DelSize, feature_DelLoc, feature_InsLoc, feature_I1or2Rpt,feature_InsSeq, feature_LocalCutSiteSequence, feature_LocalCutSiteSeqMatches, feature_LocalRelativeSequence, features_SeqMatches, feature_microhomology]
-    lin_fts = {x.__name__: x(indel_details) for x in feature_list }
-    pairwise_list = [('feature_DelSize','feature_DelLoc'),('feature_InsSeq','feature_I1or2Rpt'), ('feature_microhomology','feature_DelSize')]
-    pairwise_list += [('feature_microhomology','feature_DelLoc'), ('feature_LocalRelativeSequence','feature_DelSize'), ('feature_LocalCutSiteSequence','feature_InsSize')]
-    pairwise_list += [('features_SeqMatches','feature_DelSize'),('feature_LocalRelativeSequence','feature_DelLoc'), ('feature_LocalCutSiteSequence','feature_DelSize')]
-    pairwise_list += [('feature_LocalCutSiteSeqMatches','feature_DelSize'),('feature_LocalCutSiteSequence','feature_DelSize'), ('feature_LocalCutSiteSequence','feature_I1or2Rpt')]
-    pairwise_list += [('feature_LocalCutSiteSeqMatches','feature_I1or2Rpt')]
-    for(fname1, fname2) in pairwise_list:
+    lin_fts = {x.__name__: x(indel_details) for x in FEATURE_LIST }
+    for(fname1, fname2) in PAIRWISE_LIST:
         features, feature_labels = features_pairwise(lin_fts[fname1][0],lin_fts[fname1][1],lin_fts[fname2][0],lin_fts[fname2][1])
         all_features.extend(features); all_feature_labels.extend(feature_labels)
     for fname in lin_fts:
@@ -188,39 +195,323 @@ def calculateFeatures(indel_details):
     assert(len(all_features)==len(all_feature_labels))
     return all_features, all_feature_labels
 
+@lru_cache(maxsize=1)
+def _getFeatureGroupLabels():
+    #Feature labels don't depend on the indel, so compute them once from a placeholder deletion
+    indel_details = ('A'*79, 40, 35, 40, '')
+    return {x.__name__: x(indel_details)[1] for x in FEATURE_LIST}
+
+@lru_cache(maxsize=1)
+def _getFeatureLabels():
+    group_labels = _getFeatureGroupLabels()
+    labels = []
+    for (fname1, fname2) in PAIRWISE_LIST:
+        labels.extend(['PW_%s_vs_%s' % (label1, label2) for label1 in group_labels[fname1] for label2 in group_labels[fname2]])
+    for x in FEATURE_LIST:
+        labels.extend(group_labels[x.__name__])
+    return tuple(labels)
+
+def getFeatureLabels():
+    #Column labels of calculateFeatures/calculateFeaturesBatch, in order
+    return list(_getFeatureLabels())
+
+@lru_cache(maxsize=1)
+def _getDedupedFeatureLabels():
+    return tuple(dedupeFeatureLabels(getFeatureLabels()))
+
+def getDedupedFeatureLabels():
+    #As getFeatureLabels, with repeated labels renamed as when read from a features file (see dedupeFeatureLabels)
+    return list(_getDedupedFeatureLabels())
+
+def _inRange(vals, vmin, vmax):
+    #Equivalent of (vals in range(vmin, vmax+1)), which is empty for vmin > vmax
+    return (vals >= vmin) & (vals <= vmax)
+
+def _batchFeatureGroups(uncut_seq, cut_site, left, right, ins_seq, group_names=None):
+    #Vectorised equivalents of the feature_* functions for arrays of indels (one row each), for the groups in
+    #group_names (default all)
+    n, L = len(left), len(uncut_seq)
+    seq = np.array([x for x in uncut_seq])
+    at = lambda idx: seq[np.clip(np.where(idx < 0, idx + L, idx), 0, L-1)]   #(python style wrapping of negative indices)
+    ins_len = np.array([len(x) for x in ins_seq], dtype=int)
+    ins_seq = np.array(ins_seq, dtype=str) if n > 0 else np.array([], dtype=str)
+    is_ins, is_del = ins_len > 0, ins_len == 0
+    dl, dr, dsize = left - cut_site, right - cut_site, right - left - 1
+    const = lambda vals: np.tile(np.array(vals, dtype=bool), (n,1))
+    stack = lambda cols: np.stack(cols, axis=1) if len(cols) > 0 else np.zeros((n,0), dtype=bool)
+    groups = {}
+    need = lambda x: group_names is None or x in group_names
+
+    groups['feature_InsSize'] = stack([is_ins, ins_len == 1, ins_len == 2])
+    groups['feature_DelSize'] = stack([is_del, dsize == 1, _inRange(dsize,2,3), _inRange(dsize,4,7), _inRange(dsize,7,12), dsize > 12]) & is_del[:,None]
+
+    if need('feature_DelLoc'):
+        cols = [_inRange(dl,lmin,lmax) for lmin, lmax in [(-1,-1),(-2,-2),(-3,-3),(-4,-6),(-7,-10),(-11,-15),(-16,-30)]] + [dl < -30, dl >= 0]
+        cols += [_inRange(dr,rmin,rmax) for rmin, rmax in [(0,0),(1,1),(2,2),(3,5),(6,9),(10,14),(15,29)]] + [dr < 0, dr > 30]
+        groups['feature_DelLoc'] = stack(cols) & is_del[:,None]
+
+    if need('feature_InsLoc'):
+        cols = [_inRange(dl,lmin,lmax) for lmin, lmax in [(-1,-1),(-2,-2),(-3,-3)]] + [dl < -3, dl >= 0]
+        groups['feature_InsLoc'] = stack(cols) & is_ins[:,None]
+
+    if need('feature_I1or2Rpt'):
+        rpt_nt = uncut_seq[cut_site-1]
+        cols = [(ins_seq == rpt_nt), (ins_len == 1) & (ins_seq != rpt_nt), (ins_seq == rpt_nt*2), (ins_len == 2) & (ins_seq != rpt_nt*2)]
+        groups['feature_I1or2Rpt'] = stack(cols) & (dl == -1)[:,None] & is_ins[:,None]
+
+    if need('feature_InsSeq'):
+        cols = []
+        for nt in NTS:
+            cols.append(ins_seq == nt)
+            cols.extend([ins_seq == (nt+nt2) for nt2 in NTS])
+        groups['feature_InsSeq'] = stack(cols)
+
+    groups['feature_LocalCutSiteSequence'] = const([uncut_seq[cut_site+offset] == nt for offset in range(-5,4) for nt in NTS])
+    groups['feature_LocalCutSiteSeqMatches'] = const([(uncut_seq[cut_site+offset1] == uncut_seq[cut_site+offset2]) and (uncut_seq[cut_site+offset1] == nt) for offset1 in range(-3,2) for offset2 in range(-3,offset1) for nt in NTS])
+
+    if need('feature_LocalRelativeSequence'):
+        cols = []
+        for offset in range(-3,3):
+            left_nt, left_ok = at(left+1+offset), (left+offset+1 >= 0)
+            right_nt, right_ok = at(right+offset), (right+offset < L)
+            for nt in NTS:
+                cols.append(left_ok & (left_nt == nt))
+                cols.append(right_ok & (right_nt == nt))
+        groups['feature_LocalRelativeSequence'] = stack(cols) & is_del[:,None]
+
+    if need('features_SeqMatches'):
+        cols = []
+        for loffset in range(-3,3):
+            for roffset in range(-3,3):
+                ok = (left+loffset > 0) & (right+roffset < L)
+                match = at(left+loffset+1) == at(right+roffset)
+                cols.append(ok & match); cols.append(ok & ~match)
+        groups['features_SeqMatches'] = stack(cols) & is_del[:,None]
+
+    if need('feature_microhomology'):
+        #Microhomology: left_match[:,j] compares the j'th nucleotides back from the left and right edges of the
+        #deletion, right_match[:,j] the j'th nucleotides forward (see hasLeftMH and hasRightMH)
+        max_mh = 15
+        left_match = stack([at(left-j) == at(right-1-j) for j in range(max_mh+1)])
+        right_match = stack([at(left+1+j) == at(right+j) for j in range(max_mh+1)])
+        left_cnts, right_cnts = np.cumsum(left_match, axis=1), np.cumsum(right_match, axis=1)
+        def hasMH(mh_len, mismatch, is_left):
+            if is_left:
+                valid = (left - mh_len >= 0) & (right - mh_len - 1 >= 0) & (right <= L)
+                matches, cnts = left_match, left_cnts
+            else:
+                valid = (left + mh_len + 2 <= L) & (right + mh_len + 1 <= L)
+                matches, cnts = right_match, right_cnts
+            return valid & ~matches[:,mh_len] & matches[:,0] & matches[:,mh_len-1] & (cnts[:,mh_len-1] == (mh_len - mismatch))
+        anyMH = lambda mh_min, mh_max, mismatch, is_left: np.any(stack([hasMH(x, mismatch, is_left) for x in range(mh_min, mh_max+1)]), axis=1)
+        cols = []
+        for mh_min, mh_max in [(1,1),(2,2),(3,3),(4,6),(7,10),(11,15)]:
+            cols.append(anyMH(mh_min, mh_max, 0, True))
+            cols.append(anyMH(mh_min, mh_max, 0, False))
+            if mh_max > 2:
+                cols.append(anyMH(mh_min, mh_max, 1, True))
+                cols.append(anyMH(mh_min, mh_max, 1, False))
+        cols.append(~np.any(stack(cols), axis=1))
+        groups['feature_microhomology'] = stack(cols) & is_del[:,None]
+
+    return groups
+
+def _inBatchRange(left, right, L):
+    #Rows that _batchFeatureGroups handles
+    return (left >= 0) & (right > left) & (right <= L) & (left + 3 < L) & (L > 16)
+
+class PrunedFeatureEngine:
+    #Computes only the given columns of calculateFeaturesBatch (indices into getFeatureLabels()), evaluating just the
+    #feature groups, and the pairs of entries of pairwise blocks, that those columns need
+
+    def __init__(self, label_idxs):
+        self.label_idxs = np.array(label_idxs, dtype=int)
+        group_labels = _getFeatureGroupLabels()
+        col_sources = []    #(group1, idx1, group2, idx2) for each label (group2 is None for non-pairwise features)
+        for (fname1, fname2) in PAIRWISE_LIST:
+            col_sources.extend([(fname1, i, fname2, j) for i in range(len(group_labels[fname1])) for j in range(len(group_labels[fname2]))])
+        for x in FEATURE_LIST:
+            col_sources.extend([(x.__name__, i, None, None) for i in range(len(group_labels[x.__name__]))])
+
+        #Columns computed together: {(group1, group2): (output columns, group1 idxs, group2 idxs)}
+        self.blocks = {}
+        for col, label_idx in enumerate(self.label_idxs):
+            fname1, i, fname2, j = col_sources[label_idx]
+            cols, idxs1, idxs2 = self.blocks.setdefault((fname1, fname2), ([], [], []))
+            cols.append(col); idxs1.append(i); idxs2.append(j)
+        self.group_names = set([x for (fname1, fname2) in self.blocks for x in [fname1, fname2] if x is not None])
+        for key, (cols, idxs1, idxs2) in self.blocks.items():
+            #(Output columns as a slice where contiguous, and pairwise blocks that are mostly needed as the full
+            #outer product, indexed by idx1*len(group2) + idx2)
+            out_cols = slice(cols[0], cols[-1]+1) if cols == list(range(cols[0], cols[-1]+1)) else cols
+            flat_idxs = None
+            if key[1] is not None and len(cols) > 0.5*len(group_labels[key[0]])*len(group_labels[key[1]]):
+                flat_idxs = np.array(idxs1)*len(group_labels[key[1]]) + np.array(idxs2)
+                if list(flat_idxs) == list(range(len(group_labels[key[0]])*len(group_labels[key[1]]))): flat_idxs = slice(None)
+            self.blocks[key] = (out_cols, idxs1, idxs2, flat_idxs)
+
+    def calculateFeatures(self, uncut_seq, cut_site, lefts, rights, ins_seqs):
+        #As calculateFeaturesBatch(...)[:,label_idxs]
+        left, right = np.array(lefts, dtype=int), np.array(rights, dtype=int)
+        features = np.zeros((len(left), len(self.label_idxs)), dtype=np.uint8)
+        in_range = _inBatchRange(left, right, len(uncut_seq))
+        for i in np.where(~in_range)[0]:
+            features[i,:] = np.array(calculateFeatures((uncut_seq, cut_site, left[i], right[i], ins_seqs[i]))[0], dtype=np.uint8)[self.label_idxs]
+
+        idxs = np.where(in_range)[0]
+        if len(idxs) > 0 and len(self.label_idxs) > 0:
+            groups = _batchFeatureGroups(uncut_seq, cut_site, left[idxs], right[idxs], [ins_seqs[i] for i in idxs], self.group_names)
+            all_rows = len(idxs) == len(left)
+            for (fname1, fname2), (cols, idxs1, idxs2, flat_idxs) in self.blocks.items():
+                if fname2 is None:
+                    vals = groups[fname1][:,idxs1]
+                elif flat_idxs is not None:
+                    vals = (groups[fname1][:,:,None] & groups[fname2][:,None,:]).reshape(len(idxs),-1)[:,flat_idxs]
+                else:
+                    vals = groups[fname1][:,idxs1] & groups[fname2][:,idxs2]
+                if all_rows: features[:,cols] = vals
+                else: features[np.ix_(idxs, np.arange(features.shape[1])[cols])] = vals
+        return features
+
+    def calculateFeaturesForGenIndels(self, gen_indels, uncut_seq, cut_site, is_reverse=False):
+        #As calculateFeaturesForGenIndels, for the engine's columns only: returns (indels, X)
+        indels, lefts, rights, ins_seqs = expandIndelLocs(gen_indels.items(), is_reverse)
+        return aggregateIndelFeatures(indels, self.calculateFeatures(uncut_seq, cut_site, lefts, rights, ins_seqs))
+
+def calculateFeaturesBatch(uncut_seq, cut_site, lefts, rights, ins_seqs, sparse=False):
+    #Features of all (left, right, ins_seq) indels for a target, as a uint8 matrix with one row per indel and
+    #columns as in getFeatureLabels() (identical to stacking calculateFeatures for each indel)
+    left, right = np.array(lefts, dtype=int), np.array(rights, dtype=int)
+    n, L = len(left), len(uncut_seq)
+    features = np.zeros((n, len(_getFeatureLabels())), dtype=np.uint8)
+
+    #Rows outside the usual range (e.g. that index off the end of the sequence) use the per-indel functions
+    in_range = _inBatchRange(left, right, L)
+    for i in np.where(~in_range)[0]:
+        features[i,:] = calculateFeatures((uncut_seq, cut_site, left[i], right[i], ins_seqs[i]))[0]
+
+    idxs = np.where(in_range)[0]
+    if len(idxs) > 0:
+        groups = _batchFeatureGroups(uncut_seq, cut_site, left[idxs], right[idxs], [ins_seqs[i] for i in idxs])
+        blocks = []
+        for (fname1, fname2) in PAIRWISE_LIST:
+            blocks.append((groups[fname1][:,:,None] & groups[fname2][:,None,:]).reshape(len(idxs),-1))
+        blocks.extend([groups[x.__name__] for x in FEATURE_LIST])
+        features[idxs,:] = np.concatenate(blocks, axis=1)
+
+    if sparse:
+        return scipy.sparse.csr_matrix(features)
+    return features
+
+def expandIndelLocs(gen_indels, is_reverse=False):
+    #(indel, [(left, right, ins_seq),...]) pairs -> one (indel, left, right, ins_seq) row per location (in lists)
+    indels, lefts, rights, ins_seqs = [], [], [], []
+    for indel, indel_locs in gen_indels:
+        for indel_loc in indel_locs:
+            ins_seq = indel_loc[2]
+            indels.append(indel)
+            lefts.append(indel_loc[0] if not is_reverse else (78 - indel_loc[1]))
+            rights.append(indel_loc[1] if not is_reverse else (78 - indel_loc[0]))
+            ins_seqs.append(ins_seq if not is_reverse else Bio.Seq.reverse_complement(ins_seq))
+    return indels, lefts, rights, ins_seqs
+
+def calculateFeaturesForGenIndels(gen_indels, uncut_seq, cut_site, is_reverse=False):
+    #In-memory equivalent of calculateFeaturesForGenIndelFile followed by readSparseFeaturesData, for
+    #gen_indels = {indel: [(left, right, ins_seq),...]}: returns (indels, X, feature_cols)
+    indels, lefts, rights, ins_seqs = expandIndelLocs(gen_indels.items(), is_reverse)
+    features = calculateFeaturesBatch(uncut_seq, cut_site, lefts, rights, ins_seqs, sparse=True)
+    indels, X = aggregateIndelFeatures(indels, features)
+    return indels, X, getDedupedFeatureLabels()
+
 def calculateFeaturesForGenIndelFile( generated_indel_file, uncut_seq, cut_site, out_file, is_reverse=False):
+    #Writes a sparse feature store instead of the text table if out_file ends in SPARSE_FEATURES_EXT
 
     f = io.open(generated_indel_file )
-    fout = io.open(out_file, 'w')
-    fout.write(f.readline())    #Git commit line (pass on)
+    git_line = f.readline()    #Git commit line (pass on)
     pam_dir = 'REVERSE' if is_reverse else 'FORWARD'
-    fout.write(u'###%s\t%d\t%s\n' % (uncut_seq, cut_site, pam_dir))
-    first = True
-    A,T,G,C = 'A','T','G','C'
-    AA,AT,AC,AG,CG,CT,CA,CC = 'AA','AT','AC','AG','CG','CT','CA','CC'
-    GT,GA,GG,GC,TA,TG,TC,TT = 'GT','GA','GG','GC','TA','TG','TC','TT'
 
-    for toks in csv.reader(f,delimiter='\t'):
-        indel, indel_locs = toks[0], eval(toks[2])
-        for indel_loc in indel_locs:
-            ins_seq = indel_loc[2] if len(indel_loc) > 2 else ''
-            left = indel_loc[0] if not is_reverse else (78 - indel_loc[1]) 
-            right = indel_loc[1] if not is_reverse else (78 - indel_loc[0]) 
-            ins_seq = ins_seq if not is_reverse else Bio.Seq.reverse_complement(ins_seq)
-            indel_details = (uncut_seq, cut_site, left, right, ins_seq)
-             
-            features, feature_labels = calculateFeatures(indel_details)
-                
-            if first: fout.write(u'Indel\tLeft\tRight\tInserted Seq\t%s\n' % '\t'.join(feature_labels))
-            feature_str = '\t'.join(['%d' % x for x in features])
+    indels, lefts, rights, ins_seqs = expandIndelLocs([(toks[0], parseIndelLocs(toks[2])) for toks in csv.reader(f,delimiter='\t')], is_reverse)
+    f.close()
+
+    if out_file.endswith(SPARSE_FEATURES_EXT):
+        features = calculateFeaturesBatch(uncut_seq, cut_site, lefts, rights, ins_seqs, sparse=True)
+        writeSparseFeatures(out_file, git_line, uncut_seq, cut_site, pam_dir, indels, lefts, rights, ins_seqs, features)
+        return
+
+    fout = io.open(out_file, 'w')
+    fout.write(git_line)
+    fout.write(u'###%s\t%d\t%s\n' % (uncut_seq, cut_site, pam_dir))
+    if len(indels) > 0:
+        features = calculateFeaturesBatch(uncut_seq, cut_site, lefts, rights, ins_seqs)
+        fout.write(u'Indel\tLeft\tRight\tInserted Seq\t%s\n' % '\t'.join(getFeatureLabels()))
+        for indel, left, right, ins_seq, row in zip(indels, lefts, rights, ins_seqs, features):
+            feature_str = '\t'.join(['%d' % x for x in row])
             fout.write(u'%s\t%d\t%d\t%s\t%s\n' % (indel, left, right, ins_seq, feature_str))
-            first = False
     fout.close()
-    f.close()
 
 def readFeaturesData(features_file):
     feature_data = pd.read_csv(features_file, skiprows=2, sep='\t', dtype={'Inserted Seq':str})
     feature_cols = [x for x in feature_data.columns if x not in ['Oligo ID','Indel','Left','Right','Inserted Seq']]
     indel_feature_data = 1*feature_data[['Indel'] + feature_cols].groupby('Indel').any()
     indel_feature_data['Indel'] = indel_feature_data.index
-    return indel_feature_data, feature_cols
\ No newline at end of file
+    return indel_feature_data, feature_cols
+
+def writeSparseFeatures(out_file, git_line, uncut_seq, cut_site, pam_dir, indels, lefts, rights, ins_seqs, features, feature_cols=None):
+    #Same content as the text features file, with the (mostly zero) feature table stored in CSR form
+    if feature_cols is None: feature_cols = getFeatureLabels()
+    X = scipy.sparse.csr_matrix(features, shape=(len(indels), len(feature_cols)), dtype=np.uint8)
+    fout = io.open(out_file, 'wb')
+    np.savez_compressed(fout, git_line=np.array(git_line), uncut_seq=np.array(uncut_seq), cut_site=np.array(cut_site), pam_dir=np.array(pam_dir),
+                        indels=np.array(indels, dtype=str), lefts=np.array(lefts, dtype=int), rights=np.array(rights, dtype=int), ins_seqs=np.array(ins_seqs, dtype=str),
+                        feature_cols=np.array(feature_cols, dtype=str), data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape))
+    fout.close()
+
+def dedupeFeatureLabels(feature_cols):
+    #Repeated labels renamed <label>.1, <label>.2 etc, as pandas does when reading the text features file
+    #(the model files store the renamed labels)
+    seen, labels = {}, []
+    for x in feature_cols:
+        labels.append(x if x not in seen else '%s.%d' % (x, seen[x]))
+        seen[x] = seen.get(x, 0) + 1
+    return labels
+
+def loadSparseFeatures(features_file):
+    #Returns the stored arrays of a sparse feature store, with the feature table as a CSR matrix under 'X'
+    f = np.load(features_file)
+    store = {x: f[x] for x in f.files if x not in ['data','indices','indptr','shape']}
+    store['X'] = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+    f.close()
+    return store
+
+def readSparseFeaturesData(features_file):
+    #Sparse equivalent of readFeaturesData: returns (indels, X, feature_cols), with one row of X per
+    #distinct indel (in the same sorted order), set wherever the feature is set for any of its locations
+    store = loadSparseFeatures(features_file)
+    indels, X = aggregateIndelFeatures(store['indels'], store['X'])
+    return indels, X, dedupeFeatureLabels([x for x in store['feature_cols']])
+
+def aggregateIndelFeatures(indels, X):
+    #Combines the feature rows of each distinct indel (sorted), setting a feature if it is set for any of its locations
+    indels, row_idxs = np.unique(np.array(indels, dtype=str), return_inverse=True)
+    M = scipy.sparse.csr_matrix((np.ones(len(row_idxs), dtype=np.int32), (row_idxs, np.arange(len(row_idxs)))), shape=(len(indels), len(row_idxs)))
+    X = M.dot(scipy.sparse.csr_matrix(X).astype(np.int32)).tocsr()
+    X.data = (X.data > 0).astype(np.uint8)
+    X.eliminate_zeros()
+    return [x for x in indels], X.astype(np.uint8)
+
+def convertFeaturesFileToSparse(features_file, out_file):
+    #Converts an existing text features file (as written by calculateFeaturesForGenIndelFile) to a sparse feature store
+    f = io.open(features_file)
+    git_line = f.readline()
+    uncut_seq, cut_site, pam_dir = f.readline()[3:-1].split('\t')
+    reader = csv.reader(f, delimiter='\t')
+    header = next(reader, None)    #(No header if there were no indels)
+    feature_cols = header[4:] if header is not None else getFeatureLabels()
+    indels, lefts, rights, ins_seqs, rows, cols = [], [], [], [], [], []
+    for toks in reader:
+        nz = [i for i, x in enumerate(toks[4:]) if x != '0']
+        rows.extend([len(indels)]*len(nz)); cols.extend(nz)
+        indels.append(toks[0]); lefts.append(int(toks[1])); rights.append(int(toks[2])); ins_seqs.append(toks[3])
+    f.close()
+    features = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(indels), len(feature_cols)))
+    writeSparseFeatures(out_file, git_line, uncut_seq, int(cut_site), pam_dir, indels, lefts, rights, ins_seqs, features, feature_cols=feature_cols)
\ No newline at end of file
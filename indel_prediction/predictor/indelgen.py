@@ -0,0 +1,118 @@
+import numpy as np
+
+#Enumerates the candidate indels for a target, as indelgentarget (generateAllIndels in indel_analysis/indelmap/gen.cpp)
+#does, without the external binary: all deletions of up to MAX_DEL_SIZE that span the cut site, plus insertions of up
+#to MAX_INS_SIZE at the cut site, each named as the indelmap aligner (IndelXX::computeMatchScore) would name its read.
+#
+#For these reads the aligner's best score is reached only by the exact alignments that differ by where the gap is
+#placed (any mismatch or flank indel scores lower), so the name follows from the range of consistent gap positions,
+#limited to those the aligner considers (left flank ending at most MAX_CUT_DIST after the cut site, and right
+#flank starting at most MAX_CUT_DIST before it). This range is computed for all deletions at once from the common
+#prefix/suffix lengths between all pairs of positions in the target.
+
+MAX_DEL_SIZE = 30
+MAX_INS_SIZE = 2
+MAX_DEL_TO_ALLOW_INS = 0
+MAX_CUT_DIST = 4
+MAX_FLANK = 50
+MIN_FLANK = 10
+NTS = 'ATGC'
+
+class InvalidTargetError(Exception):
+    #A target that indels cannot be generated for (skipped, and reported, in bulk prediction)
+    pass
+
+def trimTarget(target_seq, pam_idx):
+    #As indelgentarget: trim to MAX_FLANK either side of the PAM, returning (seq, pam_idx, left_trim), and check
+    #that more than MIN_FLANK remain either side (asserted, but not checked in release builds, by indelgentarget)
+    orig_len, orig_pam_idx, left_trim = len(target_seq), pam_idx, 0
+    if len(target_seq) - pam_idx > MAX_FLANK:
+        target_seq = target_seq[:pam_idx + MAX_FLANK]
+    if pam_idx > MAX_FLANK:
+        target_seq = target_seq[pam_idx - MAX_FLANK:]
+        left_trim = pam_idx - MAX_FLANK
+        pam_idx = MAX_FLANK
+    if pam_idx <= MIN_FLANK or len(target_seq) - pam_idx <= MIN_FLANK:
+        raise InvalidTargetError('Target must have more than %d nt before the PAM index and from the PAM index to the end (PAM index %d in a target of length %d)' % (MIN_FLANK, orig_pam_idx, orig_len))
+    return target_seq, pam_idx, left_trim
+
+def getAllInsertionsOfSize(isize):
+    #In the order of gen.cpp (base-4 digits, least significant first)
+    return [''.join([NTS[(i // 4**j) % 4] for j in range(isize)]) for i in range(4**isize)]
+
+def commonPrefixLengths(seq):
+    #F[a,b] = length of the common prefix of seq[a:] and seq[b:]
+    s = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+    eq = (s[:,None] == s[None,:])
+    F = np.zeros((len(s)+1, len(s)+1), dtype=int)
+    for a in range(len(s)-1, -1, -1):
+        F[a,:-1] = eq[a]*(F[a+1,1:] + 1)
+    return F[:-1,:-1]
+
+def commonSuffixLengths(seq):
+    #B[a,b] = length of the common suffix of seq[:a+1] and seq[:b+1]
+    return commonPrefixLengths(seq[::-1])[::-1,::-1]
+
+def formatIndel(prefix, size, jmin, jmax, right, cut_idx):
+    indel = '%s%d_L%d' % (prefix, size, jmin - cut_idx - 1)
+    if jmax > jmin: indel += 'C%d' % (jmax - jmin)
+    return indel + 'R%d' % (right - cut_idx - 1)
+
+def generateDeletions(seq, cut_idx):
+    #All deletions seq[left+1:right] spanning the cut site -> (indels, lefts, rights), in the loop order of gen.cpp
+    T = len(seq)
+    lefts, rights = np.meshgrid(np.arange(max(0, cut_idx - MAX_DEL_SIZE - 1), cut_idx), np.arange(cut_idx, min(T, cut_idx + MAX_DEL_SIZE + 1)), indexing='ij')
+    lefts, rights = lefts.flatten(), rights.flatten()
+    dsizes = rights - lefts - 1
+    keep = (dsizes > 0) & (dsizes <= MAX_DEL_SIZE)
+    lefts, rights, dsizes = lefts[keep], rights[keep], dsizes[keep]
+
+    #The read matches seq up to j and seq[j+dsize:] from j (aligner coords: left_i=j, right_i=j+dsize+1) for
+    #j = left+1 moved left by the common suffix, or right by the common prefix, of the deleted and kept sequence
+    F, B = commonPrefixLengths(seq), commonSuffixLengths(seq)
+    jmins = np.maximum.reduce([lefts + 1 - B[lefts, rights - 1], np.ones(len(lefts), dtype=int), cut_idx - MAX_CUT_DIST - dsizes - 1])
+    jmaxs = np.minimum.reduce([lefts + 1 + F[lefts + 1, rights], np.full(len(lefts), cut_idx + MAX_CUT_DIST), T - dsizes - 1])
+    indels = [formatIndel('D', d, jmin, jmax, jmax + d + 1, cut_idx) for d, jmin, jmax in zip(dsizes, jmins, jmaxs)]
+    return indels, lefts, rights
+
+def generateInsertions(seq, cut_idx):
+    #All insertions at the cut site -> (indels, ins_seqs), in the order of gen.cpp
+    indels, ins_seqs = [], []
+    for isize in range(1, MAX_INS_SIZE + 1):
+        for ins_seq in getAllInsertionsOfSize(isize):
+            read_seq = seq[:cut_idx] + ins_seq + seq[cut_idx:]
+            js = [j for j in range(max(1, cut_idx - MAX_CUT_DIST - 1), min(cut_idx + MAX_CUT_DIST, len(seq) - 1) + 1)
+                  if read_seq[:j] == seq[:j] and read_seq[j+isize:] == seq[j:]]
+            indels.append(formatIndel('I', isize, js[0], js[-1], js[-1] + 1, cut_idx))
+            ins_seqs.append(ins_seq)
+    return indels, ins_seqs
+
+def generateAllIndels(target_seq, pam_idx):
+    #Equivalent of running indelgentarget: returns ({indel: [(left, right, ins_seq),...]}, {indel: rep_read}) as
+    #parsed by predict.parseGeneratedIndels (locations are in target_seq coordinates, reads in the trimmed sequence)
+    seq, pam_idx, left_trim = trimTarget(target_seq, pam_idx)
+    if 'N' in seq:    #(The aligner scores N as a partial match to anything, not handled here)
+        raise InvalidTargetError('Target contains N, which needs the indelgentarget binary (see predict.INDELGENTARGET_EXE)')
+    cut_idx = pam_idx - 3
+    gen_indels, rep_reads = {}, {}
+    def addIndel(indel, left, right, ins_seq):
+        if indel not in gen_indels:
+            gen_indels[indel] = []
+            rep_reads[indel] = seq[:left+1] + ins_seq + seq[right:]
+        gen_indels[indel].append((left + left_trim, right + left_trim, ins_seq))
+
+    #(Deletion and insertion names never coincide, so only the order within each type matters)
+    del_indels, lefts, rights = generateDeletions(seq, cut_idx)
+    for indel, left, right in zip(del_indels, lefts, rights):
+        addIndel(indel, int(left), int(right), '')
+    for indel, ins_seq in zip(*generateInsertions(seq, cut_idx)):
+        addIndel(indel, cut_idx - 1, cut_idx, ins_seq)
+    return gen_indels, rep_reads
+
+def formatGeneratedIndels(gen_indels, rep_reads):
+    #Lines of indelgentarget output (without the Git commit line), sorted by indel as in its std::map
+    lines = []
+    for indel in sorted(gen_indels):
+        locs = ','.join(['(%d,%d,%s)' % loc for loc in gen_indels[indel]])
+        lines.append('%s\t%d\t[%s]\t%s' % (indel, len(gen_indels[indel]), locs, rep_reads[indel]))
+    return lines
@@ -4,29 +4,71 @@ import random
 
 # from mpi4py import MPI
 
-import io, os, sys, csv, time
-from multiprocessing import Process, Pipe
+import io, os, sys, csv, time, atexit, traceback, hashlib
+from collections import OrderedDict
+from multiprocessing import Process, Pipe, cpu_count
 
+import scipy.sparse
 from scipy.stats import pearsonr, spearmanr
 from scipy.optimize import minimize
 
 from selftarget.data import getSampleSelectors, getAllDataDirs
 from selftarget.oligo import loadOldNewMapping, partitionGuides, getFileForOligoIdx, getOligoIdxFromId
+from selftarget.parse import parseFloat, parseInt
 from selftarget.profile import getProfileCounts
 
-from predictor.features import readFeaturesData
+from predictor.features import readFeaturesData, readSparseFeaturesData, getDedupedFeatureLabels, getFeatureLabels, PrunedFeatureEngine, SPARSE_FEATURES_EXT
+from predictor.checkpoint import writeCheckpoint, readCheckpoint, checkCheckpointMatches, getRNGState, setRNGState, logProgress, CHECKPOINT_EXT
+from predictor.optimize import initLBFGSState, minimizeLBFGS, minimizeOWLQN, l1Penalty, softThreshold
 
 # comm = MPI.COMM_WORLD
+comm = None
 mpi_rank = 0
 mpi_size = 1
 
+#Backend for evaluating the objective over a guideset: 'serial', 'process' (local worker processes
+#each holding a shard of the guideset in memory) or 'mpi' (one shard per MPI rank, requires mpi4py)
+PARALLEL_BACKEND = 'serial'
+NUM_WORKERS = cpu_count()
+MAX_WORKER_POOLS = 2
+_worker_pools = OrderedDict()
+_fit_stats = {'evaluations': 0}
+
 REG_CONST = 0.01
 I1_REG_CONST = 0.01
+#L1 penalty on all weights (added to the L2 ones above for an elastic net), trained with OWL-QN (or a proximal step
+#in stochastic mode). Weights it sets to zero need not be computed at prediction time (see CompiledModel.getPrunedFeatureEngine)
+L1_REG_CONST = 0.0
+
+#Training mode: 'lbfgs' (full-batch L-BFGS-B) or 'stochastic' (mini-batches of oligos, with Adam or SGD)
+TRAINING_MODE = 'lbfgs'
+SGD_OPTIMIZER = 'adam'
+SGD_BATCH_SIZE = 100
+SGD_NUM_EPOCHS = 20
+SGD_LEARNING_RATE = 0.01
+SGD_LR_DECAY = 0.1          #Learning rate at epoch e is SGD_LEARNING_RATE/(1 + SGD_LR_DECAY*e)
+SGD_EVAL_EPOCHS = 1         #Full-batch evaluation (and tmp theta file) every SGD_EVAL_EPOCHS epochs
+ADAM_BETA1, ADAM_BETA2, ADAM_EPS = 0.9, 0.999, 1e-8
+
+#If set, training writes a checkpoint (<prefix>_cv<idx>.npz) every CHECKPOINT_EVERY iterations (epochs in
+#stochastic mode), plus a progress log, and resumes from the checkpoint if it exists
+CHECKPOINT_PREFIX = None
+CHECKPOINT_EVERY = 10
+TRAINING_SEED = None
 GEN_INDEL_FEATURES_DIR = '/features_ext_for_gen_indels'
 GEN_INDEL_LOC = '../../indel_analysis/gen_indels'
 FEATURES_DIR = GEN_INDEL_LOC + GEN_INDEL_FEATURES_DIR
 READS_DIR = GEN_INDEL_LOC + '/reads_for_gen_indels_all_samples'
 OUT_THETA_FILE = 'model_thetas.txt'
+TRAINING_CACHE_FILE = None
+
+#Compiled model files (see compileModel), and the models loaded by this process: {abs path: (mtime, CompiledModel)}
+COMPILED_MODEL_EXT = '.npz'
+_model_registry = {}
+
+#Feature matrices and read fractions of each oligo, loaded once per training run: {oligo_id: (X, Y)}
+_training_data = {}
+_training_data_key = None
 
 def setOutputThetaFile(filename):
     global OUT_THETA_FILE
@@ -40,6 +82,63 @@ def setReadsDir(dirname):
     global READS_DIR
     READS_DIR = dirname
 
+def setTrainingCacheFile(filename):
+    #Binary file to persist the loaded training data to (and reload it from on the next run)
+    global TRAINING_CACHE_FILE
+    TRAINING_CACHE_FILE = filename
+
+def setParallelBackend(backend, num_workers=None):
+    global PARALLEL_BACKEND, NUM_WORKERS, comm, mpi_rank, mpi_size
+    if backend not in ['serial', 'process', 'mpi']:
+        raise Exception('Unknown parallel backend %s (expecting serial, process or mpi)' % backend)
+    stopWorkerPools()
+    if backend == 'mpi':
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        mpi_rank, mpi_size = comm.Get_rank(), comm.Get_size()
+    else:
+        comm, mpi_rank, mpi_size = None, 0, 1
+    PARALLEL_BACKEND = backend
+    if num_workers is not None: NUM_WORKERS = num_workers
+
+def broadcastFromMaster(val):
+    if PARALLEL_BACKEND == 'mpi':
+        return comm.bcast(val, root=0)
+    return val
+
+def setTrainingMode(mode):
+    global TRAINING_MODE
+    if mode not in ['lbfgs', 'stochastic']:
+        raise Exception('Unknown training mode %s (expecting lbfgs or stochastic)' % mode)
+    TRAINING_MODE = mode
+
+def setStochasticParams(optimizer=None, batch_size=None, num_epochs=None, learning_rate=None, lr_decay=None, eval_epochs=None):
+    global SGD_OPTIMIZER, SGD_BATCH_SIZE, SGD_NUM_EPOCHS, SGD_LEARNING_RATE, SGD_LR_DECAY, SGD_EVAL_EPOCHS
+    if optimizer is not None:
+        if optimizer not in ['adam', 'sgd']:
+            raise Exception('Unknown optimizer %s (expecting adam or sgd)' % optimizer)
+        SGD_OPTIMIZER = optimizer
+    if batch_size is not None: SGD_BATCH_SIZE = batch_size
+    if num_epochs is not None: SGD_NUM_EPOCHS = num_epochs
+    if learning_rate is not None: SGD_LEARNING_RATE = learning_rate
+    if lr_decay is not None: SGD_LR_DECAY = lr_decay
+    if eval_epochs is not None: SGD_EVAL_EPOCHS = eval_epochs
+
+def setCheckpointPrefix(prefix, every=None):
+    global CHECKPOINT_PREFIX, CHECKPOINT_EVERY
+    CHECKPOINT_PREFIX = prefix
+    if every is not None: CHECKPOINT_EVERY = every
+
+def setTrainingSeed(seed):
+    global TRAINING_SEED
+    TRAINING_SEED = seed
+
+def getCheckpointFile(cv_idx):
+    return CHECKPOINT_PREFIX + '_cv%d%s' % (cv_idx, CHECKPOINT_EXT)
+
+def getProgressLogFile(cv_idx):
+    return CHECKPOINT_PREFIX + '_cv%d_progress.txt' % cv_idx
+
 def setRegConst(val):
     global REG_CONST
     REG_CONST = val
@@ -48,6 +147,14 @@ def setI1RegConst(val):
     global I1_REG_CONST
     I1_REG_CONST = val
 
+def setL1RegConst(val):
+    global L1_REG_CONST
+    L1_REG_CONST = val
+
+def countNonZero(theta, tol=0.0):
+    #Number of weights with abs(theta) > tol (the features that need computing at prediction time)
+    return int(np.sum(np.abs(theta) > tol))
+
 def writeTheta(out_file, feature_columns, theta, train_set):
     fout = io.open(out_file, 'w')
     fout.write(u'%s\n' % ','.join([x for x in train_set]))
@@ -56,14 +163,112 @@ def writeTheta(out_file, feature_columns, theta, train_set):
     fout.close()
 
 def readTheta(theta_file):
+    if theta_file.endswith(COMPILED_MODEL_EXT):
+        model = readCompiledModel(theta_file)
+        return list(model.theta), model.train_set, model.feature_columns
     f = io.open(theta_file)
     train_set = f.readline()[:-1].split(',')
     feature_columns, theta = [], []
     for toks in csv.reader(f, delimiter='\t'):
         feature_columns.append(toks[0])
-        theta.append(eval(toks[1]))
+        theta.append(parseFloat(toks[1]))
+    f.close()
     return theta, train_set, feature_columns
 
+class CompiledModel:
+    #A trained model ready for prediction: theta (as an array), the training set, the feature columns theta is
+    #in the order of, the index of each of those in the feature labels computed by predictor.features (-1 if not
+    #computed there), and a hash identifying the model (of its feature columns and theta)
+
+    def __init__(self, theta, train_set, feature_columns, feature_idxs=None, model_hash=None):
+        self.theta = np.array(theta, dtype=float)
+        self.train_set = [x for x in train_set]
+        self.feature_columns = [x for x in feature_columns]
+        if feature_idxs is None:
+            label_lookup = {x: i for i, x in enumerate(getDedupedFeatureLabels())}
+            feature_idxs = [label_lookup.get(x, -1) for x in self.feature_columns]
+        self.feature_idxs = np.array(feature_idxs, dtype=int)
+        self.model_hash = model_hash if model_hash is not None else computeModelHash(self.theta, self.feature_columns)
+        self._label_theta = None
+        self._pruned_engines = {}
+
+    def getThetaForColumns(self, feature_cols):
+        #theta arranged for a feature matrix with columns feature_cols, so that thetaX = X.dot(result). For the feature
+        #labels computed by predictor.features this is computed once per model (a scatter of theta by feature_idxs)
+        if list(feature_cols) == getDedupedFeatureLabels():
+            if self._label_theta is None:
+                if (self.feature_idxs < 0).any():
+                    raise Exception('Stored feature names associated with model thetas are not contained in those computed')
+                label_theta = np.zeros(len(feature_cols))
+                np.add.at(label_theta, self.feature_idxs, self.theta)
+                self._label_theta = label_theta
+            return self._label_theta
+        col_lookup = {x: i for i, x in enumerate(feature_cols)}
+        if len(set(self.feature_columns).difference(set(col_lookup))) != 0:
+            raise Exception('Stored feature names associated with model thetas are not contained in those computed')
+        col_theta = np.zeros(len(feature_cols))
+        np.add.at(col_theta, [col_lookup[x] for x in self.feature_columns], self.theta)
+        return col_theta
+
+    def getPrunedFeatureEngine(self, tol=0.0):
+        #(PrunedFeatureEngine computing only the features with abs(theta) > tol, theta for its columns), built once per tol
+        if tol not in self._pruned_engines:
+            label_theta = self.getThetaForColumns(getDedupedFeatureLabels())
+            label_idxs = np.where(np.abs(label_theta) > tol)[0]
+            self._pruned_engines[tol] = (PrunedFeatureEngine(label_idxs), label_theta[label_idxs])
+        return self._pruned_engines[tol]
+
+def computeModelHash(theta, feature_columns):
+    h = hashlib.sha1()
+    h.update('\t'.join(feature_columns).encode('utf-8'))
+    h.update(np.array(theta, dtype='<f8').tobytes())
+    return h.hexdigest()
+
+def getFeatureLabelsHash():
+    return hashlib.sha1('\t'.join(getFeatureLabels()).encode('utf-8')).hexdigest()
+
+def writeCompiledModel(out_file, model):
+    tmp_filename = out_file + '.tmp%d' % os.getpid()
+    fout = io.open(tmp_filename, 'wb')
+    np.savez(fout, theta=model.theta, train_set=np.array(model.train_set, dtype=str), feature_columns=np.array(model.feature_columns, dtype=str),
+             feature_idxs=model.feature_idxs, labels_hash=np.array(getFeatureLabelsHash()), model_hash=np.array(model.model_hash))
+    fout.close()
+    os.replace(tmp_filename, out_file)
+
+def readCompiledModel(model_file):
+    f = np.load(model_file)
+    #(The stored column mapping is only used if the feature labels have not changed since the model was compiled)
+    feature_idxs = f['feature_idxs'] if str(f['labels_hash']) == getFeatureLabelsHash() else None
+    model = CompiledModel(f['theta'], [x for x in f['train_set']], [x for x in f['feature_columns']], feature_idxs, str(f['model_hash']))
+    f.close()
+    return model
+
+def compileModel(theta_file, out_file=None):
+    #Converts a model (theta) text file, as written by writeTheta, to a compiled model file (by default alongside it)
+    if out_file is None: out_file = os.path.splitext(theta_file)[0] + COMPILED_MODEL_EXT
+    theta, train_set, feature_columns = readTheta(theta_file)
+    writeCompiledModel(out_file, CompiledModel(theta, train_set, feature_columns))
+    return out_file
+
+def exportModel(model_file, theta_file):
+    #Writes a compiled model back to the text format
+    model = readCompiledModel(model_file)
+    writeTheta(theta_file, model.feature_columns, model.theta, model.train_set)
+
+def loadModel(model_file):
+    #The CompiledModel for a model text or compiled file, read once per process (and again only if the file changes)
+    key, mtime = os.path.abspath(model_file), os.path.getmtime(model_file)
+    if key not in _model_registry or _model_registry[key][0] != mtime:
+        if model_file.endswith(COMPILED_MODEL_EXT):
+            model = readCompiledModel(model_file)
+        else:
+            model = CompiledModel(*readTheta(model_file))
+        _model_registry[key] = (mtime, model)
+    return _model_registry[key][1]
+
+def clearModelRegistry():
+    _model_registry.clear()
+
 def printAndFlush(msg, master_only=True):
     if not master_only or mpi_rank == 0:
         print(msg)
@@ -71,27 +276,37 @@ def printAndFlush(msg, master_only=True):
 
 def getCutSite(features_file):
     f = io.open(features_file); f.readline()
-    cut_site = eval(f.readline().split('\t')[1])
+    cut_site = parseInt(f.readline().split('\t')[1])
     return cut_site
 
-def loadOligoFeaturesAndReadCounts(oligo_id, sample_names):
-
+def getOligoDataFiles(oligo_id, features_ext='.txt'):
     oligo_idx = getOligoIdxFromId(oligo_id)
     oligo_subdir, _ = getFileForOligoIdx(oligo_idx, ext='')
-
-    features_file = FEATURES_DIR + '/' + oligo_subdir + '/%s_gen_indel_features.txt' % oligo_id
+    features_file = FEATURES_DIR + '/' + oligo_subdir + '/%s_gen_indel_features%s' % (oligo_id, features_ext)
     reads_file = READS_DIR + '/' + oligo_subdir + '/%s_gen_indel_reads.txt' % oligo_id
+    return features_file, reads_file
+
+def hasSparseFeatures(oligo_id):
+    return os.path.isfile(getOligoDataFiles(oligo_id, SPARSE_FEATURES_EXT)[0])
+
+def loadReadFractions(reads_file, sample_names):
+    read_data =  pd.read_csv(reads_file, skiprows=1, sep='\t')
+    read_data['Sum Sample Reads'] = read_data[sample_names].sum(axis=1) + 0.5
+    read_data = read_data.loc[read_data['Indel']!='All Mutated']
+    total_mut_reads = read_data['Sum Sample Reads'].sum()
+    if total_mut_reads == 0: raise Exception('No Mutated Reads in %s' % reads_file)
+    read_data['Frac Sample Reads'] = read_data['Sum Sample Reads']/total_mut_reads
+    return read_data
+
+def loadOligoFeaturesAndReadCounts(oligo_id, sample_names):
+
+    features_file, reads_file = getOligoDataFiles(oligo_id)
 
     cut_site = getCutSite(features_file)
     indel_feature_data, feature_cols = readFeaturesData(features_file)
     
     if len(sample_names) > 0:
-        read_data =  pd.read_csv(reads_file, skiprows=1, sep='\t')
-        read_data['Sum Sample Reads'] = read_data[sample_names].sum(axis=1) + 0.5
-        read_data = read_data.loc[read_data['Indel']!='All Mutated']
-        total_mut_reads = read_data['Sum Sample Reads'].sum()
-        if total_mut_reads == 0: raise Exception('No Mutated Reads in %s' % reads_file)
-        read_data['Frac Sample Reads'] = read_data['Sum Sample Reads']/total_mut_reads
+        read_data = loadReadFractions(reads_file, sample_names)
         merged_data = pd.merge(indel_feature_data, read_data[['Indel','Frac Sample Reads']], left_index=True, right_on='Indel', how='inner')
     else:
         merged_data = indel_feature_data
@@ -99,31 +314,251 @@ def loadOligoFeaturesAndReadCounts(oligo_id, sample_names):
 
     return merged_data
 
-def calcThetaX(row, theta, feature_columns):
-    return sum(theta*row[feature_columns])
+def selectFeatureColumns(X, feature_cols, feature_columns):
+    #Columns of the feature matrix X (with columns feature_cols) in feature_columns order
+    if list(feature_cols) == list(feature_columns): return X
+    col_lookup = {x: i for i, x in enumerate(feature_cols)}
+    if len(set(feature_columns).difference(set(col_lookup))) != 0:
+        raise Exception('Stored feature names associated with model thetas are not contained in those computed')
+    return X[:, [col_lookup[x] for x in feature_columns]]
+
+def loadOligoSparseFeaturesAndReadCounts(oligo_id, sample_names, feature_columns):
+    #Returns (indels, X, Y) from the sparse feature store: X a CSR matrix with one row per indel and columns in
+    #feature_columns order, and Y the fraction of mutated reads for each indel (None if no sample_names are given)
+    features_file, reads_file = getOligoDataFiles(oligo_id, SPARSE_FEATURES_EXT)
+    indels, X, feature_cols = readSparseFeaturesData(features_file)
+    X = selectFeatureColumns(X, feature_cols, feature_columns)
+    if len(sample_names) == 0:
+        return indels, X, None
+
+    #Same inner merge as loadOligoFeaturesAndReadCounts, so X and Y rows line up as they do for the text features
+    read_data = loadReadFractions(reads_file, sample_names)
+    indel_rows = pd.DataFrame({'Indel': indels, 'Row': np.arange(len(indels))})
+    merged_data = pd.merge(indel_rows, read_data[['Indel','Frac Sample Reads']], on='Indel', how='inner')
+    X, Y = X[merged_data['Row'].values], merged_data['Frac Sample Reads'].values
+    assert(X.shape[0] == len(Y))
+    return [x for x in merged_data['Indel']], X, Y
+
+def loadOligoFeatureMatrixAndReadCounts(oligo_id, sample_names, feature_columns):
+    #Returns (indels, X, Y) with X a numeric feature matrix (columns in feature_columns order, sparse if read
+    #from a sparse feature store) and Y the fraction of mutated reads per indel (None if no sample_names given)
+    if hasSparseFeatures(oligo_id):
+        return loadOligoSparseFeaturesAndReadCounts(oligo_id, sample_names, feature_columns)
+    data = loadOligoFeaturesAndReadCounts(oligo_id, sample_names)
+    Y = data['Frac Sample Reads'].values if len(sample_names) > 0 else None
+    return [x for x in data['Indel']], data[feature_columns].values.astype(float), Y
+
+def clearTrainingData():
+    global _training_data_key
+    _training_data.clear()
+    _training_data_key = None
+
+def _getTrainingDataKey(sample_names, feature_columns):
+    return (FEATURES_DIR, READS_DIR, tuple(sample_names), tuple(feature_columns))
+
+def _getTrainingCacheFile():
+    if TRAINING_CACHE_FILE is None or mpi_size == 1: return TRAINING_CACHE_FILE
+    return TRAINING_CACHE_FILE + '.%d' % mpi_rank
+
+def _writeTrainingCacheFile(filename):
+    oligo_ids = sorted(_training_data.keys())
+    Xs, Ys = [_training_data[x][0] for x in oligo_ids], [_training_data[x][1] for x in oligo_ids]
+    X = scipy.sparse.vstack(Xs, format='csr') if len(Xs) > 0 else scipy.sparse.csr_matrix((0,len(_training_data_key[3])))
+    offsets = np.cumsum([0] + [len(y) for y in Ys])
+    key = _training_data_key
+    tmp_filename = filename + '.tmp%d' % os.getpid()
+    fout = io.open(tmp_filename, 'wb')
+    np.savez(fout, features_dir=np.array(key[0]), reads_dir=np.array(key[1]), sample_names=np.array(key[2], dtype=str), feature_cols=np.array(key[3], dtype=str),
+             oligo_ids=np.array(oligo_ids, dtype=str), offsets=offsets, Y=np.concatenate(Ys) if len(Ys) > 0 else np.zeros(0),
+             data=X.data.astype(np.uint8), indices=X.indices, indptr=X.indptr, shape=np.array(X.shape))
+    fout.close()
+    os.replace(tmp_filename, filename)
+
+def _readTrainingCacheFile(filename, oligo_ids):
+    #Adds any of oligo_ids stored in the cache file to the training data (if it was written for the same data and features)
+    f = np.load(filename)
+    key = (str(f['features_dir']), str(f['reads_dir']), tuple([x for x in f['sample_names']]), tuple([x for x in f['feature_cols']]))
+    if key != _training_data_key:
+        printAndFlush('Ignoring training cache file %s (different data or features)' % filename, master_only=False)
+        f.close()
+        return
+    X = scipy.sparse.csr_matrix((f['data'].astype(float), f['indices'], f['indptr']), shape=tuple(f['shape']))
+    offsets, Y = f['offsets'], f['Y']
+    idx_lookup = {x: i for i, x in enumerate(f['oligo_ids'])}
+    for oligo_id in oligo_ids:
+        if oligo_id not in idx_lookup: continue
+        i = idx_lookup[oligo_id]
+        _training_data[oligo_id] = (X[offsets[i]:offsets[i+1]], Y[offsets[i]:offsets[i+1]])
+    f.close()
+
+def loadTrainingData(guideset, sample_names, feature_columns):
+    #Returns [(X, Y)] for each oligo in guideset. The feature and read files of each oligo are read only the
+    #first time it is requested (or once per run from TRAINING_CACHE_FILE), then held in memory as a
+    #CSR feature matrix and array of read fractions.
+    global _training_data_key
+    if len(sample_names) == 0:
+        raise Exception('No samples given for training data')
+    key = _getTrainingDataKey(sample_names, feature_columns)
+    if key != _training_data_key:
+        _training_data.clear()
+        _training_data_key = key
+
+    to_load = [x for x in guideset if x not in _training_data]
+    cache_file = _getTrainingCacheFile()
+    if len(to_load) > 0 and cache_file is not None and os.path.isfile(cache_file):
+        _readTrainingCacheFile(cache_file, to_load)
+        to_load = [x for x in to_load if x not in _training_data]
+    for oligo_id in to_load:
+        _, X, Y = loadOligoFeatureMatrixAndReadCounts(oligo_id, sample_names, feature_columns)
+        _training_data[oligo_id] = (scipy.sparse.csr_matrix(X, dtype=float), Y)
+    if len(to_load) > 0 and cache_file is not None:
+        _writeTrainingCacheFile(cache_file)
+    return [_training_data[x] for x in guideset]
+
+def getRegConsts(feature_columns, reg_const, i1_reg_const):
+    return np.array([i1_reg_const if 'I' in name else reg_const for name in feature_columns])
 
 def computeRegularisers(theta, feature_columns, reg_const, i1_reg_const):
-    Q_reg = sum([i1_reg_const*val**2.0 if 'I' in name else reg_const*val**2.0 for (val, name) in zip(theta, feature_columns)])
-    grad_reg = theta*np.array([i1_reg_const if 'I' in name else reg_const for name in feature_columns])
+    reg_consts = getRegConsts(feature_columns, reg_const, i1_reg_const)
+    Q_reg = np.dot(reg_consts, theta**2.0)
+    grad_reg = theta*reg_consts
     return Q_reg, grad_reg
 
+def computeOligoKLObjAndGradient(theta, X, Y):
+    #KL objective (excluding regularisation) and its gradient for one oligo, with X the oligo's
+    #feature matrix (dense or sparse) and Y the observed read fractions for each row
+    thetaX = X.dot(theta)
+    exp_thetaX = np.exp(thetaX)
+    sum_exp = exp_thetaX.sum()
+    Q = np.log(sum_exp) + np.dot(Y, np.log(Y) - thetaX)
+    jac = X.T.dot(exp_thetaX)/sum_exp - X.T.dot(Y)
+    return Q, jac
+
 def computeKLObjAndGradients(theta, guideset, sample_names, feature_columns, reg_const, i1_reg_const):
     N = len(feature_columns)
     Q, jac, minQ, maxQ = 0.0, np.zeros(N), 0.0, 1000.0
     Qs = []
-    for oligo_id in guideset:
-        data = loadOligoFeaturesAndReadCounts(oligo_id, sample_names)
-        Y = data['Frac Sample Reads']
-        data['ThetaX'] = data.apply(calcThetaX, axis=1, args=(theta,feature_columns))
-        sum_exp = np.exp(data['ThetaX']).sum()
-        Q_reg, grad_reg =  computeRegularisers(theta, feature_columns, reg_const, i1_reg_const)
-        tmpQ = (np.log(sum_exp) + sum(Y*(np.log(Y) - data['ThetaX'])) + Q_reg)
+    theta = np.array(theta, dtype=float)
+    Q_reg, grad_reg =  computeRegularisers(theta, feature_columns, reg_const, i1_reg_const)
+    for (X, Y) in loadTrainingData(guideset, sample_names, feature_columns):
+        oligo_Q, oligo_jac = computeOligoKLObjAndGradient(theta, X, Y)
+        tmpQ = oligo_Q + Q_reg
         Q += tmpQ
         Qs.append(tmpQ)
-        jac += np.matmul(np.exp(data['ThetaX']),data[feature_columns].astype(int))/sum_exp - np.matmul(Y,data[feature_columns].astype(int)) + grad_reg
+        jac += oligo_jac + grad_reg
     return Q, jac, Qs 
 
+def _objectiveWorker(conn, features_dir, reads_dir, cache_file, guideset, sample_names, feature_columns):
+    #Holds the training data for its shard of the guideset in memory, returning the objective and gradients for each theta received
+    try:
+        setFeaturesDir(features_dir); setReadsDir(reads_dir); setTrainingCacheFile(cache_file)
+        loadTrainingData(guideset, sample_names, feature_columns)
+        shard_ids = set(guideset)
+        conn.send((True, None))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+        return
+    while True:
+        msg = conn.recv()
+        if msg is None: break
+        theta, reg_const, i1_reg_const, batch = msg
+        try:
+            oligo_ids = guideset if batch is None else [x for x in batch if x in shard_ids]
+            conn.send((True, computeKLObjAndGradients(theta, oligo_ids, sample_names, feature_columns, reg_const, i1_reg_const)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+class ObjectiveWorkerPool:
+
+    def __init__(self, guideset, sample_names, feature_columns, num_workers):
+        self.conns, self.workers = [], []
+        num_workers = max(min(num_workers, len(guideset)), 1)
+        for i in range(num_workers):
+            cache_file = TRAINING_CACHE_FILE + '.%d_of_%d' % (i, num_workers) if TRAINING_CACHE_FILE is not None else None
+            parent_conn, child_conn = Pipe()
+            worker = Process(target=_objectiveWorker, args=(child_conn, FEATURES_DIR, READS_DIR, cache_file, guideset[i::num_workers], sample_names, feature_columns))
+            worker.daemon = True
+            worker.start()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+        self._receiveAll()    #(Wait for data to load)
+
+    def _receiveAll(self):
+        results = [conn.recv() for conn in self.conns]
+        for ok, result in results:
+            if not ok:
+                self.close()
+                raise Exception('Objective worker failed:\n%s' % result)
+        return [result for ok, result in results]
+
+    def evaluate(self, theta, reg_const, i1_reg_const, batch=None):
+        #Sums over the full guideset, or just the oligos in batch (a subset of it) if given
+        for conn in self.conns:
+            conn.send((theta, reg_const, i1_reg_const, batch))
+        Q, jac, Qs = 0.0, 0.0, []
+        for (worker_Q, worker_jac, worker_Qs) in self._receiveAll():
+            Q, jac = Q + worker_Q, jac + worker_jac
+            Qs.extend(worker_Qs)
+        return Q, jac, Qs
+
+    def close(self):
+        for conn, worker in zip(self.conns, self.workers):
+            try: conn.send(None)
+            except (OSError, EOFError): pass
+            worker.join(timeout=5)
+            if worker.is_alive(): worker.terminate()
+        self.conns, self.workers = [], []
+
+def _getWorkerPool(guideset, sample_names, feature_columns):
+    key = (tuple(guideset), tuple(sample_names), tuple(feature_columns), FEATURES_DIR, READS_DIR)
+    if key not in _worker_pools:
+        while len(_worker_pools) >= MAX_WORKER_POOLS:
+            _worker_pools.popitem(last=False)[1].close()
+        _worker_pools[key] = ObjectiveWorkerPool([x for x in guideset], sample_names, feature_columns, NUM_WORKERS)
+    _worker_pools.move_to_end(key)
+    return _worker_pools[key]
+
+def stopWorkerPools():
+    while len(_worker_pools) > 0:
+        _worker_pools.popitem(last=False)[1].close()
+
+atexit.register(stopWorkerPools)
+
+def computeObjective(theta, guideset, sample_names, feature_columns, reg_const, i1_reg_const):
+    #Objective and gradients summed over the guideset (on this process, or its worker processes)
+    if PARALLEL_BACKEND == 'process':
+        return _getWorkerPool(guideset, sample_names, feature_columns).evaluate(theta, reg_const, i1_reg_const)
+    return computeKLObjAndGradients(theta, guideset, sample_names, feature_columns, reg_const, i1_reg_const)
+
+def computeBatchObjective(theta, guideset, batch, sample_names, feature_columns, reg_const, i1_reg_const):
+    #As computeObjective, for a mini-batch of oligos from guideset (using the worker processes holding guideset)
+    if PARALLEL_BACKEND == 'process':
+        return _getWorkerPool(guideset, sample_names, feature_columns).evaluate(theta, reg_const, i1_reg_const, batch=batch)
+    return computeKLObjAndGradients(theta, batch, sample_names, feature_columns, reg_const, i1_reg_const)
+
+def getNumEvaluations():
+    #Number of objective evaluations by assessFit in this process so far
+    return _fit_stats['evaluations']
+
+def printFit(Q, Qs, reg_const, i1_reg_const, theta=None, l1_reg_const=0.0):
+    #(Q excludes the L1 penalty, which is reported with the number of non-zero weights)
+    fields = ['Q=%.5f' % Q, 'Min=%.3f' % min(Qs), 'Max=%.3f' % max(Qs), 'Num=%d' % len(Qs), 'Lambda=%e' % reg_const, 'I1_Lambda=%e' % i1_reg_const]
+    if l1_reg_const > 0: fields += ['L1_Lambda=%e' % l1_reg_const, 'L1=%.5f' % l1Penalty(theta, l1_reg_const)]
+    if theta is not None: fields.append('NonZero=%d/%d' % (countNonZero(theta), len(theta)))
+    printAndFlush(' '.join(fields))
+
 def assessFit(theta, guideset, sample_names, feature_columns, cv_idx=0, reg_const=REG_CONST, i1_reg_const=I1_REG_CONST, test_only=False):
+    if PARALLEL_BACKEND == 'mpi':
+        return assessFitMPI(theta, guideset, sample_names, feature_columns, cv_idx, reg_const, i1_reg_const, test_only)
+    Q, jac, Qs = computeObjective(theta, guideset, sample_names, feature_columns, reg_const, i1_reg_const)
+    _fit_stats['evaluations'] += 1
+    Q, jac = Q/len(Qs), jac/len(Qs)
+    printFit(Q, Qs, reg_const, i1_reg_const, theta, L1_REG_CONST)
+    writeTheta('tmp_%s_%d.txt' % (OUT_THETA_FILE, cv_idx), feature_columns, theta, guideset)
+    return Q, jac, Qs
+
+def assessFitMPI(theta, guideset, sample_names, feature_columns, cv_idx=0, reg_const=REG_CONST, i1_reg_const=I1_REG_CONST, test_only=False):
     #Send out thetas
     theta, done = comm.bcast((theta, False), root=0)
     while not done:
@@ -138,7 +573,7 @@ def assessFit(theta, guideset, sample_names, feature_columns, cv_idx=0, reg_cons
             Q, jac, Qs = sum([x[0] for x in objs_and_grads]), sum([x[1] for x in objs_and_grads]), []
             for x in objs_and_grads: Qs.extend(x[2]) 
             Q, jac, Qs = Q/len(Qs), jac/len(Qs), Qs
-            printAndFlush(' '.join(['Q=%.5f' % Q, 'Min=%.3f' % min(Qs), 'Max=%.3f' % max(Qs), 'Num=%d' % len(Qs), 'Lambda=%e' % reg_const, 'I1_Lambda=%e' % i1_reg_const]))
+            printFit(Q, Qs, reg_const, i1_reg_const, theta, L1_REG_CONST)
             writeTheta('tmp_%s_%d.txt' % (OUT_THETA_FILE, cv_idx), feature_columns, theta, flatten(full_guideset))
     
         Q, jac, Qs = comm.bcast((Q, jac, Qs), root=0)
@@ -154,9 +589,14 @@ def debugIndel(theta, data, indel, feature_columns):
         print(indel, [(x,theta) for (x,y,theta) in zip(feature_columns,[row[x] for x in feature_columns],theta) if y])
 
 def computePredictedProfile(data, theta, feature_columns):
-    data['expThetaX'] = np.exp(data.apply(calcThetaX, axis=1, args=(theta,feature_columns)))
-    sum_exp = data['expThetaX'].sum()
-    profile = {x: expthetax*1000/sum_exp for (x,expthetax) in zip(data['Indel'],data['expThetaX'])}
+    #data: DataFrame of indel features, or (indels, X) with X a (sparse) feature matrix with columns in feature_columns order
+    if isinstance(data, tuple):
+        indels, X = data
+    else:
+        indels, X = data['Indel'], data[feature_columns].values.astype(float)
+    exp_thetaX = np.exp(X.dot(np.array(theta, dtype=float)))
+    sum_exp = exp_thetaX.sum()
+    profile = {x: expthetax*1000/sum_exp for (x,expthetax) in zip(indels,exp_thetaX)}
     counts = getProfileCounts(profile)
     return profile, counts
        
@@ -166,7 +606,8 @@ def recordProfiles( output_dir, theta, guideset, feature_columns ):
             os.mkdir(output_dir)
         else: time.sleep(5)
     for oligo_id in guideset:
-        profile, counts = computePredictedProfile(oligo_id, theta, feature_columns)
+        indels, X, _ = loadOligoFeatureMatrixAndReadCounts(oligo_id, [], feature_columns)
+        profile, counts = computePredictedProfile((indels, X), theta, feature_columns)
         idx = getOligoIdxFromId(oligo_id)
         filepath, filename = getFileForOligoIdx(idx)
         if not os.path.isdir(output_dir + '/' + filepath):
@@ -178,15 +619,162 @@ def recordProfiles( output_dir, theta, guideset, feature_columns ):
                 fout.write('%s\t-\t%d\n' % (indel, val))
         fout.close()
 
+def _initTheta(theta0, feature_columns, seed=None):
+    if theta0 is not None: return np.array(theta0, dtype=float)
+    if seed is None: return np.array([np.random.normal(loc=0.0, scale=1.0) for x in feature_columns])
+    return np.random.RandomState(seed).normal(loc=0.0, scale=1.0, size=len(feature_columns))
+
+def _newTrainingSeed():
+    return TRAINING_SEED if TRAINING_SEED is not None else np.random.randint(0, 2**31-1)
+
+def _loadCheckpointForRun(checkpoint_file, mode, guideset, sample_names, feature_columns):
+    state = readCheckpoint(checkpoint_file)
+    if state['mode'] != mode:
+        raise Exception('Checkpoint %s was written in %s training mode' % (checkpoint_file, state['mode']))
+    checkCheckpointMatches(checkpoint_file, state, guideset, sample_names, feature_columns, REG_CONST, I1_REG_CONST, L1_REG_CONST)
+    printAndFlush('Resuming from checkpoint %s (iteration %d)' % (checkpoint_file, state['iteration']))
+    return state
+
+def _preloadTrainingData(guideset, sample_names, feature_columns):
+    if PARALLEL_BACKEND == 'serial': loadTrainingData(guideset, sample_names, feature_columns)    #(Load data before optimization)
+    else: _getWorkerPool(guideset, sample_names, feature_columns)
+
 def trainModelParallel(guideset, sample_names, feature_columns, theta0, cv_idx=0):
+    if TRAINING_MODE == 'stochastic':
+        return trainModelStochastic(guideset, sample_names, feature_columns, theta0, cv_idx)
+    if PARALLEL_BACKEND == 'mpi':
+        return trainModelMPI(guideset, sample_names, feature_columns, theta0, cv_idx)
+    if CHECKPOINT_PREFIX is not None:
+        return trainModelCheckpointed(guideset, sample_names, feature_columns, theta0, cv_idx)
+    theta0 = _initTheta(theta0, feature_columns)
+    args=(guideset, sample_names, feature_columns, cv_idx, REG_CONST, I1_REG_CONST)
+    _preloadTrainingData(guideset, sample_names, feature_columns)
+    if L1_REG_CONST > 0:
+        state = minimizeOWLQN(assessFit, initLBFGSState(assessFit, theta0, args, L1_REG_CONST), L1_REG_CONST, args=args, tol=1e-4)
+        printAndFlush("Optimization Result: " + str(state['converged']))
+        return state['theta']
+    result = minimize(assessFit, theta0, args=args, method='L-BFGS-B', jac=True, tol=1e-4)
+    printAndFlush("Optimization Result: " + str(result.success))
+    return result.x
+
+def trainModelCheckpointed(guideset, sample_names, feature_columns, theta0, cv_idx=0):
+    #L-BFGS (or with L1_REG_CONST, OWL-QN) training (predictor.optimize, since its state can be stored and restored
+    #exactly) that checkpoints every CHECKPOINT_EVERY iterations, resuming from the checkpoint for cv_idx if there is one
+    guideset = [x for x in guideset]
+    checkpoint_file, log_file = getCheckpointFile(cv_idx), getProgressLogFile(cv_idx)
+    args = (guideset, sample_names, feature_columns, cv_idx, REG_CONST, I1_REG_CONST)
+    _preloadTrainingData(guideset, sample_names, feature_columns)
+    if os.path.isfile(checkpoint_file):
+        state = _loadCheckpointForRun(checkpoint_file, 'lbfgs', guideset, sample_names, feature_columns)
+    else:
+        seed = _newTrainingSeed()
+        state = initLBFGSState(assessFit, _initTheta(theta0, feature_columns, seed), args, L1_REG_CONST)
+        state.update({'mode': 'lbfgs', 'seed': seed, 'guideset': guideset, 'sample_names': sample_names, 'feature_columns': feature_columns,
+                      'reg_const': REG_CONST, 'i1_reg_const': I1_REG_CONST, 'l1_reg_const': L1_REG_CONST})
+        writeCheckpoint(checkpoint_file, state)
+
+    start_time = time.time()
+    def checkpointCallback(state):
+        logProgress(log_file, state['iteration'], state['Q'], state['jac'], start_time)
+        if state['iteration'] % CHECKPOINT_EVERY == 0 or state['converged']:
+            writeCheckpoint(checkpoint_file, state)
+
+    if L1_REG_CONST > 0:
+        state = minimizeOWLQN(assessFit, state, L1_REG_CONST, args=args, tol=1e-4, callback=checkpointCallback)
+    else:
+        state = minimizeLBFGS(assessFit, state, args=args, tol=1e-4, callback=checkpointCallback)
+    writeCheckpoint(checkpoint_file, state)
+    printAndFlush("Optimization Result: " + str(state['converged']))
+    return state['theta']
+
+def trainModelStochastic(guideset, sample_names, feature_columns, theta0, cv_idx=0, seed=None):
+    #Mini-batch training (Adam or SGD, with a decaying learning rate) on the same objective and regularisers as
+    #trainModelParallel, with a full-batch evaluation (printed, and written to the tmp theta file) every SGD_EVAL_EPOCHS epochs.
+    #The L1 penalty, if any, is applied by a proximal (soft threshold) step after each update, scaled by its per-weight step size
+    if PARALLEL_BACKEND == 'mpi':
+        raise Exception('Stochastic training is not supported with the mpi backend')
+    guideset = [x for x in guideset]
+    _preloadTrainingData(guideset, sample_names, feature_columns)
+    checkpoint_file = getCheckpointFile(cv_idx) if CHECKPOINT_PREFIX is not None else None
+    if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+        state = _loadCheckpointForRun(checkpoint_file, 'stochastic', guideset, sample_names, feature_columns)
+        rng = np.random.RandomState()
+        setRNGState(rng, state)
+    else:
+        if seed is None: seed = TRAINING_SEED
+        if seed is None and checkpoint_file is not None: seed = _newTrainingSeed()
+        theta = _initTheta(theta0, feature_columns, seed)
+        state = {'mode': 'stochastic', 'theta': theta, 'm': np.zeros(len(theta)), 'v': np.zeros(len(theta)), 't': 0, 'iteration': 0, 'trace': []}
+        if checkpoint_file is not None:
+            state.update({'seed': seed, 'guideset': guideset, 'sample_names': sample_names, 'feature_columns': feature_columns,
+                          'reg_const': REG_CONST, 'i1_reg_const': I1_REG_CONST, 'l1_reg_const': L1_REG_CONST})
+        rng = np.random.RandomState(seed)
+
+    start_time = time.time()
+    theta, m, v, t = state['theta'], state['m'], state['v'], state['t']
+    while state['iteration'] < SGD_NUM_EPOCHS:
+        epoch = state['iteration']
+        lr = SGD_LEARNING_RATE/(1.0 + SGD_LR_DECAY*epoch)
+        order = rng.permutation(len(guideset))
+        for start in range(0, len(guideset), SGD_BATCH_SIZE):
+            batch = [guideset[i] for i in order[start:start+SGD_BATCH_SIZE]]
+            _, jac, Qs = computeBatchObjective(theta, guideset, batch, sample_names, feature_columns, REG_CONST, I1_REG_CONST)
+            jac = jac/len(Qs)
+            if SGD_OPTIMIZER == 'adam':
+                t += 1
+                m = ADAM_BETA1*m + (1.0-ADAM_BETA1)*jac
+                v = ADAM_BETA2*v + (1.0-ADAM_BETA2)*jac**2.0
+                steps = lr/(np.sqrt(v/(1.0-ADAM_BETA2**t)) + ADAM_EPS)
+                theta = theta - lr*(m/(1.0-ADAM_BETA1**t))/(np.sqrt(v/(1.0-ADAM_BETA2**t)) + ADAM_EPS)
+            else:
+                steps = lr
+                theta = theta - lr*jac
+            if L1_REG_CONST > 0: theta = softThreshold(theta, steps*L1_REG_CONST)
+        state.update({'theta': theta, 'm': m, 'v': v, 't': t, 'iteration': epoch+1})
+        if (epoch+1) % SGD_EVAL_EPOCHS == 0 or epoch == SGD_NUM_EPOCHS-1:
+            printAndFlush('Epoch %d (learning rate %e)' % (epoch+1, lr))
+            Q, full_jac, _ = assessFit(theta, guideset, sample_names, feature_columns, cv_idx, REG_CONST, I1_REG_CONST)
+            state['trace'] = [x for x in state['trace']] + [Q]
+            if checkpoint_file is not None: logProgress(getProgressLogFile(cv_idx), epoch+1, Q, full_jac, start_time)
+        if checkpoint_file is not None and ((epoch+1) % CHECKPOINT_EVERY == 0 or epoch == SGD_NUM_EPOCHS-1):
+            state.update(getRNGState(rng))
+            writeCheckpoint(checkpoint_file, state)
+    return theta
+
+def trainRegularisationPath(guideset, sample_names, feature_columns, reg_pairs, theta0=None, cv_idx=0, on_trained=None):
+    #Trains a model for each (reg_const, i1_reg_const) in reg_pairs, from most to least regularised, starting each
+    #from the previous solution. Calls on_trained(reg_const, i1_reg_const, theta, num_evaluations) after each, and
+    #returns [(reg_const, i1_reg_const, theta)]
+    reg_pairs = sorted(reg_pairs, key=lambda x: (-x[0], -x[1]))
+    prev_reg_consts, checkpoint_prefix, results, theta = (REG_CONST, I1_REG_CONST), CHECKPOINT_PREFIX, [], theta0
+    try:
+        for reg_const, i1_reg_const in reg_pairs:
+            setRegConst(reg_const); setI1RegConst(i1_reg_const)
+            if checkpoint_prefix is not None: setCheckpointPrefix(checkpoint_prefix + '_%.8f_%.8f' % (reg_const, i1_reg_const))
+            printAndFlush('Regularisation path: Lambda=%e I1_Lambda=%e' % (reg_const, i1_reg_const))
+            num_evals = getNumEvaluations()
+            theta = trainModelParallel(guideset, sample_names, feature_columns, theta, cv_idx=cv_idx)
+            results.append((reg_const, i1_reg_const, theta))
+            if on_trained is not None: on_trained(reg_const, i1_reg_const, theta, getNumEvaluations() - num_evals)
+    finally:
+        setRegConst(prev_reg_consts[0]); setI1RegConst(prev_reg_consts[1])
+        setCheckpointPrefix(checkpoint_prefix)
+    return results
+
+def trainModelMPI(guideset, sample_names, feature_columns, theta0, cv_idx=0):
     
     guidesubsets = [guideset[i:len(guideset):mpi_size] for i in range(mpi_size)]
     if theta0 is None: theta0 = np.array([np.random.normal(loc=0.0, scale=1.0) for x in feature_columns])
     args=(guidesubsets[mpi_rank], sample_names, feature_columns, cv_idx, REG_CONST, I1_REG_CONST)
+    loadTrainingData(guidesubsets[mpi_rank], sample_names, feature_columns)    #(Load data before optimization)
     if mpi_rank == 0:
-        result = minimize(assessFit, theta0, args=args, method='L-BFGS-B', jac=True, tol=1e-4)
-        theta = result.x
-        printAndFlush("Optimization Result: " + str(result.success))
+        if L1_REG_CONST > 0:
+            state = minimizeOWLQN(assessFit, initLBFGSState(assessFit, theta0, args, L1_REG_CONST), L1_REG_CONST, args=args, tol=1e-4)
+            theta, success = state['theta'], state['converged']
+        else:
+            result = minimize(assessFit, theta0, args=args, method='L-BFGS-B', jac=True, tol=1e-4)
+            theta, success = result.x, result.success
+        printAndFlush("Optimization Result: " + str(success))
         done = True
         theta, done = comm.bcast((theta, done), root=0)
     else:
@@ -197,7 +785,7 @@ def trainModelParallel(guideset, sample_names, feature_columns, theta0, cv_idx=0
 
 def testModelParallel(theta, guideset, sample_names, feature_columns):
     guidesubsets = [guideset[i:len(guideset):mpi_size] for i in range(mpi_size)]
-    assessFit( theta, guidesubsets[mpi_rank], sample_names, feature_columns,reg_const=0.0,i1_reg_const=0.0,test_only=True )
+    return assessFit( theta, guidesubsets[mpi_rank], sample_names, feature_columns,reg_const=0.0,i1_reg_const=0.0,test_only=True )
 
 def recordPredictions(output_dir, theta, guideset, feature_columns ):
     guidesubsets = [guideset[i:len(guideset):mpi_size] for i in range(mpi_size)]
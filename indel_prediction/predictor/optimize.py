@@ -0,0 +1,137 @@
+import numpy as np
+
+#Limited memory BFGS with all optimizer state held in a dict, so that it can be checkpointed and
+#resumed exactly (scipy's L-BFGS-B does not expose its internal history). minimizeOWLQN extends it to
+#objectives with an added L1 penalty (Andrew & Gao 2007), giving exactly zero weights for unused features.
+
+LBFGS_HISTORY = 10
+LBFGS_MAX_ITER = 15000
+ARMIJO_C = 1e-4
+MIN_STEP = 1e-10
+OWLQN_CONVERGENCE_WINDOW = 5    #(Iterations over which the relative reduction in the objective is averaged)
+
+def lbfgsDirection(jac, S, Y):
+    #Two-loop recursion: approximate -H^-1 jac from the recent steps S and gradient changes Y
+    q, alphas = np.array(jac, dtype=float), []
+    for s, y in reversed(list(zip(S, Y))):
+        rho = 1.0/np.dot(y, s)
+        alpha = rho*np.dot(s, q)
+        q -= alpha*y
+        alphas.append((rho, alpha))
+    if len(S) > 0:
+        q *= np.dot(S[-1], Y[-1])/np.dot(Y[-1], Y[-1])
+    for (s, y), (rho, alpha) in zip(zip(S, Y), reversed(alphas)):
+        beta = rho*np.dot(y, q)
+        q += s*(alpha - beta)
+    return -q
+
+def initLBFGSState(fun, theta0, args=(), l1_weights=0.0):
+    Q, jac = fun(np.array(theta0, dtype=float), *args)[:2]
+    return {'theta': np.array(theta0, dtype=float), 'Q': Q, 'jac': np.array(jac, dtype=float), 'S': [], 'Y': [],
+            'iteration': 0, 'trace': [Q + l1Penalty(theta0, l1_weights)], 'converged': False}
+
+def stopAtCurrentPoint(state, S, Y, callback):
+    #Ends the optimization without moving, after a failed line search (no step of at least MIN_STEP reduces the objective)
+    state.update({'S': S, 'Y': Y, 'iteration': state['iteration'] + 1, 'converged': True})
+    state['trace'] = [x for x in state['trace']] + [state['trace'][-1]]
+    if callback is not None: callback(state)
+
+def minimizeLBFGS(fun, state, args=(), tol=1e-4, maxiter=LBFGS_MAX_ITER, callback=None):
+    #fun(theta, *args) returns (objective, gradient, ...). Continues the optimization from state (see initLBFGSState),
+    #calling callback(state) after each iteration, until the relative reduction in the objective or the largest
+    #gradient is below tol. Returns the final state.
+    S, Y = [x for x in state['S']], [x for x in state['Y']]
+    while state['iteration'] < maxiter and not state['converged']:
+        theta, Q, jac = state['theta'], state['Q'], state['jac']
+        if np.max(np.abs(jac)) <= tol:
+            state['converged'] = True
+            break
+
+        p = lbfgsDirection(jac, S, Y)
+        gp = np.dot(jac, p)
+        if gp >= 0:    #(Not a descent direction: restart from steepest descent)
+            S, Y, p = [], [], -jac
+            gp = np.dot(jac, p)
+        step = 1.0 if len(S) > 0 else min(1.0, 1.0/np.sqrt(np.dot(jac, jac)))
+        while True:
+            new_theta = theta + step*p
+            new_Q, new_jac = fun(new_theta, *args)[:2]
+            accepted = new_Q <= Q + ARMIJO_C*step*gp
+            if accepted or step < MIN_STEP: break
+            step *= 0.5
+        if not accepted:    #(Line search failed: stop at the current point)
+            stopAtCurrentPoint(state, S, Y, callback)
+            break
+
+        s, y = new_theta - theta, np.array(new_jac, dtype=float) - jac
+        if np.dot(s, y) > 1e-10:
+            S.append(s); Y.append(y)
+            if len(S) > LBFGS_HISTORY: S, Y = S[1:], Y[1:]
+        state.update({'theta': new_theta, 'Q': new_Q, 'jac': np.array(new_jac, dtype=float), 'S': S, 'Y': Y, 'iteration': state['iteration'] + 1})
+        state['trace'] = [x for x in state['trace']] + [new_Q]
+        state['converged'] = (Q - new_Q) <= tol*max(abs(Q), abs(new_Q), 1.0)
+        if callback is not None: callback(state)
+    return state
+
+def l1Penalty(theta, l1_weights):
+    return np.dot(np.zeros(len(theta)) + l1_weights, np.abs(theta))
+
+def pseudoGradient(theta, jac, l1_weights):
+    #Steepest descent direction (negated) of f + sum(l1_weights*abs(theta)), given the gradient jac of f
+    l1_weights = np.zeros(len(theta)) + l1_weights
+    pg = jac + np.sign(theta)*l1_weights
+    at_zero = (theta == 0)
+    pg[at_zero] = np.where(jac[at_zero] + l1_weights[at_zero] < 0, jac[at_zero] + l1_weights[at_zero],
+                           np.where(jac[at_zero] - l1_weights[at_zero] > 0, jac[at_zero] - l1_weights[at_zero], 0.0))
+    return pg
+
+def softThreshold(theta, thresholds):
+    #Proximal operator of sum(thresholds*abs(theta))
+    return np.sign(theta)*np.maximum(np.abs(theta) - thresholds, 0.0)
+
+def minimizeOWLQN(fun, state, l1_weights, args=(), tol=1e-4, maxiter=LBFGS_MAX_ITER, callback=None):
+    #As minimizeLBFGS, for fun(theta, *args) + sum(l1_weights*abs(theta)), where fun returns the smooth part (and its
+    #gradient): the L-BFGS direction is computed from the pseudo-gradient and each step is kept within the orthant
+    #it starts in, with weights that would change sign set to zero. state['Q'] and state['jac'] hold the smooth
+    #part, state['trace'] the full objective. Since the reduction per iteration varies more than for L-BFGS, convergence
+    #is on the reduction averaged over the last OWLQN_CONVERGENCE_WINDOW iterations.
+    S, Y = [x for x in state['S']], [x for x in state['Y']]
+    while state['iteration'] < maxiter and not state['converged']:
+        theta, Q, jac = state['theta'], state['Q'], state['jac']
+        full_Q = Q + l1Penalty(theta, l1_weights)
+        pg = pseudoGradient(theta, jac, l1_weights)
+        if np.max(np.abs(pg)) <= tol:
+            state['converged'] = True
+            break
+
+        p = lbfgsDirection(pg, S, Y)
+        p[p*pg >= 0] = 0.0
+        gp = np.dot(pg, p)
+        if gp >= 0:    #(Not a descent direction: restart from steepest descent)
+            S, Y, p = [], [], -pg
+            gp = np.dot(pg, p)
+        orthant = np.where(theta != 0, np.sign(theta), -np.sign(pg))
+        step = 1.0 if len(S) > 0 else min(1.0, 1.0/np.sqrt(np.dot(pg, pg)))
+        while True:
+            new_theta = theta + step*p
+            new_theta[np.sign(new_theta) != orthant] = 0.0
+            new_Q, new_jac = fun(new_theta, *args)[:2]
+            new_full_Q = new_Q + l1Penalty(new_theta, l1_weights)
+            accepted = new_full_Q <= full_Q + ARMIJO_C*np.dot(pg, new_theta - theta)
+            if accepted or step < MIN_STEP: break
+            step *= 0.5
+        if not accepted:    #(Line search failed: stop at the current point)
+            stopAtCurrentPoint(state, S, Y, callback)
+            break
+
+        s, y = new_theta - theta, np.array(new_jac, dtype=float) - jac
+        if np.dot(s, y) > 1e-10:
+            S.append(s); Y.append(y)
+            if len(S) > LBFGS_HISTORY: S, Y = S[1:], Y[1:]
+        state.update({'theta': new_theta, 'Q': new_Q, 'jac': np.array(new_jac, dtype=float), 'S': S, 'Y': Y, 'iteration': state['iteration'] + 1})
+        state['trace'] = [x for x in state['trace']] + [new_full_Q]
+        window = min(OWLQN_CONVERGENCE_WINDOW, len(state['trace']) - 1)
+        prev_Q = state['trace'][-1-window]
+        state['converged'] = (prev_Q - new_full_Q)/window <= tol*max(abs(prev_Q), abs(new_full_Q), 1.0)
+        if callback is not None: callback(state)
+    return state
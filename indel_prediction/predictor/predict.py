@@ -1,13 +1,19 @@
+import collections
 import csv
+import hashlib
 import io
 import os
 import random
 import subprocess
+import tempfile
+from multiprocessing import Pool
 
 import numpy as np
-from predictor.features import calculateFeaturesForGenIndelFile, readFeaturesData
-from predictor.model import computePredictedProfile, readTheta
+from predictor.features import calculateFeaturesForGenIndelFile, calculateFeaturesForGenIndels, readFeaturesData
+from predictor.indelgen import generateAllIndels, trimTarget, InvalidTargetError
+from predictor.model import computePredictedProfile, loadModel
 from selftarget.indel import tokFullIndel
+from selftarget.parse import parseInt, parseFloat, parseIndelLocs
 from selftarget.plot import setFigType
 from selftarget.profile import fetchIndelSizeCounts, getProfileCounts, fetchReads, FRAME_SHIFT
 from selftarget.view import plotProfiles
@@ -15,16 +21,298 @@ from selftarget.view import plotProfiles
 INDELGENTARGET_EXE = os.getenv("INDELGENTARGET_EXE", "C:/Users/fa9/postdoc/indelmap/build/Release/indelgentarget.exe")
 DEFAULT_MODEL = 'model_output_10000_0.01000000_0.01000000_-0.607_theta.txt_cf0.txt' 
 
+
+#Set USE_INDELGENTARGET_EXE=1 to generate the candidate indels with the indelgentarget binary rather than
+#predictor.indelgen (which gives the same output, see tests.py)
+USE_INDELGENTARGET_EXE = os.getenv('USE_INDELGENTARGET_EXE', '0') == '1'
+
+#Set PREDICT_VIA_FILES=1 to run predictions through the (slower) tmp genindels and features files,
+#e.g. to inspect them when debugging, rather than in memory
+PREDICT_VIA_FILES = os.getenv('PREDICT_VIA_FILES', '0') == '1'
+
+#Set PRUNE_FEATURES_TOL to compute only the features whose theta is larger than this in absolute value (e.g. 0 for
+#the non-zero features of a sparse model), and VERIFY_PRUNED_FEATURES=1 to check each such prediction against one from
+#all the features (raising an exception if any predicted count differs by more than PRUNED_VERIFY_TOL)
+PRUNE_FEATURES_TOL = parseFloat(os.getenv('PRUNE_FEATURES_TOL')) if os.getenv('PRUNE_FEATURES_TOL') else None
+VERIFY_PRUNED_FEATURES = os.getenv('VERIFY_PRUNED_FEATURES', '0') == '1'
+PRUNED_VERIFY_TOL = 1e-6
+
+#Number of worker processes generating indels ahead of feature computation and scoring in bulk
+#prediction (0: generate in the calling process), and the number of targets sent to a worker at once
+INDELGEN_WORKERS = int(os.getenv('INDELGEN_WORKERS', '0'))
+INDELGEN_BATCH_SIZE = 64
+
+#Cache of predicted (profile, rep reads, in frame percentage), keyed by model hash, target, PAM index and the
+#settings that affect the result: an LRU of PREDICTION_CACHE_SIZE entries in each process, backed if PREDICTION_CACHE_DIR
+#is set by a store of one file per prediction (named by the key) shared by all processes using that directory, e.g. the
+#web server and the command line. Once the store exceeds PREDICTION_CACHE_MAX_MB, the least recently used files are
+#removed until it is below PREDICTION_CACHE_EVICT_TO of that size
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '1000'))
+PREDICTION_CACHE_DIR = os.getenv('PREDICTION_CACHE_DIR') or None
+PREDICTION_CACHE_MAX_MB = parseFloat(os.getenv('PREDICTION_CACHE_MAX_MB', '1000'))
+PREDICTION_CACHE_EVICT_TO = 0.8
+PREDICTION_CACHE_VERSION = 1    #(Change if the predictions, or their format in the store, change)
+_prediction_cache = collections.OrderedDict()
+_prediction_cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'disk_bytes': None}
+
 def setIndelGenTargetExeLoc(val):
     global INDELGENTARGET_EXE
     INDELGENTARGET_EXE = val
 
+def setUseIndelGenTargetExe(val):
+    global USE_INDELGENTARGET_EXE
+    USE_INDELGENTARGET_EXE = val
+
+def setPredictViaFiles(val):
+    global PREDICT_VIA_FILES
+    PREDICT_VIA_FILES = val
+
+def setPruneFeatures(tol, verify=False):
+    #tol=None computes all features
+    global PRUNE_FEATURES_TOL, VERIFY_PRUNED_FEATURES
+    PRUNE_FEATURES_TOL, VERIFY_PRUNED_FEATURES = tol, verify
+
+def getPredictSettings():
+    #Module settings, to pass on to worker processes (see applyPredictSettings)
+    return {'use_exe': USE_INDELGENTARGET_EXE, 'exe_loc': INDELGENTARGET_EXE, 'via_files': PREDICT_VIA_FILES,
+            'prune_tol': PRUNE_FEATURES_TOL, 'verify_pruned': VERIFY_PRUNED_FEATURES}
+
+def applyPredictSettings(settings):
+    setUseIndelGenTargetExe(settings['use_exe']); setIndelGenTargetExeLoc(settings['exe_loc']); setPredictViaFiles(settings['via_files'])
+    setPruneFeatures(settings['prune_tol'], settings['verify_pruned'])
+
+def setIndelGenWorkers(num_workers, batch_size=None):
+    global INDELGEN_WORKERS, INDELGEN_BATCH_SIZE
+    INDELGEN_WORKERS = num_workers
+    if batch_size is not None: INDELGEN_BATCH_SIZE = batch_size
+
+def setPredictionCacheSize(size):
+    global PREDICTION_CACHE_SIZE
+    PREDICTION_CACHE_SIZE = size
+    while len(_prediction_cache) > PREDICTION_CACHE_SIZE:
+        _prediction_cache.popitem(last=False)
+
+def setPredictionCacheDir(cache_dir, max_mb=None):
+    #cache_dir=None keeps the cache in memory only
+    global PREDICTION_CACHE_DIR, PREDICTION_CACHE_MAX_MB
+    PREDICTION_CACHE_DIR = cache_dir
+    if max_mb is not None: PREDICTION_CACHE_MAX_MB = max_mb
+    _prediction_cache_stats['disk_bytes'] = None
+
+def clearPredictionCache():
+    #Clears the in-memory cache and the statistics (not the store in PREDICTION_CACHE_DIR)
+    _prediction_cache.clear()
+    _prediction_cache_stats.update({'hits': 0, 'disk_hits': 0, 'misses': 0, 'disk_bytes': None})
+
+def getPredictionCacheStats():
+    return {'hits': _prediction_cache_stats['hits'], 'disk_hits': _prediction_cache_stats['disk_hits'], 'misses': _prediction_cache_stats['misses'],
+            'size': len(_prediction_cache), 'max_size': PREDICTION_CACHE_SIZE}
+
+def usePredictionCache():
+    #(Not when debugging through files, or verifying pruned predictions, which need the predictions to be made)
+    return (PREDICTION_CACHE_SIZE > 0 or PREDICTION_CACHE_DIR is not None) and not PREDICT_VIA_FILES and not VERIFY_PRUNED_FEATURES
+
+def getPredictionCacheKey(model, target_seq, pam_idx, add_null=True):
+    key_str = '%d\t%s\t%s\t%d\t%s\t%r' % (PREDICTION_CACHE_VERSION, model.model_hash, target_seq, pam_idx, add_null, PRUNE_FEATURES_TOL)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+def _getPredictionCacheFile(key):
+    return os.path.join(PREDICTION_CACHE_DIR, key[:2], key + '.npz')
+
+def _listPredictionCacheFiles():
+    #[(last used time, size, filename)] for the store in PREDICTION_CACHE_DIR
+    files = []
+    for dirpath, _, filenames in os.walk(PREDICTION_CACHE_DIR):
+        for filename in filenames:
+            if not filename.endswith('.npz'): continue
+            try:
+                st = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue    #(Removed by another process)
+            files.append((st.st_mtime, st.st_size, os.path.join(dirpath, filename)))
+    return files
+
+def _evictPredictionCacheFiles():
+    #Removes the least recently used files until the store is below PREDICTION_CACHE_EVICT_TO of PREDICTION_CACHE_MAX_MB
+    files = sorted(_listPredictionCacheFiles())
+    total, target = sum([x[1] for x in files]), PREDICTION_CACHE_EVICT_TO*PREDICTION_CACHE_MAX_MB*1e6
+    for _, size, filename in files:
+        if total <= target: break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+    _prediction_cache_stats['disk_bytes'] = total
+
+def _readPredictionCacheFile(filename):
+    try:
+        f = np.load(filename)
+        profile = {x.decode('ascii'): float(y) for x, y in zip(f['indels'], f['counts'])}
+        rep_reads = {x.decode('ascii'): y.decode('ascii') for x, y in zip(f['rep_read_indels'], f['rep_reads'])}
+        result = (profile, rep_reads, float(f['in_frame']))
+        f.close()
+    except (OSError, IOError, KeyError, ValueError):
+        return None    #(Missing, evicted or partly written by an older version)
+    try:
+        os.utime(filename)    #(Marks it as recently used, for eviction)
+    except OSError:
+        pass
+    return result
+
+def _writePredictionCacheFile(filename, result):
+    profile, rep_reads, in_frame = result
+    if not os.path.isdir(os.path.dirname(filename)): os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + '.tmp%d' % os.getpid()
+    fout = io.open(tmp_filename, 'wb')
+    np.savez_compressed(fout, indels=np.array(list(profile.keys()), dtype='S'), counts=np.array(list(profile.values()), dtype=float),
+                        rep_read_indels=np.array(list(rep_reads.keys()), dtype='S'), rep_reads=np.array(list(rep_reads.values()), dtype='S'), in_frame=np.array(in_frame))
+    fout.close()
+    os.replace(tmp_filename, filename)
+    if _prediction_cache_stats['disk_bytes'] is None:
+        _prediction_cache_stats['disk_bytes'] = sum([x[1] for x in _listPredictionCacheFiles()])
+    else:
+        _prediction_cache_stats['disk_bytes'] += os.path.getsize(filename)
+    if _prediction_cache_stats['disk_bytes'] > PREDICTION_CACHE_MAX_MB*1e6:
+        _evictPredictionCacheFiles()
+
+def _storeMemoryPredictionCache(key, result):
+    if PREDICTION_CACHE_SIZE <= 0: return
+    _prediction_cache[key] = result
+    _prediction_cache.move_to_end(key)
+    while len(_prediction_cache) > PREDICTION_CACHE_SIZE:
+        _prediction_cache.popitem(last=False)
+
+def lookupPredictionCache(key):
+    #Cached (profile, rep_reads, in_frame) for key (see getPredictionCacheKey), or None. The result is a copy that
+    #the caller may modify
+    if key in _prediction_cache:
+        _prediction_cache_stats['hits'] += 1
+        _prediction_cache.move_to_end(key)
+        result = _prediction_cache[key]
+    elif PREDICTION_CACHE_DIR is not None and os.path.isfile(_getPredictionCacheFile(key)):
+        result = _readPredictionCacheFile(_getPredictionCacheFile(key))
+        if result is None:
+            _prediction_cache_stats['misses'] += 1
+            return None
+        _prediction_cache_stats['disk_hits'] += 1
+        _storeMemoryPredictionCache(key, result)
+    else:
+        _prediction_cache_stats['misses'] += 1
+        return None
+    profile, rep_reads, in_frame = result
+    return dict(profile), dict(rep_reads), in_frame
+
+def storePredictionCache(key, result):
+    profile, rep_reads, in_frame = result
+    result = (dict(profile), dict(rep_reads), in_frame)    #(Kept apart from the caller's copy)
+    _storeMemoryPredictionCache(key, result)
+    if PREDICTION_CACHE_DIR is not None:
+        _writePredictionCacheFile(_getPredictionCacheFile(key), result)
+
 def fetchRepReads(genindels_file):
     f = io.open(genindels_file)
     rep_reads = {toks[0]:toks[-1] for toks in csv.reader(f, delimiter='\t') if 'Git' not in toks[0]}
     f.close()
     return rep_reads
 
+def parseGeneratedIndels(lines):
+    #Lines of indelgentarget output -> ({indel: [(left, right, ins_seq),...]}, {indel: rep_read})
+    gen_indels, rep_reads = {}, {}
+    for toks in csv.reader(lines, delimiter='\t'):
+        if len(toks) == 0 or 'Git' in toks[0]: continue
+        gen_indels[toks[0]] = parseIndelLocs(toks[2])
+        rep_reads[toks[0]] = toks[-1]
+    return gen_indels, rep_reads
+
+def generateIndels(target_seq, pam_idx):
+    #Raises InvalidTargetError for targets that cannot be predicted. Targets containing N are generated by the
+    #binary where it is available, since predictor.indelgen does not handle them
+    seq = trimTarget(target_seq, pam_idx)[0]
+    if not USE_INDELGENTARGET_EXE and ('N' not in seq or not os.path.isfile(INDELGENTARGET_EXE)):
+        return generateAllIndels(target_seq, pam_idx)
+
+    #Run indelgentarget, reading its output directly from the pipe where possible (else via a tmp file)
+    if os.path.exists('/dev/stdout'):
+        output = subprocess.check_output([INDELGENTARGET_EXE, target_seq, '%d' % pam_idx, '/dev/stdout'])
+    else:
+        fd, tmp_genindels_file = tempfile.mkstemp(prefix='tmp_genindels_', suffix='.txt')
+        os.close(fd)
+        try:
+            subprocess.check_call([INDELGENTARGET_EXE, target_seq, '%d' % pam_idx, tmp_genindels_file])
+            f = io.open(tmp_genindels_file, 'rb'); output = f.read(); f.close()
+        finally:
+            os.remove(tmp_genindels_file)
+    return parseGeneratedIndels(output.decode('ascii').splitlines())
+
+def imapBounded(pool, func, items, batch_size, max_pending):
+    #Applies func (on a list of items -> list of results) to batches of items on the pool, yielding
+    #(item, result) in input order, with at most max_pending batches in flight so that items are read,
+    #and results held, incrementally
+    pending, batch = collections.deque(), []
+    def collect():
+        batch, result = pending.popleft()
+        return zip(batch, result.get())
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            pending.append((batch, pool.apply_async(func, (batch,)))); batch = []
+            if len(pending) >= max_pending:
+                for x in collect(): yield x
+    if len(batch) > 0: pending.append((batch, pool.apply_async(func, (batch,))))
+    while len(pending) > 0:
+        for x in collect(): yield x
+
+def _initIndelGenWorker(settings):
+    applyPredictSettings(settings)
+
+def generateIndelsOrError(target_seq, pam_idx):
+    #(gen_indels, rep_reads), or (None, the InvalidTargetError) for a target that cannot be predicted
+    try:
+        return generateIndels(target_seq, pam_idx)
+    except InvalidTargetError as e:
+        return None, e
+
+def generateIndelsBatch(targets):
+    return [generateIndelsOrError(target_seq, pam_idx) for (_, target_seq, pam_idx) in targets]
+
+class IndelGeneratorPool:
+    #Long-lived worker processes generating the indels for batches of targets, so that generation (and with
+    #USE_INDELGENTARGET_EXE, the process spawns) overlaps with the feature computation and scoring of earlier
+    #targets in the calling process
+
+    def __init__(self, num_workers=None, batch_size=None):
+        self.num_workers = num_workers if num_workers is not None else INDELGEN_WORKERS
+        self.batch_size = batch_size if batch_size is not None else INDELGEN_BATCH_SIZE
+        self.pool = Pool(processes=self.num_workers, initializer=_initIndelGenWorker, initargs=(getPredictSettings(),))
+
+    def generate(self, targets):
+        #targets: iterable of (guide_id, target_seq, pam_idx). Yields (target, gen_indels, rep_reads) in input order
+        #(with gen_indels None and rep_reads the InvalidTargetError for targets that cannot be predicted)
+        for target, (gen_indels, rep_reads) in imapBounded(self.pool, generateIndelsBatch, targets, self.batch_size, 2*self.num_workers):
+            yield target, gen_indels, rep_reads
+
+    def close(self):
+        self.pool.close(); self.pool.join()
+
+def generateIndelsForTargets(targets):
+    #As IndelGeneratorPool.generate, using a pool of INDELGEN_WORKERS processes if set
+    if INDELGEN_WORKERS <= 0:
+        for target in targets:
+            yield (target,) + generateIndelsOrError(target[1], target[2])
+        return
+    pool = IndelGeneratorPool()
+    try:
+        for x in pool.generate(targets): yield x
+    finally:
+        pool.close()
+
+def getLeftTrim(target_seq, rep_reads):
+    left_trim = 0
+    isize, smallest_indel = min([(tokFullIndel(x)[1],x) for x in rep_reads]) if len(rep_reads) > 0 else (0,'-') 
+    if isize > 0: left_trim = target_seq.find(rep_reads[smallest_indel][:10])
+    return left_trim
+
 def writePredictedProfileToSummary(p1, fout):
     counts = getProfileCounts(p1)
     for cnt,indel,_,_ in counts:
@@ -41,16 +329,50 @@ def writePredictedRepReadsToFile(p1, rep_reads, fout):
         
 def predictMutations(theta_file, target_seq, pam_idx, add_null=True):
 
-    theta, train_set, theta_feature_columns = readTheta(theta_file)
+    model = loadModel(theta_file)
+
+    key = getPredictionCacheKey(model, target_seq, pam_idx, add_null) if usePredictionCache() else None
+    result = lookupPredictionCache(key) if key is not None else None
+    if result is not None:
+        return result
+
+    if PREDICT_VIA_FILES:
+        result = predictMutationsViaFiles(model, target_seq, pam_idx, add_null=add_null)
+    else:
+        gen_indels, rep_reads = generateIndels(target_seq, pam_idx)
+        result = predictMutationsForGenIndels(model, target_seq, pam_idx, gen_indels, rep_reads, add_null=add_null)
+    if key is not None: storePredictionCache(key, result)
+    return result
+
+def predictMutationsForGenIndels(model, target_seq, pam_idx, gen_indels, rep_reads, add_null=True):
+    #compute features for the generated indels
+    if PRUNE_FEATURES_TOL is not None:
+        engine, pruned_theta = model.getPrunedFeatureEngine(PRUNE_FEATURES_TOL)
+        full_result = predictMutationsForGenIndelsAllFeatures(model, target_seq, pam_idx, gen_indels, dict(rep_reads), add_null) if VERIFY_PRUNED_FEATURES else None
+        indels, feature_data = engine.calculateFeaturesForGenIndels(gen_indels, target_seq, pam_idx-3)
+        result = finishPrediction(indels, feature_data, pruned_theta, None, rep_reads, target_seq, add_null)
+        if full_result is not None: verifyPrunedPrediction(result, full_result, target_seq, pam_idx)
+        return result
+    return predictMutationsForGenIndelsAllFeatures(model, target_seq, pam_idx, gen_indels, rep_reads, add_null)
+
+def predictMutationsForGenIndelsAllFeatures(model, target_seq, pam_idx, gen_indels, rep_reads, add_null=True):
+    #(theta for the feature engine's columns is cached on the model, so no columns need selecting)
+    indels, feature_data, feature_columns = calculateFeaturesForGenIndels(gen_indels, target_seq, pam_idx-3)
+    return finishPrediction(indels, feature_data, model.getThetaForColumns(feature_columns), feature_columns, rep_reads, target_seq, add_null)
+
+def verifyPrunedPrediction(result, full_result, target_seq, pam_idx):
+    p_predict, full_p_predict = result[0], full_result[0]
+    max_diff = max([abs(p_predict[x] - full_p_predict[x]) for x in full_p_predict]) if set(p_predict) == set(full_p_predict) else np.inf
+    if max_diff > PRUNED_VERIFY_TOL:
+        raise Exception('Pruned features changed the predicted profile for %s %d (max count difference %e, in frame %.3f vs %.3f)' % (target_seq, pam_idx, max_diff, result[2], full_result[2]))
+
+def predictMutationsViaFiles(model, target_seq, pam_idx, add_null=True):
 
     #generate indels
-    left_trim = 0
     tmp_genindels_file = 'tmp_genindels_%d.txt' % (random.randint(0,100000))
     cmd = INDELGENTARGET_EXE + ' %s %d %s' % (target_seq, pam_idx, tmp_genindels_file)
     print(cmd); subprocess.check_call(cmd.split())
     rep_reads = fetchRepReads(tmp_genindels_file)
-    isize, smallest_indel = min([(tokFullIndel(x)[1],x) for x in rep_reads]) if len(rep_reads) > 0 else (0,'-') 
-    if isize > 0: left_trim = target_seq.find(rep_reads[smallest_indel][:10])
 
     #compute features for all generated indels
     tmp_features_file = 'tmp_features_%d.txt' % (random.randint(0,100000))
@@ -59,15 +381,16 @@ def predictMutations(theta_file, target_seq, pam_idx, add_null=True):
     feature_data, feature_columns = readFeaturesData(tmp_features_file)
     os.remove(tmp_features_file)
 
-    if len(set(theta_feature_columns).difference(set(feature_columns))) != 0:
+    if len(set(model.feature_columns).difference(set(feature_columns))) != 0:
         raise Exception('Stored feature names associated with model thetas are not contained in those computed')
+    indels, feature_data = [x for x in feature_data['Indel']], feature_data[model.feature_columns].values.astype(float)
+    return finishPrediction(indels, feature_data, model.theta, model.feature_columns, rep_reads, target_seq, add_null)
 
-    if len(set(theta_feature_columns).union(set(feature_columns))) != len(theta_feature_columns):
-        feature_data = feature_data[['Indel'] + theta_feature_columns]
-        feature_columns = theta_feature_columns
+def finishPrediction(indels, feature_data, theta, feature_columns, rep_reads, target_seq, add_null=True):
+    left_trim = getLeftTrim(target_seq, rep_reads)
 
     #Predict the profile
-    p_predict, _ = computePredictedProfile(feature_data, theta, theta_feature_columns)
+    p_predict, _ = computePredictedProfile((indels, feature_data), theta, feature_columns)
     in_frame, out_frame, _ = fetchIndelSizeCounts(p_predict)
     in_frame_perc = in_frame*100.0/(in_frame + out_frame)
     if add_null:
@@ -109,21 +432,111 @@ def plot_predictions(theta_file, target_seq, pam_idx, out_filename=None):
     fig = plotProfiles([profile], [rep_reads], [pam_idx], [False], ['Predicted'], title='In Frame: %.1f%%' % in_frame)
     return fig
 
-def predictProfilesBulk(theta_file, target_file):
-    #Target File: a tab-delimited file with columns:  ID, Target, PAM Index
-    profiles_and_rr = []
+def readTargetFile(target_file):
+    #Target File: a tab-delimited file with columns:  ID, Target, PAM Index. Yields (ID, Target, PAM Index)
     f = io.open(target_file)
     for row in csv.DictReader(f, delimiter='\t'):
-        prof, rep_reads, in_frame = predictMutations(theta_file, row['Target'], eval(row['PAM Index']))
-        profiles_and_rr.append((row['ID'], prof, rep_reads, in_frame))
+        yield row['ID'], row['Target'], parseInt(row['PAM Index'])
     f.close()
-    return profiles_and_rr
-            
+
+_worker_model = None
+
+def _initPredictWorker(theta_file, settings):
+    global _worker_model
+    applyPredictSettings(settings)
+    _worker_model = loadModel(theta_file)
+
+def predictTargetsBatch(targets):
+    results = []
+    for guide_id, target_seq, pam_idx in targets:
+        if PREDICT_VIA_FILES:
+            results.append(predictMutationsViaFiles(_worker_model, target_seq, pam_idx))
+        else:
+            gen_indels, rep_reads = generateIndelsOrError(target_seq, pam_idx)
+            results.append(predictMutationsOrError(_worker_model, target_seq, pam_idx, gen_indels, rep_reads))
+    return results
+
+def predictMutationsOrError(model, target_seq, pam_idx, gen_indels, rep_reads):
+    #As predictMutationsForGenIndels, passing on the InvalidTargetError from generateIndelsOrError (in rep_reads)
+    if gen_indels is None: return rep_reads
+    return predictMutationsForGenIndels(model, target_seq, pam_idx, gen_indels, rep_reads)
+
+def mergeCachedPredictions(targets, lookup, predict_misses):
+    #Yields (target, result) for each target in input order, with result = lookup(target) where that is not None, and
+    #otherwise from predict_misses, which is given an iterable of the remaining targets and yields (target, result)
+    #for them in order (possibly reading ahead of the results it has yielded)
+    looked_up = collections.deque()
+    def misses():
+        for target in targets:
+            result = lookup(target)
+            looked_up.append((target, result))
+            if result is None: yield target
+    predicted, next_predicted = predict_misses(misses()), None
+    while True:
+        if len(looked_up) == 0:
+            next_predicted = next(predicted, None)    #(Reads targets up to and including the next miss)
+            if len(looked_up) == 0: return
+        target, result = looked_up.popleft()
+        if result is None:
+            if next_predicted is None: next_predicted = next(predicted)
+            result, next_predicted = next_predicted[1], None
+        yield target, result
+
+def iterPredictedProfiles(theta_file, targets, jobs=1, batch_size=8, skipped=None):
+    #Yields (guide_id, profile, rep_reads, in_frame) for each (guide_id, target_seq, pam_idx) in targets, in input
+    #order. With jobs > 1, the guides are predicted on that many worker processes (each reading the model once).
+    #Guides in the prediction cache are not predicted again, and new predictions are added to it. Guides that cannot
+    #be predicted (see InvalidTargetError) are reported, and added to skipped as (guide_id, reason) if given
+    if usePredictionCache():
+        model = loadModel(theta_file)
+        lookup = lambda target: lookupPredictionCache(getPredictionCacheKey(model, target[1], target[2]))
+        def predictMisses(miss_targets):
+            for target, result in _iterPredictedProfiles(theta_file, miss_targets, jobs, batch_size):
+                if not isinstance(result, InvalidTargetError):
+                    storePredictionCache(getPredictionCacheKey(model, target[1], target[2]), result)
+                yield target, result
+        predicted = mergeCachedPredictions(targets, lookup, predictMisses)
+    else:
+        predicted = _iterPredictedProfiles(theta_file, targets, jobs, batch_size)
+    for (guide_id, _, _), result in predicted:
+        if isinstance(result, InvalidTargetError):
+            print('Skipping %s: %s' % (guide_id, result))
+            if skipped is not None: skipped.append((guide_id, str(result)))
+            continue
+        prof, rep_reads, in_frame = result
+        yield guide_id, prof, rep_reads, in_frame
+
+def _iterPredictedProfiles(theta_file, targets, jobs=1, batch_size=8):
+    #Yields (target, (profile, rep_reads, in_frame) or InvalidTargetError) for each target, as iterPredictedProfiles
+    #without the cache
+    pool = None
+    if jobs > 1:
+        pool = Pool(processes=jobs, initializer=_initPredictWorker, initargs=(theta_file, getPredictSettings()))
+        predicted = imapBounded(pool, predictTargetsBatch, targets, batch_size, 2*jobs)
+    elif PREDICT_VIA_FILES:
+        model = loadModel(theta_file)
+        predicted = ((target, predictMutationsViaFiles(model, target[1], target[2])) for target in targets)
+    else:
+        model = loadModel(theta_file)
+        predicted = ((target, predictMutationsOrError(model, target[1], target[2], gen_indels, rep_reads))
+                     for target, gen_indels, rep_reads in generateIndelsForTargets(targets))
+    try:
+        for target, result in predicted:
+            yield target, result
+    finally:
+        if pool is not None: pool.close(); pool.join()
+
+def predictProfilesBulk(theta_file, target_file, jobs=1, skipped=None):
+    #Target File: a tab-delimited file with columns:  ID, Target, PAM Index
+    return list(iterPredictedProfiles(theta_file, readTargetFile(target_file), jobs=jobs, skipped=skipped))
+
 def writeProfilesToFile(out_prefix, profiles_and_rr, write_rr = False):
+    #profiles_and_rr: list or iterable of (guide_id, prof, rep_reads, in_frame), written as it is read
+    #(guide ids are written if there is more than one profile). Returns the number of profiles written
     fout = io.open(out_prefix + '_predictedindelsummary.txt', 'w')
     if write_rr: fout_rr = io.open(out_prefix + '_predictedreads.txt', 'w')
-    for (guide_id, prof, rep_reads, in_frame) in profiles_and_rr:
-        if len(profiles_and_rr) > 1: 
+    def writeProfile(guide_id, prof, rep_reads, in_frame, write_id):
+        if write_id: 
             id_str = u'@@@%s\t%.3f\n' % (guide_id, in_frame)
             fout.write(id_str)
             if write_rr: 
@@ -131,7 +544,18 @@ def writeProfilesToFile(out_prefix, profiles_and_rr, write_rr = False):
         writePredictedProfileToSummary(prof, fout)
         if write_rr: 
             writePredictedRepReadsToFile(prof, rep_reads, fout_rr)
+    num_written, first = 0, None
+    for profile_and_rr in profiles_and_rr:
+        if num_written == 0:
+            first = profile_and_rr    #(held until it is known whether there is more than one)
+        else:
+            if first is not None: writeProfile(*first, write_id=True); first = None
+            writeProfile(*profile_and_rr, write_id=True)
+        num_written += 1
+    if first is not None: writeProfile(*first, write_id=False)
     fout.close()
+    if write_rr: fout_rr.close()
+    return num_written
 
 def predictMutationsSingle(target_seq, pam_idx, out_prefix, theta_file = DEFAULT_MODEL):
     print('Predicting mutations...')
@@ -140,13 +564,15 @@ def predictMutationsSingle(target_seq, pam_idx, out_prefix, theta_file = DEFAULT
     writeProfilesToFile(out_prefix, [('Test Guide', p_predict, rep_reads, in_frame_perc)], write_rr=True)
     print('Done!')
     
-def predictMutationsBulk(target_file, out_prefix, theta_file = DEFAULT_MODEL):
+def predictMutationsBulk(target_file, out_prefix, theta_file = DEFAULT_MODEL, jobs = 1):
     #Target File: a tab-delimited file with columns:  ID, Target, PAM Index
-    print('Predicting mutations...')
-    profiles_and_rr = predictProfilesBulk(theta_file, target_file)
-    print('Writing to file...')
-    writeProfilesToFile(out_prefix, profiles_and_rr, write_rr=True)
-    print('Done!')    
+    #(profiles are written as they are predicted, in the order of the target file, on jobs processes, skipping any
+    #guides that cannot be predicted). Returns [(guide_id, reason)] for the skipped guides
+    print('Predicting mutations and writing to file...')
+    skipped = []
+    num_written = writeProfilesToFile(out_prefix, iterPredictedProfiles(theta_file, readTargetFile(target_file), jobs=jobs, skipped=skipped), write_rr=True)
+    print('Done! (%d guides%s)' % (num_written, ', %d skipped' % len(skipped) if len(skipped) > 0 else ''))
+    return skipped
 
 
 def main():
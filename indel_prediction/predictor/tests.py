@@ -1,4 +1,31 @@
-from selftarget.profile import CrisprLine
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from predictor.features import calculateFeatures, calculateFeaturesBatch, getFeatureLabels, calculateFeaturesForGenIndelFile, \
+    readFeaturesData, readSparseFeaturesData, convertFeaturesFileToSparse, calculateFeaturesForGenIndels, dedupeFeatureLabels, \
+    PrunedFeatureEngine
+from predictor.model import computePredictedProfile, computeKLObjAndGradients, setFeaturesDir, setReadsDir, \
+    setTrainingCacheFile, clearTrainingData, setParallelBackend, computeObjective, \
+    setOutputThetaFile, setStochasticParams, trainModelStochastic, setCheckpointPrefix, setTrainingSeed, trainModelParallel, \
+    trainRegularisationPath, setRegConst, setI1RegConst, setL1RegConst, countNonZero, getNumEvaluations, readTheta, compileModel, \
+    exportModel, loadModel
+from predictor.optimize import l1Penalty, initLBFGSState, minimizeLBFGS, minimizeOWLQN
+import predictor.model
+from predictor.indelgen import generateAllIndels, formatGeneratedIndels
+from predictor.predict import parseGeneratedIndels, generateIndels, IndelGeneratorPool, writeProfilesToFile, predictMutations, \
+    mergeCachedPredictions, setPredictionCacheDir, clearPredictionCache, getPredictionCacheStats, predictMutationsBulk, \
+    setIndelGenTargetExeLoc
+import predictor.predict
+from selftarget.data import getIndelSummaryFiles
+from selftarget.oligo import getFileForOligoIdx
+from selftarget.indel import parseIndel, tokFullIndel
+from selftarget.metrics import AlignedProfiles
+from selftarget.parse import parseIndelLocs, parseCount
+from selftarget.profile import CrisprLine, readSummaryToProfile, readSummaryToProfiles, clearWTCache, getWTCacheStats, \
+    KL, symmetricKL, percentOverlap, entropy, compareTopIndels
 
 
 def test_crispr_line_create_coordinates_positive_strand():
@@ -14,3 +41,440 @@ def test_crispr_line_create_coordinates_negative_strand():
 def test_crispr_line_parse_gene():
     line = CrisprLine(["@@@CCDS100.2_chr1_9104441_- GGAATCCCAAGGGACCCCAG 31.49"])
     assert line.get_gene == "CCDS100.2"
+
+
+def _write_summary_file(filename, blocks):
+    with open(filename, 'w') as f:
+        for oligo_id, rows in blocks:
+            f.write('@@@%s\n' % oligo_id)
+            for indel, oligo_indel, num_reads in rows:
+                f.write('%s\t%s\t%d\n' % (indel, oligo_indel, num_reads))
+
+
+def test_read_summary_to_profile_indexed(tmp_path):
+    filename = str(tmp_path / 'Oligos_0-49_mappedindelsummary.txt')
+    _write_summary_file(filename, [('Oligo1', [('-', '-', 10), ('D2_L-3C0R0', '-', 5)]),
+                                   ('Oligo2', [('-', '-', 7), ('I1_L-1C1R0', '-', 3), ('D1_L-2C0R0', '-', 2)])])
+    profile = {}
+    acc, pacc, null = readSummaryToProfile(filename, profile, oligoid='Oligo2', remove_wt=False)
+    assert profile == {'-': 7, 'I1_L-1C1R0': 3, 'D1_L-2C0R0': 2}
+    assert (acc, pacc, null) == (12, 100.0, 7)
+    assert os.path.isfile(filename + '.idx')
+
+    #Index is rebuilt when the summary file changes
+    _write_summary_file(filename, [('Oligo2', [('D3_L-4C0R0', '-', 4)])])
+    os.utime(filename, ns=(0, 0))
+    profile = {}
+    readSummaryToProfile(filename, profile, oligoid='Oligo2', remove_wt=False)
+    assert profile == {'-': 0, 'D3_L-4C0R0': 4}
+    assert readSummaryToProfile(filename, {}, oligoid='Oligo1', remove_wt=False)[0] == 0
+
+    #Index files, and temporary ones left behind by killed runs, are not taken for summary files
+    for tmp_file in [filename + '.idx.tmp123', str(tmp_path / '.Oligos_0-49_mappedindelsummary.txt.idx.tmp123')]:
+        open(tmp_file, 'w').close()
+    assert getIndelSummaryFiles(str(tmp_path), withpath=False) == ['Oligos_0-49_mappedindelsummary.txt']
+
+
+def test_read_summary_to_profiles_matches_single_reads(tmp_path):
+    suffix = 'mapped_reads/Oligos_0/Oligos_0-49_mappedindelsummary.txt'
+    filename = str(tmp_path / 'ST_June_2017/data/K562_800x_LV7A_DPI7' / suffix)
+    wt_filename = str(tmp_path / 'ST_Feb_2018/data/WT_12NA_DPI7' / suffix)
+    os.makedirs(os.path.dirname(filename)); os.makedirs(os.path.dirname(wt_filename))
+    _write_summary_file(filename, [('Oligo1', [('-', '-', 10), ('D2_L-3C0R0', '-', 5), ('D1_L-2C0R0', '-', 40), ('D12_L10C0R23', '-', 3)]),
+                                   ('Oligo2', [('-', '-', 7), ('I1_L-1C1R0', '-', 3)]),
+                                   ('Oligo3', [('-', '-', 7)])])
+    _write_summary_file(wt_filename, [('Oligo1', [('-', '-', 100), ('D2_L-3C0R0', '-', 10), ('D1_L-2C0R0', '-', 1)]),
+                                      ('Oligo2', [('-', '-', 5), ('D5_L-3C0R3', '-', 95)])])
+    clearWTCache()
+    bulk = [x for x in readSummaryToProfiles(filename)]
+    assert [x[0] for x in bulk] == ['Oligo1', 'Oligo2', 'Oligo3']
+    assert getWTCacheStats()['size'] == 6
+    for oligo_id, profile, acc, pacc, null in bulk:
+        single_profile = {}
+        assert readSummaryToProfile(filename, single_profile, oligoid=oligo_id) == (acc, pacc, null)
+        assert single_profile == profile
+    assert getWTCacheStats()['hits'] >= 6
+    clearWTCache()
+    single_profile = {}
+    readSummaryToProfile(filename, single_profile, oligoid='Oligo1')
+    assert single_profile == bulk[0][1]
+    assert bulk[0][1] == {'-': 10, 'D1_L-2C0R0': 40}
+    assert bulk[2][1] == {}
+
+
+def test_parse_indel_locs():
+    assert parseIndelLocs('[(3,5,),(-1,6,),(9,10,AT)]') == [(3, 5, ''), (-1, 6, ''), (9, 10, 'AT')]
+    assert parseCount('12') == 12 and parseCount('2.5') == 2.5
+
+
+def test_parse_indel_record():
+    ind = parseIndel('I1_L-1C1R0_M5[A]')
+    assert (ind.type, ind.size, ind.L, ind.C, ind.R, ind.I, ind.D) == ('I', 1, -1, 1, 0, 0, 0)
+    assert ind.muts == (('M', 5, 'A'),)
+    assert parseIndel('I1_L-1C1R0_M5[A]') is ind
+    with pytest.raises(AttributeError):
+        ind.size = 2
+    assert tokFullIndel('D2_L-3C0R0') == ('D', 2, {'I': 0, 'D': 0, 'C': 0, 'L': -3, 'R': 0}, [])
+    assert tokFullIndel('-') == ('-', 0, {'I': 0, 'D': 0, 'C': 0}, [])
+
+
+def test_aligned_profile_metrics_match_profile_functions():
+    rng = np.random.RandomState(1)
+    indels = ['-'] + ['D%d_L-%dC0R%d' % (i, i, i % 3) for i in range(1, 15)] + ['I1_L-1C1R0', 'I1_L-2C1R-1']
+    profiles = [{'-': 0}, {'-': 12}, {'D1_L-1C0R1': 0, 'D2_L-2C0R2': 4}]
+    for k in range(6):
+        chosen = rng.choice(indels, size=rng.randint(1, len(indels)), replace=False)
+        profiles.append({x: int(rng.randint(0, 50)) for x in chosen})
+    aligned = AlignedProfiles(profiles)
+    for i, p1 in enumerate(profiles):
+        for ignore_null in [True, False]:
+            assert np.allclose(aligned.entropy(i, ignore_null), entropy(p1, ignore_null), equal_nan=True)
+        for j, p2 in enumerate(profiles):
+            for ignore_null in [True, False]:
+                assert np.allclose(aligned.KL(i, j, ignore_null), KL(p1, p2, ignore_null), equal_nan=True)
+                assert np.allclose(aligned.symmetricKL(i, j, ignore_null), symmetricKL(p1, p2, ignore_null), equal_nan=True)
+            if len([x for x in p1 if x != '-']) > 0 and len([x for x in p2 if x != '-']) > 0:
+                assert np.allclose(aligned.percentOverlap(i, j, True), percentOverlap(p1, p2, True))
+            nonmatch, common, percs = aligned.compareTopIndels(i, j)
+            exp_nonmatch, exp_common, exp_percs = compareTopIndels(p1, p2)
+            assert (nonmatch, common) == (exp_nonmatch, exp_common)
+            assert np.allclose([percs[x] for x in percs], [exp_percs[x] for x in exp_percs], equal_nan=True)
+
+
+def test_calculate_features_batch_matches_calculate_features():
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    rows = [(l, r, '') for l in range(8, 40, 3) for r in range(41, 75, 4)]
+    rows += [(l, l + 1, ins) for l in range(35, 41) for ins in ['A', 'G', 'CC', 'TA']]
+    features = calculateFeaturesBatch(uncut_seq, 39, [x[0] for x in rows], [x[1] for x in rows], [x[2] for x in rows])
+    assert features.shape == (len(rows), len(getFeatureLabels()))
+    for row, (left, right, ins_seq) in zip(features, rows):
+        expected, labels = calculateFeatures((uncut_seq, 39, left, right, ins_seq))
+        assert labels == getFeatureLabels()
+        assert [int(x) for x in expected] == row.tolist()
+
+
+def _write_gen_indel_file(filename):
+    with open(filename, 'w') as f:
+        f.write('Git Commit: test\n')
+        f.write('D2_L-2C1R1\t2\t[(36,39,),(37,40,)]\tREAD1\n')
+        f.write('D5_L-4C1R2\t1\t[(34,40,)]\tREAD2\n')
+        f.write('I1_L-1C1R1\t2\t[(38,39,A),(39,40,G)]\tREAD3\n')
+        f.write('I2_L-1C1R1\t1\t[(38,39,TA)]\tREAD4\n')
+
+
+def test_sparse_features_match_text_features(tmp_path):
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    gen_file = str(tmp_path / 'genindels.txt')
+    _write_gen_indel_file(gen_file)
+    calculateFeaturesForGenIndelFile(gen_file, uncut_seq, 39, str(tmp_path / 'features.txt'))
+    calculateFeaturesForGenIndelFile(gen_file, uncut_seq, 39, str(tmp_path / 'features.npz'))
+    convertFeaturesFileToSparse(str(tmp_path / 'features.txt'), str(tmp_path / 'converted.npz'))
+
+    data, feature_cols = readFeaturesData(str(tmp_path / 'features.txt'))
+    theta = np.random.RandomState(0).normal(size=len(feature_cols))
+    expected, _ = computePredictedProfile(data, theta, feature_cols)
+    for filename in ['features.npz', 'converted.npz']:
+        indels, X, sparse_cols = readSparseFeaturesData(str(tmp_path / filename))
+        assert sparse_cols == feature_cols
+        assert indels == list(data['Indel'])
+        assert (X.toarray() == data[feature_cols].values).all()
+        profile, _ = computePredictedProfile((indels, X), theta, feature_cols)
+        assert profile == pytest.approx(expected)
+
+
+def test_in_memory_features_match_features_file(tmp_path):
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    gen_file = str(tmp_path / 'genindels.txt')
+    _write_gen_indel_file(gen_file)
+    with open(gen_file) as f:
+        gen_indels, rep_reads = parseGeneratedIndels(f.readlines())
+    assert rep_reads == {'D2_L-2C1R1': 'READ1', 'D5_L-4C1R2': 'READ2', 'I1_L-1C1R1': 'READ3', 'I2_L-1C1R1': 'READ4'}
+    for is_reverse in [False, True]:
+        calculateFeaturesForGenIndelFile(gen_file, uncut_seq, 39, str(tmp_path / 'features.npz'), is_reverse=is_reverse)
+        indels, X, feature_cols = readSparseFeaturesData(str(tmp_path / 'features.npz'))
+        mem_indels, mem_X, mem_feature_cols = calculateFeaturesForGenIndels(gen_indels, uncut_seq, 39, is_reverse=is_reverse)
+        assert mem_indels == indels and mem_feature_cols == feature_cols
+        assert (mem_X != X).nnz == 0
+
+
+def _read_indelgentarget_outputs():
+    #Outputs of the indelgentarget binary (without the Git commit line) for a set of (target, pam_idx)
+    outputs = []
+    with gzip.open(os.path.join(os.path.dirname(__file__), 'indelgentarget_parity.txt.gz'), 'rt') as f:
+        for line in f:
+            if line.startswith('@@@'):
+                target_seq, pam_idx = line[3:].strip().split('\t')
+                outputs.append((target_seq, int(pam_idx), []))
+            else:
+                outputs[-1][2].append(line.rstrip('\n'))
+    return outputs
+
+
+@pytest.mark.parametrize('target_seq,pam_idx,expected', _read_indelgentarget_outputs())
+def test_generated_indels_match_indelgentarget(target_seq, pam_idx, expected):
+    gen_indels, rep_reads = generateAllIndels(target_seq, pam_idx)
+    assert formatGeneratedIndels(gen_indels, rep_reads) == expected
+    assert (gen_indels, rep_reads) == parseGeneratedIndels(expected)
+
+
+def test_indel_generator_pool_preserves_order():
+    targets = [('Guide%d' % i, target_seq, pam_idx) for i, (target_seq, pam_idx, _) in enumerate(_read_indelgentarget_outputs())]
+    pool = IndelGeneratorPool(num_workers=2, batch_size=2)
+    try:
+        results = list(pool.generate(iter(targets)))
+    finally:
+        pool.close()
+    assert [x[0] for x in results] == targets
+    for target, gen_indels, rep_reads in results:
+        assert (gen_indels, rep_reads) == generateIndels(target[1], target[2])
+
+
+def test_write_profiles_streams_in_order(tmp_path):
+    profiles = [('G%d' % i, {'D1_L-1R0': 10.0 + i, 'I1_L-1R0': 2.0}, {'D1_L-1R0': 'READD', 'I1_L-1R0': 'READI'}, 50.0 + i) for i in range(3)]
+    assert writeProfilesToFile(str(tmp_path / 'many'), iter(profiles), write_rr=True) == 3
+    with open(str(tmp_path / 'many_predictedindelsummary.txt')) as f:
+        assert [x for x in f.read().split('\n') if x.startswith('@@@')] == ['@@@G0\t50.000', '@@@G1\t51.000', '@@@G2\t52.000']
+    assert writeProfilesToFile(str(tmp_path / 'one'), iter(profiles[:1]), write_rr=True) == 1
+    with open(str(tmp_path / 'one_predictedreads.txt')) as f:
+        assert f.read() == '0\tREADD\tD1_L-1R0\n1\tREADI\tI1_L-1R0\n'
+
+
+def test_bulk_prediction_skips_invalid_targets(tmp_path):
+    theta_file = os.path.join(os.path.dirname(__file__), 'model_output_10000_0.01000000_0.01000000_-0.607_theta.txt_cf0.txt')
+    target_file, exe_loc = str(tmp_path / 'targets.txt'), predictor.predict.INDELGENTARGET_EXE
+    with open(target_file, 'w') as f:
+        f.write('ID\tTarget\tPAM Index\nGuide_1\tATGCTAGCTAGGGCATGAGGCATGCTAGTGACTGCATGGTAC\t17\n')
+        f.write('Guide_N\tATGCTAGCTAGGGCATGNGGCATGCTAGTGACTGCATGGTAC\t17\n')
+        f.write('Guide_Short\tATGCTAGCTAGGGCATGAGGCATG\t17\n')
+        f.write('Guide_2\tATCGATGACTGATCGTAGCTAGCTGGGATGCTAGCTAGTTGCATGCTAGGAGTCAGCTAG\t23\n')
+    try:
+        setIndelGenTargetExeLoc(str(tmp_path / 'missing_indelgentarget'))    #(No binary to fall back to for N)
+        for jobs in [1, 2]:
+            skipped = predictMutationsBulk(target_file, str(tmp_path / ('out%d' % jobs)), theta_file=theta_file, jobs=jobs)
+            assert [x[0] for x in skipped] == ['Guide_N', 'Guide_Short']
+            assert 'contains N' in skipped[0][1] and 'more than 10 nt' in skipped[1][1]
+            with open(str(tmp_path / ('out%d_predictedindelsummary.txt' % jobs))) as f:
+                assert [x.split('\t')[0] for x in f.read().split('\n') if x.startswith('@@@')] == ['@@@Guide_1', '@@@Guide_2']
+    finally:
+        setIndelGenTargetExeLoc(exe_loc)
+
+
+def test_prediction_cache(tmp_path):
+    theta_file = os.path.join(os.path.dirname(__file__), 'model_output_10000_0.01000000_0.01000000_-0.607_theta.txt_cf0.txt')
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    try:
+        setPredictionCacheDir(str(tmp_path / 'cache'), max_mb=0.02)
+        clearPredictionCache()
+        profile, rep_reads, in_frame = predictMutations(theta_file, uncut_seq, 42)
+        profile['-'] = 0    #(Callers' changes do not reach the cache)
+        for from_disk in [False, True]:
+            if from_disk: clearPredictionCache()
+            cached_profile, cached_rep_reads, cached_in_frame = predictMutations(theta_file, uncut_seq, 42)
+            assert cached_profile == dict(profile, **{'-': 1000}) and cached_rep_reads == rep_reads and cached_in_frame == in_frame
+        assert getPredictionCacheStats()['disk_hits'] == 1
+
+        #The least recently used predictions are removed from the store once it exceeds the size limit
+        for pam_idx in [36, 42, 45]:
+            predictMutations(theta_file, uncut_seq, pam_idx)
+        cache_files = [os.path.join(d, x) for d, _, files in os.walk(str(tmp_path / 'cache')) for x in files]
+        assert 0 < len(cache_files) < 3 and sum([os.path.getsize(x) for x in cache_files]) <= 0.02*1e6
+    finally:
+        setPredictionCacheDir(None)
+        clearPredictionCache()
+
+    #Cached and predicted results are merged in input order (with the misses predicted ahead of their use)
+    targets = [('G%d' % i, 'SEQ', i) for i in range(6)]
+    cached = {targets[i]: 'cached %d' % i for i in [0, 2, 3, 5]}
+    def predictMisses(misses):
+        misses = list(misses)
+        assert misses == [targets[1], targets[4]]
+        return ((x, 'predicted %d' % x[2]) for x in misses)
+    assert [x[1] for x in mergeCachedPredictions(iter(targets), cached.get, predictMisses)] == \
+        ['cached 0', 'predicted 1', 'cached 2', 'cached 3', 'predicted 4', 'cached 5']
+
+
+def test_pruned_feature_engine_matches_all_features():
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    gen_indels, _ = generateAllIndels(uncut_seq, 42)
+    indels, X, _ = calculateFeaturesForGenIndels(gen_indels, uncut_seq, 39)
+    num_labels = len(getFeatureLabels())
+    rng = np.random.RandomState(0)
+    for label_idxs in [np.arange(num_labels), np.sort(rng.choice(num_labels, 300, replace=False)), rng.choice(num_labels, 20, replace=False)]:
+        engine = PrunedFeatureEngine(label_idxs)
+        pruned_indels, pruned_X = engine.calculateFeaturesForGenIndels(gen_indels, uncut_seq, 39)
+        assert pruned_indels == indels
+        assert (pruned_X != X[:,label_idxs]).nnz == 0
+        #(including rows handled by the per-indel functions)
+        lefts, rights, ins_seqs = [0, 5, 75, 30], [3, 79, 78, 41], ['', '', '', '']
+        expected = calculateFeaturesBatch(uncut_seq, 39, lefts, rights, ins_seqs)[:,label_idxs]
+        assert (engine.calculateFeatures(uncut_seq, 39, lefts, rights, ins_seqs) == expected).all()
+
+
+def test_compiled_model_round_trip(tmp_path):
+    theta_file = os.path.join(os.path.dirname(__file__), 'model_output_10000_0.01000000_0.01000000_-0.607_theta.txt_cf0.txt')
+    theta, train_set, feature_columns = readTheta(theta_file)
+    model_file = compileModel(theta_file, str(tmp_path / 'model.npz'))
+    model = loadModel(model_file)
+    assert list(model.theta) == theta and model.train_set == train_set and model.feature_columns == feature_columns
+    labels = dedupeFeatureLabels(getFeatureLabels())
+    assert [labels[i] for i in model.feature_idxs] == feature_columns
+    assert loadModel(model_file) is model and loadModel(theta_file).model_hash == model.model_hash
+    exportModel(model_file, str(tmp_path / 'theta.txt'))
+    with open(theta_file) as f1, open(str(tmp_path / 'theta.txt')) as f2:
+        assert f1.read() == f2.read()
+
+
+def _write_training_oligo(tmp_path, oligo_idx, sparse=False):
+    uncut_seq = 'CTGAGTAGCTATGCGGCCAGCAGCGAGACGCTCAGCGTGAAGCGGCAGTATCCCTCTTTCCTGCGCACCATCCCCAATC'
+    subdir, _ = getFileForOligoIdx(oligo_idx, ext='')
+    for dirname in ['features', 'reads']:
+        (tmp_path / dirname / subdir).mkdir(parents=True, exist_ok=True)
+    gen_file = str(tmp_path / ('genindels_%d.txt' % oligo_idx))
+    _write_gen_indel_file(gen_file)
+    ext = '.npz' if sparse else '.txt'
+    calculateFeaturesForGenIndelFile(gen_file, uncut_seq, 39, str(tmp_path / 'features' / subdir / ('Oligo%d_gen_indel_features%s' % (oligo_idx, ext))))
+    with open(str(tmp_path / 'reads' / subdir / ('Oligo%d_gen_indel_reads.txt' % oligo_idx)), 'w') as f:
+        f.write('Git Commit: test\nIndel\tDetails\tS1\tS2\nAll Mutated\t[]\t20\t12\n')
+        f.write('D2_L-2C1R1\t[]\t%d\t1\nD5_L-4C1R2\t[]\t0\t2\nI1_L-1C1R1\t[]\t7\t%d\nI2_L-1C1R1\t[]\t0\t0\n' % (oligo_idx, oligo_idx))
+    return 'Oligo%d' % oligo_idx
+
+
+_TRAINING_SETTINGS = ['FEATURES_DIR', 'READS_DIR', 'OUT_THETA_FILE', 'TRAINING_CACHE_FILE', 'SGD_OPTIMIZER', 'SGD_BATCH_SIZE',
+                      'SGD_NUM_EPOCHS', 'SGD_LEARNING_RATE', 'SGD_LR_DECAY', 'SGD_EVAL_EPOCHS', 'CHECKPOINT_PREFIX', 'CHECKPOINT_EVERY',
+                      'TRAINING_SEED', 'REG_CONST', 'I1_REG_CONST', 'L1_REG_CONST']
+
+
+@pytest.fixture
+def training_data(tmp_path, monkeypatch):
+    #Training data for oligos 5, 12, 19 and 26 (text features for the odd ones, sparse for the even ones), run from
+    #tmp_path. Returns (guideset, feature_cols); the predictor.model settings changed by the test are restored after it
+    for name in _TRAINING_SETTINGS:
+        monkeypatch.setattr(predictor.model, name, getattr(predictor.model, name))
+    monkeypatch.chdir(tmp_path)
+    setFeaturesDir(str(tmp_path / 'features'))
+    setReadsDir(str(tmp_path / 'reads'))
+    setOutputThetaFile('test_theta.txt')
+    guideset = [_write_training_oligo(tmp_path, idx, sparse=(idx % 2 == 0)) for idx in [5, 12, 19, 26]]
+    feature_cols = readSparseFeaturesData(str(tmp_path / 'features' / getFileForOligoIdx(12, ext='')[0] / 'Oligo12_gen_indel_features.npz'))[2]
+    yield guideset, feature_cols
+    setParallelBackend('serial')
+    clearTrainingData()
+
+
+def test_sparse_features_align_with_reads_like_text(tmp_path, training_data):
+    feature_cols = training_data[1]
+    _write_training_oligo(tmp_path, 5, sparse=True)
+    with open(str(tmp_path / 'reads' / getFileForOligoIdx(5, ext='')[0] / 'Oligo5_gen_indel_reads.txt'), 'a') as f:
+        f.write('D2_L-2C1R1\t[]\t3\t0\n')    #(Duplicated indel row)
+    data = predictor.model.loadOligoFeaturesAndReadCounts('Oligo5', ['S1', 'S2'])
+    indels, X, Y = predictor.model.loadOligoSparseFeaturesAndReadCounts('Oligo5', ['S1', 'S2'], feature_cols)
+    assert X.shape[0] == len(Y) == len(data) and indels == [x for x in data['Indel']]
+    assert np.array_equal(X.toarray(), data[feature_cols].values) and np.allclose(Y, data['Frac Sample Reads'].values)
+
+
+def test_training_data_cache(tmp_path, training_data):
+    guideset, feature_cols = training_data
+    theta = np.random.RandomState(0).normal(size=len(feature_cols))*0.1
+    setTrainingCacheFile(str(tmp_path / 'training_cache.npz'))
+    clearTrainingData()
+    Q, jac, Qs = computeKLObjAndGradients(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)
+    assert os.path.isfile(str(tmp_path / 'training_cache.npz'))
+
+    #Reload from the cache file only
+    clearTrainingData()
+    for dirname in ['features', 'reads']:
+        os.rename(str(tmp_path / dirname), str(tmp_path / (dirname + '_moved')))
+    Q2, jac2, Qs2 = computeKLObjAndGradients(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)
+    assert Q2 == pytest.approx(Q)
+    assert np.allclose(jac, jac2)
+    assert Qs2 == pytest.approx(Qs)
+
+
+def test_process_backend_matches_serial(training_data):
+    guideset, feature_cols = training_data
+    theta = np.random.RandomState(0).normal(size=len(feature_cols))*0.1
+    Q, jac, Qs = computeObjective(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)
+    setParallelBackend('process', num_workers=2)
+    Q2, jac2, Qs2 = computeObjective(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)
+    assert Q2 == pytest.approx(Q)
+    assert np.allclose(jac, jac2)
+    assert sorted(Qs2) == pytest.approx(sorted(Qs))
+
+
+def test_stochastic_training_reduces_objective(training_data):
+    guideset, feature_cols = training_data
+    theta0 = np.random.RandomState(0).normal(size=len(feature_cols))
+    for optimizer in ['adam', 'sgd']:
+        setStochasticParams(optimizer=optimizer, batch_size=2, num_epochs=5, learning_rate=0.05)
+        theta = trainModelStochastic(guideset, ['S1', 'S2'], feature_cols, theta0, seed=1)
+        assert computeObjective(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)[0] < computeObjective(theta0, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)[0]
+        assert os.path.isfile('tmp_test_theta.txt_0.txt')
+
+
+def test_failed_line_search_keeps_current_point():
+    #With a gradient of the wrong sign, no step reduces the objective: the optimizer stops where it is
+    fun = lambda theta: (np.sum(theta**2.0), -2.0*theta)
+    theta0 = np.array([1.0, -2.0, 0.5])
+    states = []
+    state = minimizeLBFGS(fun, initLBFGSState(fun, theta0), callback=lambda x: states.append(dict(x)))
+    assert state['converged'] and np.array_equal(state['theta'], theta0) and state['Q'] == fun(theta0)[0]
+    assert states[-1]['converged'] and max(state['trace']) == fun(theta0)[0]
+
+    #Same for OWL-QN, where the objective includes the l1 penalty
+    l1_weights = np.array([0.0, 0.1, 0.1])
+    state = minimizeOWLQN(fun, initLBFGSState(fun, theta0, l1_weights=l1_weights), l1_weights)
+    full_Q = fun(theta0)[0] + l1Penalty(theta0, l1_weights)
+    assert state['converged'] and np.array_equal(state['theta'], theta0)
+    assert state['trace'][-1] <= state['trace'][0] == full_Q
+
+
+def test_checkpointed_training_resumes_exactly(tmp_path, monkeypatch, training_data):
+    guideset, feature_cols = training_data
+    setCheckpointPrefix(str(tmp_path / 'checkpoint'), every=3)
+    setTrainingSeed(7)
+    theta = trainModelParallel(guideset, ['S1', 'S2'], feature_cols, None)
+    os.remove(str(tmp_path / 'checkpoint_cv0.npz'))
+
+    #Interrupt a second run after iteration 8 (last checkpoint at 6), then resume it
+    log_progress = predictor.model.logProgress
+    def interruptingLogProgress(log_file, iteration, *args):
+        log_progress(log_file, iteration, *args)
+        if iteration == 8: raise KeyboardInterrupt()
+    monkeypatch.setattr(predictor.model, 'logProgress', interruptingLogProgress)
+    with pytest.raises(KeyboardInterrupt):
+        trainModelParallel(guideset, ['S1', 'S2'], feature_cols, None)
+    monkeypatch.setattr(predictor.model, 'logProgress', log_progress)
+    resumed_theta = trainModelParallel(guideset, ['S1', 'S2'], feature_cols, None)
+    assert np.array_equal(theta, resumed_theta)
+
+
+def test_regularisation_path_warm_starts(training_data):
+    guideset, feature_cols = training_data
+    theta0 = np.random.RandomState(0).normal(size=len(feature_cols))
+    trained = []
+    path = trainRegularisationPath(guideset, ['S1', 'S2'], feature_cols, [(0.01, 0.01), (0.1, 0.1)], theta0=theta0,
+                                   on_trained=lambda reg, i1_reg, theta, num_evals: trained.append((reg, num_evals)))
+    assert [x[:2] for x in path] == [(0.1, 0.1), (0.01, 0.01)]
+
+    #Cold start at the smallest lambda takes more evaluations than the warm start
+    setRegConst(0.01); setI1RegConst(0.01)
+    num_evals = getNumEvaluations()
+    trainModelParallel(guideset, ['S1', 'S2'], feature_cols, theta0)
+    assert trained[1][1] < getNumEvaluations() - num_evals
+
+
+def test_l1_training_gives_sparse_model(training_data):
+    guideset, feature_cols = training_data
+    theta0 = np.random.RandomState(0).normal(size=len(feature_cols))
+    objective = lambda theta: computeObjective(theta, guideset, ['S1', 'S2'], feature_cols, 0.01, 0.01)[0]/len(guideset) + l1Penalty(theta, 0.05)
+    l2_theta = trainModelParallel(guideset, ['S1', 'S2'], feature_cols, theta0)
+    setL1RegConst(0.05)
+    l1_theta = trainModelParallel(guideset, ['S1', 'S2'], feature_cols, theta0)
+    assert countNonZero(l2_theta) == len(feature_cols)
+    assert countNonZero(l1_theta) < len(feature_cols)/2
+    assert objective(l1_theta) < objective(l2_theta)
+
+    setStochasticParams(batch_size=2, num_epochs=10, learning_rate=0.05)
+    sgd_theta = trainModelStochastic(guideset, ['S1', 'S2'], feature_cols, theta0, seed=1)
+    assert countNonZero(sgd_theta) < len(feature_cols)
+    assert objective(sgd_theta) < objective(theta0)
@@ -1,6 +1,7 @@
 import io, os, csv, sys, re
 
 SELFTARGET_ANALYSIS = '/lustre/scratch117/cellgen/team227/fa9/self-target/indel_analysis/'
+SUMMARY_INDEX_EXT = '.idx'
 
 def setHighDataDir(dirname):
     global SELFTARGET_ANALYSIS
@@ -120,8 +121,10 @@ def getSubdirs(dirname, withpath=True, mapped_dir='mapped_reads'):
     else: return subdirs
     
 def getIndelSummaryFiles(subdir, withpath=True):
-    if withpath: return [subdir + '/' + x for x in os.listdir(subdir) if 'mappedindelsummary' in x]
-    else: return [x for x in os.listdir(subdir) if 'mappedindelsummary' in x]
+    #(Excluding the summary index files, and any temporary index files left by killed runs)
+    is_summary = lambda x: 'mappedindelsummary' in x and SUMMARY_INDEX_EXT not in x and not x.startswith('.')
+    if withpath: return [subdir + '/' + x for x in os.listdir(subdir) if is_summary(x)]
+    else: return [x for x in os.listdir(subdir) if is_summary(x)]
     
 def getDirNameFromSubdir(subdir):
     return '/'.join(subdir.split('/')[:-2])
@@ -1,34 +1,61 @@
 import io, os, csv, sys, re
+from functools import lru_cache
 import numpy as np
 
-def tokFullIndel(indel):
+CIGAR_RE = re.compile(r'([CLRDI]+)(-?\d+)')
+MUT_RE = re.compile(r'([MNDSI]+)(-?\d+)(\[[ATGC]+\])?')
+INDEL_CACHE_SIZE = 100000
+
+class Indel(object):
+    #Immutable parsed form of an indel string e.g. D2_L-3C0R0 or I1_L-1C1R0_M5[A]
+    #(L and R are None where not given, e.g. for '-')
+    __slots__ = ('indel', 'type', 'size', 'L', 'R', 'C', 'I', 'D', 'muts')
+
+    def __init__(self, indel, itype, isize, details, muts):
+        for name, val in [('indel', indel), ('type', itype), ('size', isize), ('muts', tuple(muts))]:
+            object.__setattr__(self, name, val)
+        for letter in ['L', 'R', 'C', 'I', 'D']:
+            object.__setattr__(self, letter, details.get(letter))
+
+    def __setattr__(self, name, val):
+        raise AttributeError('Indel records are immutable')
+
+    def __repr__(self):
+        return 'Indel(%s)' % self.indel
+
+    @property
+    def details(self):
+        return {x: getattr(self, x) for x in ['I', 'D', 'C', 'L', 'R'] if getattr(self, x) is not None}
+
+@lru_cache(maxsize=INDEL_CACHE_SIZE)
+def parseIndel(indel):
     indel_toks = indel.split('_')
     indel_type, indel_details = indel_toks[0], ''
     if len(indel_toks) > 1:
         indel_details =  indel_toks[1]
-    cigar_toks = re.findall(r'([CLRDI]+)(-?\d+)', indel_details)
     details, muts = {'I':0,'D':0,'C':0}, []
-    for (letter,val) in cigar_toks:
-        details[letter] = eval(val)
+    for (letter,val) in CIGAR_RE.findall(indel_details):
+        details[letter] = int(val)
     if len(indel_toks) > 2 or (indel_type == '-' and len(indel_toks) > 1):
-        mut_toks = re.findall(r'([MNDSI]+)(-?\d+)(\[[ATGC]+\])?', indel_toks[-1])
-        for (letter,val,nucl) in mut_toks:
-            if nucl == '':
-                nucl = '[]'
-            muts.append((letter, eval(val), nucl[1:-1]))
+        for (letter,val,nucl) in MUT_RE.findall(indel_toks[-1]):
+            muts.append((letter, int(val), nucl[1:-1]))
     if indel_type[0] == '-':
         isize = 0
     else:
-        isize = eval(indel_type[1:])
-    return indel_type[0],isize,details, muts
+        isize = int(indel_type[1:])
+    return Indel(indel, indel_type[0], isize, details, muts)
+
+def tokFullIndel(indel):
+    ind = parseIndel(indel)
+    return ind.type, ind.size, ind.details, list(ind.muts)
     
 def computeReadLength(indel, oligo_indel):
     read_length = 79
     for ind in [indel, oligo_indel]:
-        itype, isize, details, muts = tokFullIndel(ind)    
-        if itype == 'I': read_length += isize
-        elif itype == 'D': read_length -= isize
-        for mut in muts:
+        ind = parseIndel(ind)
+        if ind.type == 'I': read_length += ind.size
+        elif ind.type == 'D': read_length -= ind.size
+        for mut in ind.muts:
             if mut[0] == 'I': read_length += mut[1]
             elif mut[0] == 'D': read_length -= mut[1]
     return read_length
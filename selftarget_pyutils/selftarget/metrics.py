@@ -0,0 +1,99 @@
+import numpy as np
+
+#Profile comparison metrics computed as NumPy array operations over a set of profiles aligned
+#onto a shared indel vocabulary. Values match KL, symmetricKL, percentOverlap, entropy and
+#compareTopIndels in selftarget.profile (up to floating point summation order).
+
+TOP_THRESHOLDS = [3,5,10]
+
+class AlignedProfiles:
+
+    def __init__(self, profiles):
+        #profiles: list of {indel: count} dicts
+        self.indels = sorted(set([x for p1 in profiles for x in p1]))    #(sorted, so index order == indel string order)
+        lookup = {x: i for i, x in enumerate(self.indels)}
+        self.counts = np.zeros((len(profiles), len(self.indels)))
+        self.present = np.zeros((len(profiles), len(self.indels)), dtype=bool)    #Entries in the dict (even if zero)
+        for i, p1 in enumerate(profiles):
+            idxs = np.array([lookup[x] for x in p1], dtype=int)
+            self.counts[i, idxs] = [p1[x] for x in p1]
+            self.present[i, idxs] = True
+        self.not_null = np.array([x != '-' for x in self.indels], dtype=bool)
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def _included(self, ignore_null):
+        return self.not_null if ignore_null else np.ones(len(self.indels), dtype=bool)
+
+    # KL Divergence between profiles i and j (non-symmetric)
+    def KL(self, i, j, ignore_null=True, missing_count=0.5):
+        incl = self._included(ignore_null)
+        c1, c2 = self.counts[i], self.counts[j]
+        m1, m2 = (c1 > 0) & incl, (c2 > 0) & incl
+        p1_total = c1[m1].sum() + missing_count*(m2 & ~m1).sum()
+        p2_total = c2[m2].sum() + missing_count*(m1 & ~m2).sum()
+        if not (p1_total > 0 and p2_total > 0):
+            return np.nan
+        union = m1 | m2
+        q1 = np.where(m1, c1, missing_count)[union]/p1_total
+        q2 = np.where(m2, c2, missing_count)[union]/p2_total
+        return (q1*np.log2(q1/q2)).sum()
+
+    def symmetricKL(self, i, j, ignore_null=True):
+        return 0.5*self.KL(i, j, ignore_null) + 0.5*self.KL(j, i, ignore_null)
+
+    def pairwiseSymmetricKL(self, ignore_null=True):
+        N = len(self)
+        kls = np.zeros((N,N))
+        for i in range(N):
+            for j in range(i+1,N):
+                kls[i,j] = kls[j,i] = self.symmetricKL(i, j, ignore_null)
+        return kls
+
+    #Percent Overlap between profiles i and j
+    def percentOverlap(self, i, j, ignore_null):
+        c1, c2 = self.counts[i], self.counts[j]
+        pr1, pr2 = self.present[i], self.present[j]
+        incl = self._included(ignore_null)
+        if ignore_null:
+            if (pr1.sum() == 1 and (pr1 & ~self.not_null).any()) or (pr2 & self.not_null).sum() == 0:
+                return 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm1, norm2 = 100.0/c1[pr1 & incl].sum(), 100.0/c2[pr2 & incl].sum()
+            both = pr1 & pr2 & incl
+            return np.minimum(c1[both]*norm1, c2[both]*norm2).sum()
+
+    #Entropy of profile i
+    def entropy(self, i, ignore_null):
+        c1, pr1 = self.counts[i], self.present[i]
+        if pr1.sum() == 0 or c1[pr1].sum() == 0:
+            return 0.0
+        if ignore_null and pr1.sum() == 1 and (pr1 & ~self.not_null).any():
+            return 0.0
+        incl = pr1 & self._included(ignore_null)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q1 = c1[incl]/c1[incl].sum()
+            return 0.0 - (q1*np.log2(q1)).sum()
+
+    def _rankedIndels(self, i):
+        #Non-null indels in profile i, highest count first (ties broken by indel string, descending, as in a list sort)
+        idxs = np.where(self.present[i] & self.not_null)[0]
+        return idxs[np.lexsort((idxs, self.counts[i, idxs]))[::-1]]
+
+    def compareTopIndels(self, i, j):
+        ranked1, ranked2 = self._rankedIndels(i), self._rankedIndels(j)
+        L = min(len(ranked1), len(ranked2))
+        mismatches = np.where(ranked1[:L] != ranked2[:L])[0]
+        nonmatch_idx = mismatches[0] if len(mismatches) > 0 else -1
+        top_common, top_percs = {x: -1 for x in TOP_THRESHOLDS}, {x: (-1,-1) for x in TOP_THRESHOLDS}
+        if len(ranked1) > 0 and len(ranked2) > 0:
+            total1, total2 = self.counts[i, ranked1].sum(), self.counts[j, ranked2].sum()
+            for thresh in TOP_THRESHOLDS:
+                top1, top2 = ranked1[:min(thresh,L)], ranked2[:min(thresh,L)]
+                top_common[thresh] = len(np.intersect1d(top1, top2))
+                top_percs[thresh] = (self.counts[i, top1].sum()*100.0/total1, self.counts[j, top2].sum()*100.0/total2)
+        return nonmatch_idx+1, top_common, top_percs
+
+def alignProfiles(profiles):
+    return AlignedProfiles(profiles)
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 from Bio import SeqIO
 from selftarget.data import getExpOligoFile
+from selftarget.parse import parseInt
 import Bio
 
 def loadPamLookup(filename, adj=20):
@@ -10,7 +11,7 @@ def loadPamLookup(filename, adj=20):
     f = io.open(filename)
     reader = csv.reader(f, delimiter='\t')
     for toks in reader:
-            lookup[toks[0]] = (eval(toks[1])-adj, toks[2])
+            lookup[toks[0]] = (parseInt(toks[1])-adj, toks[2])
     f.close()
     return lookup
     
@@ -64,7 +65,7 @@ def splitOligoFastaFile(filename, oligo_ids, filepath=None):
     return out_filename            
     
 def getOligoIdxFromId(oligo_id):
-    return eval(oligo_id.replace('_','')[5:])
+    return parseInt(oligo_id.replace('_','')[5:])
 
 def getOligoIdsFromMappedFastaFile(filename, return_counts=False):
     oligo_counts = {}
@@ -0,0 +1,62 @@
+import io, csv, sys, re, time
+
+#Typed parsers for the numeric fields of the summary, generated indel and model files,
+#used in place of eval (faster, and safe to run on user-supplied input in the server)
+
+_INDEL_LOC_RE = re.compile(r'\((-?\d+),(-?\d+),([A-Z]*)\)')
+
+def parseInt(val):
+    return int(val)
+
+def parseFloat(val):
+    return float(val)
+
+def parseCount(val):
+    #Read counts are integers, but allow for fractional (e.g. predicted) counts
+    try:
+        return int(val)
+    except ValueError:
+        return float(val)
+
+def parseIndelLocs(val):
+    #e.g. '[(3,5,),(4,6,),(9,10,AT)]' as written by indelgentarget -> [(3,5,''),(4,6,''),(9,10,'AT')]
+    return [(int(left), int(right), ins_seq) for (left, right, ins_seq) in _INDEL_LOC_RE.findall(val)]
+
+def _evalIndelLocs(val):
+    A,T,G,C = 'A','T','G','C'
+    AA,AT,AC,AG,CG,CT,CA,CC = 'AA','AT','AC','AG','CG','CT','CA','CC'
+    GT,GA,GG,GC,TA,TG,TC,TT = 'GT','GA','GG','GC','TA','TG','TC','TT'
+    return [(x[0], x[1], x[2] if len(x) > 2 else '') for x in eval(val)]
+
+def _timeParse(fn, vals, repeats):
+    start = time.time()
+    for i in range(repeats):
+        for val in vals: fn(val)
+    return time.time() - start
+
+def benchmarkParse(filenames, repeats=5):
+    #Micro-benchmark of eval vs the typed parsers on the count (or location list) column of
+    #mappedindelsummary (or generated indel) files
+    counts, locs = [], []
+    for filename in filenames:
+        f = io.open(filename)
+        for toks in csv.reader(f, delimiter='\t'):
+            if len(toks) < 3 or toks[0][:3] == '@@@': continue
+            if toks[2][:1] == '[': locs.append(toks[2])
+            else: counts.append(toks[2])
+        f.close()
+    results = []
+    for label, vals, eval_fn, parse_fn in [('Counts', counts, eval, parseCount), ('Indel Locations', locs, _evalIndelLocs, parseIndelLocs)]:
+        if len(vals) == 0: continue
+        if [eval_fn(x) for x in vals[:1000]] != [parse_fn(x) for x in vals[:1000]]:
+            raise Exception('Typed parser does not match eval for %s' % label)
+        eval_time, parse_time = _timeParse(eval_fn, vals, repeats), _timeParse(parse_fn, vals, repeats)
+        results.append((label, len(vals), eval_time, parse_time))
+        print('%s (%d values x %d): eval %.3fs, typed parser %.3fs (%.1fx faster)' % (label, len(vals), repeats, eval_time, parse_time, eval_time/parse_time))
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: parse.py <summary_or_genindel_file> (<summary_or_genindel_file> ...)')
+    else:
+        benchmarkParse(sys.argv[1:])
@@ -2,12 +2,14 @@ import csv
 import io
 import os
 import sys
+from collections import OrderedDict
 from typing import List, Tuple
 
 import numpy as np
-from selftarget.data import getWTDir
-from selftarget.indel import tokFullIndel
+from selftarget.data import getWTDir, SUMMARY_INDEX_EXT
+from selftarget.indel import parseIndel
 from selftarget.oligo import getSummaryFileSuffix
+from selftarget.parse import parseCount
 
 FRAME_SHIFT = 'frame_shift'
 NEGATIVE = "-"
@@ -152,7 +154,8 @@ def entropy(p1, ignore_null):
     return score
 
 def isAllowableOligoIndel(oligo_indel):
-    itype, isize, details, muts = tokFullIndel(oligo_indel)
+    ind = parseIndel(oligo_indel)
+    muts = ind.muts
     #Exclude reads from oligos with any mutations in the guide or PAM sequence
     is_ok = True
     mut_locs = [x for x in muts if x[0] not in ['N','I','D']]
@@ -167,46 +170,180 @@ def isAllowableOligoIndel(oligo_indel):
         if any([x[1] > 2 for x in ins_del_muts]):
             is_ok = False
     if oligo_indel[0] != '-':
-        if isize > 2 or (details['L'] < 6 and details['R'] > -20):   
+        if ind.size > 2 or (ind.L < 6 and ind.R > -20):   
             is_ok = False
     return is_ok
-    
-#Read in profile from indel summary file
-def readSummaryToProfile(filename, profile, oligoid=None, noexclude=False, remove_long_indels=False, remove_wt=True, wt_thresh=3.0):
 
-    if not os.path.isfile(filename): return 0,0,0
-    
+#Byte-offset index of the @@@ oligo blocks in an indel summary file, stored in a sidecar
+#file (<filename>.idx) and rebuilt whenever the summary file's mtime or size changes
+_summary_indexes = {}
+
+def _getSummaryIndexFilename(filename):
+    return filename + SUMMARY_INDEX_EXT
+
+def _buildSummaryIndex(filename):
+    index, curr_oligo_id, start, offset = {}, None, 0, 0
+    f = io.open(filename, 'rb')
+    for line in f:
+        if line[:3] == b'@@@':
+            if curr_oligo_id is not None:
+                index.setdefault(curr_oligo_id, []).append((start, offset))
+            curr_oligo_id = line.split(b'\t')[0][3:].split()[0].decode()
+            start = offset + len(line)
+        offset += len(line)
+    if curr_oligo_id is not None:
+        index.setdefault(curr_oligo_id, []).append((start, offset))
+    f.close()
+    return index
+
+def _readSummaryIndexFile(index_filename, mtime, size):
+    if not os.path.isfile(index_filename): return None
+    f = io.open(index_filename)
+    if f.readline() != u'###%d\t%d\n' % (mtime, size):
+        f.close()
+        return None
+    index = {}
+    for toks in csv.reader(f, delimiter='\t'):
+        index.setdefault(toks[0], []).append((int(toks[1]), int(toks[2])))
+    f.close()
+    return index
+
+def _writeSummaryIndexFile(index_filename, index, mtime, size):
+    #(Hidden, so that it is not taken for a summary file if left behind by a killed run)
+    tmp_filename = os.path.join(os.path.dirname(index_filename), '.%s.tmp%d' % (os.path.basename(index_filename), os.getpid()))
+    try:
+        fout = io.open(tmp_filename, 'w')
+        fout.write(u'###%d\t%d\n' % (mtime, size))
+        for oligo_id in index:
+            for start, end in index[oligo_id]:
+                fout.write(u'%s\t%d\t%d\n' % (oligo_id, start, end))
+        fout.close()
+        os.replace(tmp_filename, index_filename)
+    except OSError:
+        #e.g. read-only data directory, just keep the index in memory
+        if os.path.isfile(tmp_filename): os.remove(tmp_filename)
+
+def getSummaryIndex(filename):
+    #Returns {oligo_id: [(start_byte, end_byte),...]} for the rows following each @@@ header
+    st = os.stat(filename)
+    mtime, size = st.st_mtime_ns, st.st_size
+    if filename in _summary_indexes and _summary_indexes[filename][:2] == (mtime, size):
+        return _summary_indexes[filename][2]
+    index_filename = _getSummaryIndexFilename(filename)
+    index = _readSummaryIndexFile(index_filename, mtime, size)
+    if index is None:
+        index = _buildSummaryIndex(filename)
+        _writeSummaryIndexFile(index_filename, index, mtime, size)
+    _summary_indexes[filename] = (mtime, size, index)
+    return index
+
+def readSummaryBlock(filename, oligoid):
+    #Seeks straight to the block(s) for oligoid and returns its rows (split on tabs as in csv.reader)
+    rows = []
+    index = getSummaryIndex(filename)
+    if oligoid not in index: return rows
+    f = io.open(filename, 'rb')
+    for start, end in index[oligoid]:
+        f.seek(start)
+        block = f.read(end - start).decode()
+        rows.extend(csv.reader(io.StringIO(block, newline=''), delimiter='\t'))
+    f.close()
+    return rows
+
+def _readSummaryRows(filename, oligoid):
+    if oligoid is not None:
+        return readSummaryBlock(filename, oligoid)
+    #Rows preceding the first @@@ header (not covered by the index)
+    rows = []
+    f = io.open(filename)
+    for toks in csv.reader(f, delimiter='\t'):
+        if toks[0][:3] == '@@@': break
+        rows.append(toks)
+    f.close()
+    return rows
+
+def _getWTFilename(filename, noexclude=False, remove_wt=True):
+    #Returns the matching WT summary file to filter against (or None if not applicable)
     dirname = '/'.join(filename.split('/')[:-3])
     filename_suffix = '/'.join(filename.split('/')[-3:])
-    wt_p, wt_p_wfilter = {}, {}
     if 'WT' not in dirname and dirname != '' and not noexclude and remove_wt:
         wt_filename = getWTDir(dirname) + '/' + filename_suffix
         #if wt_filename[0] == '/' and wt_filename[1:7] != 'lustre': wt_filename = wt_filename[1:]
         if not os.path.isfile(wt_filename):
             print('Warning: Could not find', wt_filename)
-        else:
-            readSummaryToProfile(wt_filename, wt_p, oligoid=oligoid, noexclude=True, remove_wt=False)
-            _, wt_acc, _ = readSummaryToProfile(wt_filename, wt_p_wfilter, oligoid=oligoid, noexclude=False, remove_wt=False)
-            if wt_acc < 10.0: return 0,0,0    #Need at least 20% acceptable reads in the wild type
-                                          #(to remove oligos that are really messed up)
-
+        else: return wt_filename
+    return None
+
+#Process-wide LRU cache of parsed WT profiles, keyed by (WT file, mtime, oligo id, noexclude),
+#since the same WT_12NA/WT_12OA files are used to filter every sample
+WT_CACHE_SIZE = 20000
+_wt_profile_cache = OrderedDict()
+_wt_cache_stats = {'hits': 0, 'misses': 0}
+
+def setWTCacheSize(size):
+    global WT_CACHE_SIZE
+    WT_CACHE_SIZE = size
+    while len(_wt_profile_cache) > WT_CACHE_SIZE:
+        _wt_profile_cache.popitem(last=False)
+
+def clearWTCache():
+    _wt_profile_cache.clear()
+    _wt_cache_stats['hits'], _wt_cache_stats['misses'] = 0, 0
+
+def getWTCacheStats():
+    return {'hits': _wt_cache_stats['hits'], 'misses': _wt_cache_stats['misses'], 'size': len(_wt_profile_cache), 'max_size': WT_CACHE_SIZE}
+
+def _getWTCacheKey(wt_filename, oligoid, noexclude):
+    return (wt_filename, os.stat(wt_filename).st_mtime_ns, oligoid, noexclude)
+
+def _lookupWTCache(key):
+    if key not in _wt_profile_cache:
+        _wt_cache_stats['misses'] += 1
+        return None
+    _wt_cache_stats['hits'] += 1
+    _wt_profile_cache.move_to_end(key)
+    return _wt_profile_cache[key]
+
+def _storeWTCache(key, value):
+    if WT_CACHE_SIZE <= 0: return
+    _wt_profile_cache[key] = value
+    _wt_profile_cache.move_to_end(key)
+    while len(_wt_profile_cache) > WT_CACHE_SIZE:
+        _wt_profile_cache.popitem(last=False)
+
+def _isWTCached(wt_filename, oligoid):
+    return all([_getWTCacheKey(wt_filename, oligoid, noexclude) in _wt_profile_cache for noexclude in [True, False]])
+
+def _getWTProfile(wt_filename, oligoid, wt_rows=None):
+    #Unfiltered WT profile (used for removal of WT indels), and the percentage of WT reads accepted by the filters
+    #(cached profiles are shared, so must not be modified by the caller)
+    results = []
+    for noexclude in [True, False]:
+        key = _getWTCacheKey(wt_filename, oligoid, noexclude)
+        result = _lookupWTCache(key)
+        if result is None:
+            if wt_rows is None: wt_rows = _readSummaryRows(wt_filename, oligoid)
+            wt_p = {}
+            stats = _rowsToProfile(wt_rows, wt_p, noexclude=noexclude, remove_wt=False)
+            result = (wt_p, stats)
+            _storeWTCache(key, result)
+        results.append(result)
+    (wt_p, _), (_, (_, wt_acc, _)) = results
+    return wt_p, wt_acc
+
+def _rowsToProfile(rows, profile, wt_p={}, wt_acc=None, noexclude=False, remove_long_indels=False, remove_wt=True, wt_thresh=3.0):
+
+    if wt_acc is not None and wt_acc < 10.0: return 0,0,0    #Need at least 20% acceptable reads in the wild type
+                                                             #(to remove oligos that are really messed up)
     total, accepted = 0,0
-    f = io.open(filename)
-    reader = csv.reader(f, delimiter='\t')
     if '-' not in profile:
         profile['-'] = 0
     orig_null = profile['-']
-    curr_oligo_id = None
     wt_indels = []
-    for toks in reader:
-        if toks[0][:3] == '@@@':
-            curr_oligo_id = toks[0][3:].split()[0]
-            continue
-        if oligoid != curr_oligo_id:
-            continue
+    for toks in rows:
         indel = toks[0]
         oligo_indel = toks[1]
-        num_reads = eval(toks[2])
+        num_reads = parseCount(toks[2])
         total += num_reads
         if not noexclude:
             if oligo_indel != '-':
@@ -215,10 +352,10 @@ def readSummaryToProfile(filename, profile, oligoid=None, noexclude=False, remov
             #Only allow indels that span the cut site and which are
             #not present in the corresponding WT sample
             if indel != '-':
-                itype, isize, details, muts = tokFullIndel(indel)
-                if itype != '-' and (details['L'] > 5 or details['R'] < -5):
+                ind = parseIndel(indel)
+                if ind.type != '-' and (ind.L > 5 or ind.R < -5):
                     continue
-                if remove_long_indels and isize > 30:
+                if remove_long_indels and ind.size > 30:
                     continue
                 if indel in wt_p and remove_wt: 
                     #Check the levels of the indel in the WT sample,
@@ -235,12 +372,60 @@ def readSummaryToProfile(filename, profile, oligoid=None, noexclude=False, remov
             if indel not in profile: profile[indel] = 0
             profile[indel] += num_reads
             accepted += num_reads
-    f.close()
     if total == 0:
         perc_accepted = 0.0
     else:
         perc_accepted = accepted*100.0/total
     return accepted, perc_accepted, profile['-']-orig_null
+
+#Read in profile from indel summary file
+def readSummaryToProfile(filename, profile, oligoid=None, noexclude=False, remove_long_indels=False, remove_wt=True, wt_thresh=3.0):
+
+    if not os.path.isfile(filename): return 0,0,0
+
+    wt_p, wt_acc = {}, None
+    wt_filename = _getWTFilename(filename, noexclude=noexclude, remove_wt=remove_wt)
+    if wt_filename is not None:
+        wt_p, wt_acc = _getWTProfile(wt_filename, oligoid)
+
+    rows = _readSummaryRows(filename, oligoid)
+    return _rowsToProfile(rows, profile, wt_p=wt_p, wt_acc=wt_acc, noexclude=noexclude, remove_long_indels=remove_long_indels, remove_wt=remove_wt, wt_thresh=wt_thresh)
+
+def _readAllSummaryRows(filename):
+    #Single pass over a summary file, returning {oligo_id: rows} (ids in file order)
+    rows_by_id, curr_rows = {}, None
+    f = io.open(filename)
+    for toks in csv.reader(f, delimiter='\t'):
+        if toks[0][:3] == '@@@':
+            curr_rows = rows_by_id.setdefault(toks[0][3:].split()[0], [])
+            continue
+        if curr_rows is not None:
+            curr_rows.append(toks)
+    f.close()
+    return rows_by_id
+
+#Read in the profiles of all oligos in an indel summary file (and its WT counterpart) in one pass each
+#Yields (oligo_id, profile, accepted, perc_accepted, null_reads) with the same filtering as readSummaryToProfile
+def readSummaryToProfiles(filename, oligo_ids=None, noexclude=False, remove_long_indels=False, remove_wt=True, wt_thresh=3.0):
+
+    if not os.path.isfile(filename): return
+
+    rows_by_id = _readAllSummaryRows(filename)
+    wt_filename = _getWTFilename(filename, noexclude=noexclude, remove_wt=remove_wt)
+    wt_rows_by_id = None
+
+    if oligo_ids is None: oligo_ids = [x for x in rows_by_id]
+    for oligo_id in oligo_ids:
+        profile, wt_p, wt_acc = {}, {}, None
+        if wt_filename is not None:
+            #WT file is only read (once) if some of its profiles are not already cached
+            if wt_rows_by_id is None and not _isWTCached(wt_filename, oligo_id):
+                wt_rows_by_id = _readAllSummaryRows(wt_filename)
+            wt_rows = wt_rows_by_id.get(oligo_id, []) if wt_rows_by_id is not None else None
+            wt_p, wt_acc = _getWTProfile(wt_filename, oligo_id, wt_rows=wt_rows)
+        rows = rows_by_id.get(oligo_id, [])
+        accepted, perc_accepted, null_reads = _rowsToProfile(rows, profile, wt_p=wt_p, wt_acc=wt_acc, noexclude=noexclude, remove_long_indels=remove_long_indels, remove_wt=remove_wt, wt_thresh=wt_thresh)
+        yield oligo_id, profile, accepted, perc_accepted, null_reads
     
 def loadMergedProfile(oligo_id, sample_dirs=[]):
     profile, sumfilename = {}, getSummaryFileSuffix(oligo_id)
@@ -265,7 +450,7 @@ def readNullSummaryToProfile(filename, profile, oligoid=None, unedited_only=True
         if unedited_only and indel != '-':
             continue
         oligo_indel = toks[1]
-        num_reads = eval(toks[2])
+        num_reads = parseCount(toks[2])
         if oligo_indel not in profile:
             profile[oligo_indel] = 0
         profile[oligo_indel] += num_reads
@@ -398,8 +583,8 @@ def fetchIndelSizeCounts(p1):
     for indel in p1:
         if indel == '-':
             continue
-        itype,isize,details, muts = tokFullIndel(indel)
-        net_isize = isize - details['I'] - details['D']
+        ind = parseIndel(indel)
+        itype, net_isize = ind.type, ind.size - ind.I - ind.D
         if net_isize % 3 == 0:
             inframe += p1[indel]
         else: